@@ -1,31 +1,128 @@
-from aiogram.dispatcher import Dispatcher
+import asyncio
+import signal
 from aiogram.bot import Bot
-from aiogram.utils.executor import start_webhook
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.dispatcher import Dispatcher
+from aiogram.utils.executor import Executor, set_webhook
+from aiohttp import web
 from sqlalchemy.ext.asyncio import create_async_engine
 from settings import settings
-from storage import Storage
+from storage import MeteredPool, Storage
+from fsm_storage import PostgresStateStorage
+from cache import UserStateCache
+from tally import Tally
+from evks_index import EvksPlayerIndex
+from photo_archive import PhotoArchive
+from secret_codes import SecretCodes
 from models.mapping import mapper_registry
 from logger import get_logger, setup_logger, LoggingMiddlewareAdapter
+from instrumentation import InstrumentedBot, MetricsMiddleware, metrics_handler
+from tracing import Tracer, TracingMiddleware
+from polling import UpdatePoller
+from user_serialization import UserSerialization
+from cache_sync import CHANGES_CHANNEL, ChangeListener
+from workers import FrontDispatcher, WorkerPool
 
 
-bot = Bot(token=settings["telegram_token"])
-dp = Dispatcher(bot)
+bot = InstrumentedBot(
+    token=settings["telegram_token"],
+    server=TelegramAPIServer.from_base(settings["telegram_api_server"]),
+)
 setup_logger()
 logger = get_logger()
-dp.middleware.setup(LoggingMiddlewareAdapter(logger=logger))
 
-connection_string = (
-    "postgresql+asyncpg://{user}:{password}@{host}:{port}/{database}".format(
-        **settings["db"]
-    )
+dsn = "postgresql://{user}:{password}@{host}:{port}/{database}".format(
+    **settings["db"]
+)
+connection_string = dsn.replace("postgresql://", "postgresql+asyncpg://", 1)
+pool_settings = settings["db"]["pool"]
+engine = create_async_engine(
+    connection_string,
+    poolclass=MeteredPool,
+    pool_size=pool_settings["size"],
+    max_overflow=pool_settings["max_overflow"],
+    pool_timeout=pool_settings["timeout"],
+    pool_recycle=pool_settings["recycle"],
+    pool_pre_ping=pool_settings["pre_ping"],
+    connect_args={"statement_cache_size": pool_settings["statement_cache_size"]},
 )
-engine = create_async_engine(connection_string)
 mapper_registry.configure()
 storage = Storage()
 storage.setup_db_engine(engine)
+storage.setup_tally(Tally())
+storage.setup_evks_players(EvksPlayerIndex())
+if settings["cache_sync"]["enabled"] or settings["workers"]["count"] > 1:
+    storage.setup_changes_channel(CHANGES_CHANNEL)
+change_listener = ChangeListener(storage=storage, dsn=dsn)
+if settings["user_state_cache"]["enabled"]:
+    storage.setup_state_cache(
+        UserStateCache(
+            max_size=settings["user_state_cache"]["max_size"],
+            ttl=settings["user_state_cache"]["ttl"],
+        )
+    )
+fsm_settings = settings["fsm_storage"]
+dp = Dispatcher(
+    bot,
+    storage=PostgresStateStorage(
+        storage=storage,
+        read_delay=fsm_settings["read_delay"],
+        write_buffer_size=fsm_settings["write_buffer_size"],
+        flush_interval=fsm_settings["flush_interval"],
+    ),
+)
+dp.middleware.setup(LoggingMiddlewareAdapter(logger=logger))
+dp.middleware.setup(MetricsMiddleware())
+tracer = Tracer(size=settings["tracing"]["buffer_size"])
+if settings["tracing"]["enabled"]:
+    dp.middleware.setup(TracingMiddleware(tracer))
+UserSerialization(coalesce_window=settings["callback_coalesce_window"]).install(dp)
+photo_archive_settings = settings["photo_archive"]
+photo_archive = PhotoArchive(
+    bot=bot,
+    storage=storage,
+    directory=settings["photo_storage_path"],
+    concurrency=photo_archive_settings["concurrency"],
+    queue_size=photo_archive_settings["queue_size"],
+    max_attempts=photo_archive_settings["max_attempts"],
+    retry_backoff=photo_archive_settings["retry_backoff"],
+    rescan_interval=photo_archive_settings["rescan_interval"],
+)
+secret_codes = SecretCodes(
+    key=settings["secret_codes"]["key"],
+    storage=storage,
+    batch_size=settings["secret_codes"]["batch_size"],
+)
+
+
+async def recount_tally() -> None:
+    while True:
+        await asyncio.sleep(settings["tally_recount_interval"])
+        try:
+            await storage.refresh_tally()
+            await storage.publish_tally()
+        except Exception:
+            logger.exception("TALLY_RECOUNT_FAILED")
+
+
+async def start_background_tasks(singleton_jobs: bool = True) -> None:
+    """Loads the in-memory state of this process and starts its jobs.
+
+    With several workers the periodic tally recount and the photo archive
+    run in one of them only, the others get the recounted tally by NOTIFY
+    and leave submitted photos to the archive's scan.
+    """
+    if storage.changes_channel is not None:
+        await change_listener.start()
+    await storage.refresh_evks_players()
+    await storage.refresh_tally()
+    if singleton_jobs:
+        asyncio.ensure_future(recount_tally())
+        await photo_archive.start()
 
 
 async def on_startup(_: Dispatcher) -> None:
+    await start_background_tasks()
     await bot.set_webhook(settings["webhook_url"])
 
 
@@ -35,13 +132,107 @@ async def on_shutdown(_: Dispatcher) -> None:
     await bot.delete_webhook(settings["webhook_url"])
 
 
-def start_app() -> None:
-    start_webhook(
+def create_executor() -> Executor:
+    executor = set_webhook(
         dispatcher=dp,
         webhook_path=settings["webhook_path"],
         on_startup=on_startup,
         on_shutdown=on_shutdown,
-        host=settings["host"],
-        port=settings["port"],
         skip_updates=True,
     )
+    executor.web_app.router.add_get("/metrics", metrics_handler)
+    return executor
+
+
+async def run_polling(poller: UpdatePoller) -> None:
+    await start_background_tasks()
+    # updates are fetched with getUpdates, pending ones are kept
+    await bot.delete_webhook()
+    try:
+        await poller.run()
+    finally:
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+        session = await bot.get_session()
+        await session.close()
+
+
+def start_polling() -> None:
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    polling_settings = settings["polling"]
+    poller = UpdatePoller(
+        dispatcher=dp,
+        max_pending=polling_settings["max_pending"],
+        timeout=polling_settings["timeout"],
+    )
+
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, poller.stop)
+    loop.run_until_complete(run_polling(poller))
+
+
+def worker_port(index: int) -> int:
+    return settings["workers"]["base_port"] + index
+
+
+async def on_worker_shutdown(_: Dispatcher) -> None:
+    await dp.storage.close()
+    await dp.storage.wait_closed()
+
+
+def run_worker(index: int) -> None:
+    """Serves the webhook behind the front dispatcher, see start_workers."""
+
+    async def on_worker_startup(_: Dispatcher) -> None:
+        await start_background_tasks(singleton_jobs=index == 0)
+
+    executor = Executor(dp)
+    executor.on_startup(on_worker_startup, polling=False)
+    executor.on_shutdown(on_worker_shutdown, polling=False)
+    executor.set_webhook(webhook_path=settings["webhook_path"])
+    executor.web_app.router.add_get("/metrics", metrics_handler)
+    executor.run_app(host="127.0.0.1", port=worker_port(index))
+
+
+def start_workers() -> None:
+    """Runs the front dispatcher here and the webhook in worker processes.
+
+    The webhook is set and deleted by the front only, workers keep pending
+    updates.
+    """
+    count = settings["workers"]["count"]
+    pool = WorkerPool(count=count, target=run_worker)
+    front = FrontDispatcher(
+        worker_ports=[worker_port(index) for index in range(count)],
+        webhook_path=settings["webhook_path"],
+    )
+    web_app = front.create_app()
+
+    async def on_front_startup(_: web.Application) -> None:
+        asyncio.ensure_future(pool.watch())
+        await bot.set_webhook(settings["webhook_url"])
+
+    async def on_front_shutdown(_: web.Application) -> None:
+        await bot.delete_webhook()
+        session = await bot.get_session()
+        await session.close()
+
+    web_app.on_startup.append(on_front_startup)
+    web_app.on_shutdown.append(on_front_shutdown)
+
+    pool.start()
+    try:
+        web.run_app(web_app, host=settings["host"], port=settings["port"])
+    finally:
+        pool.stop()
+
+
+def start_app() -> None:
+    if settings["run_mode"] == "polling":
+        start_polling()
+    elif settings["workers"]["count"] > 1:
+        start_workers()
+    else:
+        create_executor().run_app(host=settings["host"], port=settings["port"])
@@ -0,0 +1,45 @@
+"""Memory footprint of the in-memory EVKS player index.
+
+Run with ``PYTHONPATH=foospollbot python foospollbot/benchmarks/bench_evks_index.py``
+"""
+from datetime import date, timedelta
+import tracemalloc
+
+from evks_index import EvksPlayerIndex, EvksPlayerRecord
+
+
+PLAYERS = 10_000
+
+
+def make_players(count: int) -> list[dict]:
+    # rows as they come from the database driver
+    return [
+        dict(
+            id=player_id,
+            first_name=f"Имя{player_id}",
+            last_name=f"Фамилия{player_id}",
+            foreigner=False,
+            last_competition_date=date(2020, 1, 1) + timedelta(days=player_id % 1000),
+            itsf_first_name=f"Name{player_id}" if player_id % 3 == 0 else None,
+            itsf_last_name=f"Surname{player_id}" if player_id % 3 == 0 else None,
+            itsf_license=player_id if player_id % 3 == 0 else None,
+        )
+        for player_id in range(1, count + 1)
+    ]
+
+
+def main() -> None:
+    tracemalloc.start()
+    rows = make_players(PLAYERS)
+    index = EvksPlayerIndex()
+    index.load(EvksPlayerRecord(**row) for row in rows)
+    del rows
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{len(index)} players retain {retained / 1024:.0f} KiB")
+    print(f"{retained / len(index):.0f} bytes per player")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Per-poll CPU cost of preparing a sendMessage request for a campaign.
+
+Compares building the keyboard for every recipient (and parsing the returned
+Message) with the payload prepared once by ``build_poll_payload``.
+
+Run with ``PYTHONPATH=foospollbot python foospollbot/benchmarks/bench_poll_payload.py``
+"""
+import time
+from aiogram import types
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.utils.payload import generate_payload, prepare_arg
+
+from models.entities import VoteOption
+from poll_sender import VoteOptionCallback, build_poll_payload
+
+
+USERS = 50_000
+OPTIONS = tuple(VoteOption(id=i, text=f"Candidate {i}") for i in range(1, 11))
+
+
+# Telegram answer to sendMessage, echoing the keyboard back
+RESPONSE = {
+    "message_id": 1,
+    "date": 1,
+    "chat": {"id": 1, "type": "private"},
+    "text": "text",
+    "reply_markup": InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text=option.text, callback_data="VOTE_OPTION:1")]
+            for option in OPTIONS
+        ]
+    ).to_python(),
+}
+
+
+def per_recipient(user_ids: range) -> None:
+    text = build_poll_payload(OPTIONS)["text"]
+    for user_id in user_ids:
+        inline_keyboard: list[list[InlineKeyboardButton]] = []
+        for option in OPTIONS:
+            inline_keyboard.append(
+                [
+                    InlineKeyboardButton(
+                        text=option.text,
+                        callback_data=VoteOptionCallback.new(option_id=option.id),
+                    )
+                ]
+            )
+        keyboard = InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
+        # what Bot.send_message does around the request
+        reply_markup = prepare_arg(keyboard)
+        generate_payload(
+            chat_id=user_id, text=text, reply_markup=reply_markup, entities=None
+        )
+        types.Message(**RESPONSE)
+
+
+def per_campaign(user_ids: range) -> None:
+    payload = build_poll_payload(OPTIONS)
+    for user_id in user_ids:
+        {"chat_id": user_id, **payload}
+
+
+def main() -> None:
+    for func in (per_recipient, per_campaign):
+        started = time.process_time()
+        func(range(USERS))
+        seconds = time.process_time() - started
+        print(
+            f"{func.__name__}: {seconds:.2f} s CPU for {USERS} polls, "
+            f"{seconds / USERS * 1e6:.2f} us per poll"
+        )
+
+
+if __name__ == "__main__":
+    main()
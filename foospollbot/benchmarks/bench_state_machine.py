@@ -0,0 +1,39 @@
+"""Compares the table-driven UserStateMachine with a transitions.Machine model.
+
+Run with ``PYTHONPATH=foospollbot python foospollbot/benchmarks/bench_state_machine.py``
+"""
+import timeit
+from transitions import Machine
+
+from models.entities import UserInfo, UserState
+from state_machine import UserStateMachine, _transitions
+
+
+class MachineUserStateMachine:
+    """The previous implementation: one transitions.Machine per instance."""
+
+    def __init__(self, state: UserState) -> None:
+        self._machine = Machine(
+            model=self,
+            states=UserState,
+            transitions=_transitions,
+            initial=state,
+        )
+
+    def has_full_info(self, user_info: UserInfo) -> bool:
+        return UserStateMachine.has_full_info(self, user_info)
+
+
+def single_transition(cls: type) -> None:
+    user_sm = cls(UserState.COLLECTING_PHONE)
+    user_sm.next()
+
+
+def main(number: int = 10_000) -> None:
+    for cls in (MachineUserStateMachine, UserStateMachine):
+        seconds = timeit.timeit(lambda: single_transition(cls), number=number)
+        print(f"{cls.__name__}: {seconds / number * 1e6:.2f} us per transition")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,441 @@
+"""Load test of the webhook app with synthetic Telegram updates.
+
+Starts the aiohttp webhook app from ``app.py`` against the database from
+``settings.yaml`` and a stub Bot API server, then fires a mix of updates at
+a target rate and reports latency percentiles, throughput and DB queries per
+update type.
+
+The database needs the schema, EVKS players and at least one vote option for
+vote callbacks. Synthetic users get ids from ``USER_ID_BASE`` up and are
+deleted before and after the run, use a scratch database anyway.
+
+The stub API and the load generator run in a separate thread with their own
+event loop, so the bot's loop only processes updates.
+
+Run with ``PYTHONPATH=foospollbot python foospollbot/benchmarks/bench_webhook_load.py``
+"""
+from typing import Any, Optional
+from collections import defaultdict
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+import argparse
+import asyncio
+import itertools
+import math
+import random
+import tempfile
+import threading
+import time
+from aiohttp import ClientSession, web
+
+from settings import settings
+
+
+USER_ID_BASE = 9_000_000_000
+UPDATE_TYPE_HEADER = "X-Update-Type"
+DEFAULT_MIX = "new_user=1,registration_step=4,photo=1,vote=4,info=0.1"
+
+# registration steps after /start, the last one is the photo
+REGISTRATION_STEPS = ("first_name", "last_name", "phone", "rtsf_url", "photo")
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        name, weight = item.split("=")
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+class StubBotApi:
+    """Answers every Bot API method with a plausible result."""
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.calls: dict[str, int] = defaultdict(int)
+        self._message_ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self, port: int) -> None:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.handle_file)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", port).start()
+
+    async def stop(self) -> None:
+        await self._runner.cleanup()
+
+    def _message(self) -> dict[str, Any]:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": 1, "type": "private"},
+            "text": "",
+        }
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        result: Any = True
+        if method == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub"}
+        elif method == "getupdates":
+            result = []
+        elif method == "getwebhookinfo":
+            result = {
+                "url": "",
+                "has_custom_certificate": False,
+                "pending_update_count": 0,
+            }
+        elif method == "getfile":
+            result = {
+                "file_id": "photo",
+                "file_unique_id": "photo",
+                "file_size": 1024,
+                "file_path": "photos/photo.jpg",
+            }
+        elif method.startswith("send") or method.startswith("edit"):
+            result = self._message()
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request: web.Request) -> web.Response:
+        self.calls["file"] += 1
+        return web.Response(body=random.randbytes(1024))
+
+
+@dataclass
+class UpdateStats:
+    latencies: list[float] = field(default_factory=list)
+    queries: list[int] = field(default_factory=list)
+    errors: int = 0
+
+
+@dataclass
+class RegisteringUser:
+    telegram_user_id: int
+    step: int = 0
+    busy: bool = False
+
+
+class LoadGenerator:
+    def __init__(
+        self,
+        webhook_url: str,
+        mix: dict[str, float],
+        voters: list[int],
+        evks_player_ids: list[int],
+        vote_option_ids: list[int],
+    ) -> None:
+        self.webhook_url = webhook_url
+        self.mix = mix
+        self.voters = voters
+        self.evks_player_ids = evks_player_ids
+        self.vote_option_ids = vote_option_ids
+        self.stats: dict[str, UpdateStats] = defaultdict(UpdateStats)
+        self._users: list[RegisteringUser] = []
+        self._next_user_id = itertools.count(USER_ID_BASE + len(voters))
+        self._update_ids = itertools.count(1)
+
+    def _message(self, telegram_user_id: int, chat_id: int, **fields: Any) -> dict:
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {
+                    "id": telegram_user_id,
+                    "is_bot": False,
+                    "first_name": "Load",
+                    "username": f"load{telegram_user_id}",
+                },
+                **fields,
+            },
+        }
+
+    def _registration_update(self, user: RegisteringUser) -> dict:
+        user_id = user.telegram_user_id
+        if user.step == 0:
+            return self._message(user_id, user_id, text="/start")
+
+        step = REGISTRATION_STEPS[user.step - 1]
+        if step == "photo":
+            photo = {
+                "file_id": f"photo{user_id}",
+                "file_unique_id": f"photo{user_id}",
+                "width": 1280,
+                "height": 960,
+            }
+            return self._message(user_id, user_id, photo=[photo])
+
+        text = {
+            "first_name": "Имя",
+            "last_name": "Фамилия",
+            "phone": f"+7999{user_id % 10_000_000:07d}",
+            "rtsf_url": "https://rtsf.ru/ratings/player/"
+            f"{random.choice(self.evks_player_ids)}",
+        }[step]
+        return self._message(user_id, user_id, text=text)
+
+    def _vote_update(self, telegram_user_id: int) -> dict:
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(telegram_user_id),
+                "chat_instance": "load",
+                "from": {"id": telegram_user_id, "is_bot": False, "first_name": "Load"},
+                "message": {
+                    "message_id": 1,
+                    "date": int(time.time()),
+                    "chat": {"id": telegram_user_id, "type": "private"},
+                    "text": "poll",
+                },
+                "data": f"VOTE_OPTION:{random.choice(self.vote_option_ids)}",
+            },
+        }
+
+    def _idle_user(self, last_step: bool) -> Optional[RegisteringUser]:
+        photo_step = len(REGISTRATION_STEPS)
+        candidates = [
+            user
+            for user in self._users
+            if not user.busy
+            and (user.step == photo_step if last_step else 0 < user.step < photo_step)
+        ]
+        return random.choice(candidates) if candidates else None
+
+    def _next_update(self) -> tuple[str, dict, Optional[RegisteringUser]]:
+        update_type = random.choices(list(self.mix), weights=self.mix.values())[0]
+
+        if update_type == "info":
+            admin_chat_id = settings["admin_chat_id"]
+            return update_type, self._message(1, admin_chat_id, text="/info"), None
+        if update_type == "vote" and self.voters:
+            return update_type, self._vote_update(self.voters.pop()), None
+
+        user = None
+        if update_type in ("registration_step", "photo"):
+            user = self._idle_user(last_step=update_type == "photo")
+        if user is None:
+            update_type = "new_user"
+            user = RegisteringUser(telegram_user_id=next(self._next_user_id))
+            self._users.append(user)
+        user.busy = True
+        return update_type, self._registration_update(user), user
+
+    async def _fire(
+        self,
+        session: ClientSession,
+        update_type: str,
+        update: dict,
+        user: Optional[RegisteringUser],
+    ) -> None:
+        stats = self.stats[update_type]
+        started = time.perf_counter()
+        try:
+            async with session.post(
+                self.webhook_url,
+                json=update,
+                headers={UPDATE_TYPE_HEADER: update_type},
+            ) as response:
+                await response.read()
+                if response.status != 200:
+                    stats.errors += 1
+        except Exception:
+            stats.errors += 1
+        stats.latencies.append(time.perf_counter() - started)
+
+        if user is not None:
+            user.step += 1
+            user.busy = False
+            if user.step > len(REGISTRATION_STEPS):
+                self._users.remove(user)
+
+    async def run(self, rate: float, duration: float) -> float:
+        """Fires updates open-loop at ``rate`` per second, returns elapsed time."""
+        tasks = []
+        async with ClientSession() as session:
+            started = time.perf_counter()
+            for i in range(int(rate * duration)):
+                delay = started + i / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                update = self._next_update()
+                tasks.append(asyncio.ensure_future(self._fire(session, *update)))
+            await asyncio.gather(*tasks)
+        return time.perf_counter() - started
+
+
+_query_counter: ContextVar[Optional[list[int]]] = ContextVar(
+    "query_counter", default=None
+)
+
+
+def _count_query(*_: Any) -> None:
+    if (counter := _query_counter.get()) is not None:
+        counter[0] += 1
+
+
+def make_query_counting_middleware(stats: dict[str, UpdateStats]) -> Any:
+    """Counts queries of every webhook request, by update type.
+
+    The dispatcher handles the update in a task created from the request, so
+    the counter set here is visible to the queries of the handler.
+    """
+
+    @web.middleware
+    async def middleware(request: web.Request, handler: Any) -> web.StreamResponse:
+        counter = [0]
+        _query_counter.set(counter)
+        try:
+            return await handler(request)
+        finally:
+            if update_type := request.headers.get(UPDATE_TYPE_HEADER):
+                stats[update_type].queries.append(counter[0])
+
+    return middleware
+
+
+async def delete_synthetic_users(storage: Any) -> None:
+    from sqlalchemy import delete
+    from models.tables import poll_dispatches, telegram_users, vote_results
+
+    async with storage.session() as session:
+        for table, column in (
+            (vote_results, vote_results.c.telegram_user_id),
+            (poll_dispatches, poll_dispatches.c.telegram_user_id),
+            (telegram_users, telegram_users.c.id),
+        ):
+            await session.execute(delete(table).where(column >= USER_ID_BASE))
+        await session.commit()
+
+
+async def seed_voters(storage: Any, count: int) -> list[int]:
+    from sqlalchemy import insert
+    from models.entities import UserState
+    from models.tables import telegram_users, user_infos
+
+    voters = list(range(USER_ID_BASE, USER_ID_BASE + count))
+    async with storage.session() as session:
+        await session.execute(
+            insert(telegram_users),
+            [{"id": voter, "first_name": "Voter"} for voter in voters],
+        )
+        await session.execute(
+            insert(user_infos),
+            [
+                {"telegram_user_id": voter, "state": UserState.VOTING}
+                for voter in voters
+            ],
+        )
+        await session.commit()
+    return voters
+
+
+def print_report(
+    generator: LoadGenerator, api: StubBotApi, query_stats: dict, elapsed: float
+) -> None:
+    total = sum(len(stats.latencies) for stats in generator.stats.values())
+    print(f"{total} updates in {elapsed:.1f}s, {total / elapsed:.1f} updates/s\n")
+    print(
+        f"{'update type':<18}{'count':>7}{'errors':>8}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}"
+    )
+    for update_type, stats in sorted(generator.stats.items()):
+        latencies = sorted(stats.latencies)
+        queries = query_stats[update_type].queries
+        print(
+            f"{update_type:<18}{len(latencies):>7}{stats.errors:>8}"
+            + "".join(f"{percentile(latencies, q) * 1000:>9.1f}" for q in (50, 95, 99))
+            + f"{sum(queries) / max(len(queries), 1):>9.1f}"
+        )
+    calls = ", ".join(f"{name} {count}" for name, count in sorted(api.calls.items()))
+    print(f"\nBot API calls: {calls}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rate", type=float, default=50, help="updates per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="update type weights")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="seconds")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--api-port", type=int, default=18081)
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+
+    # must be in place before the app is imported
+    settings["telegram_api_server"] = f"http://127.0.0.1:{args.api_port}"
+    settings["photo_storage_path"] = tempfile.mkdtemp(prefix="foospollbot-load-")
+    settings["log_level"] = "WARNING"
+
+    import bot  # noqa: F401, registers the handlers
+    from app import create_executor, engine, storage
+    from sqlalchemy import event, select
+    from models.tables import evks_players, vote_options
+
+    driver_loop = asyncio.new_event_loop()
+    threading.Thread(target=driver_loop.run_forever, daemon=True).start()
+
+    def on_driver(coro: Any) -> Any:
+        return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, driver_loop))
+
+    api = StubBotApi(latency=args.api_latency)
+    asyncio.run_coroutine_threadsafe(api.start(args.api_port), driver_loop).result()
+
+    executor = create_executor()
+    query_stats: dict[str, UpdateStats] = defaultdict(UpdateStats)
+    executor.web_app.middlewares.append(make_query_counting_middleware(query_stats))
+    event.listen(engine.sync_engine, "before_cursor_execute", _count_query)
+
+    async def run() -> None:
+        runner = web.AppRunner(executor.web_app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", args.port).start()
+        try:
+            await delete_synthetic_users(storage)
+            async with storage.session() as session:
+                player_ids = (
+                    await session.execute(select(evks_players.c.id).limit(1000))
+                ).scalars().all()
+                option_ids = (
+                    await session.execute(select(vote_options.c.id))
+                ).scalars().all()
+            if not player_ids:
+                raise SystemExit("No EVKS players in the database")
+
+            voters: list[int] = []
+            if option_ids and "vote" in mix:
+                expected = args.rate * args.duration * mix["vote"] / sum(mix.values())
+                voters = await seed_voters(storage, int(expected * 1.5) + 10)
+                await storage.refresh_tally()
+
+            generator = LoadGenerator(
+                webhook_url=f"http://127.0.0.1:{args.port}{settings['webhook_path']}",
+                mix=mix,
+                voters=voters,
+                evks_player_ids=list(player_ids),
+                vote_option_ids=list(option_ids),
+            )
+            elapsed = await on_driver(generator.run(args.rate, args.duration))
+            print_report(generator, api, query_stats, elapsed)
+        finally:
+            await delete_synthetic_users(storage)
+            await runner.cleanup()
+            await on_driver(api.stop())
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Measures webhook throughput with 1, 2, 4 ... worker processes.
+
+Updates go through ``FrontDispatcher`` to ``WorkerPool`` processes, as in the
+multi-worker run mode. Workers don't use the database or the Bot API: each
+update is parsed and answered with a poll keyboard, which stands in for the
+CPU-bound part of the handlers. Throughput can only scale up to the number
+of cores.
+
+Run with
+``PYTHONPATH=foospollbot python foospollbot/benchmarks/bench_workers_scaling.py``
+"""
+import argparse
+import asyncio
+import os
+import time
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from aiohttp import ClientError, ClientSession, web
+
+from models.entities import UserState
+from state_machine import UserStateMachine
+from workers import FrontDispatcher, WorkerPool
+
+
+BASE_PORT = 18081
+FRONT_PORT = 18080
+WEBHOOK_PATH = "/webhook"
+OPTIONS = [f"Кандидат {index}" for index in range(20)]
+
+
+async def handle_update(request: web.Request) -> web.Response:
+    update = Update(**await request.json())
+    user_sm = UserStateMachine(UserState.ACCEPTED)
+    user_sm.start_vote()
+    keyboard = InlineKeyboardMarkup(row_width=1)
+    for index, option in enumerate(OPTIONS):
+        keyboard.add(InlineKeyboardButton(option, callback_data=f"vote:{index}"))
+    return web.json_response(
+        {
+            "method": "sendMessage",
+            "chat_id": update.message.chat.id,
+            "text": update.message.text,
+            "reply_markup": keyboard.to_python(),
+        }
+    )
+
+
+def run_worker(index: int) -> None:
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    web.run_app(app, host="127.0.0.1", port=BASE_PORT + index, print=None)
+
+
+def make_update(update_id: int, user_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+            "text": "/vote",
+        },
+    }
+
+
+async def wait_ready(session: ClientSession, ports: list[int]) -> None:
+    for port in ports:
+        while True:
+            try:
+                async with session.get(f"http://127.0.0.1:{port}/"):
+                    break
+            except ClientError:
+                await asyncio.sleep(0.1)
+
+
+async def send_updates(
+    session: ClientSession, total: int, concurrency: int, users: int
+) -> float:
+    update_ids = iter(range(total))
+
+    async def client() -> None:
+        for update_id in update_ids:
+            async with session.post(
+                f"http://127.0.0.1:{FRONT_PORT}{WEBHOOK_PATH}",
+                json=make_update(update_id, update_id % users + 1),
+            ) as response:
+                assert response.status == 200, response.status
+                await response.read()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return time.perf_counter() - started
+
+
+async def measure(workers: int, total: int, concurrency: int, users: int) -> float:
+    pool = WorkerPool(count=workers, target=run_worker)
+    front = FrontDispatcher(
+        worker_ports=[BASE_PORT + index for index in range(workers)],
+        webhook_path=WEBHOOK_PATH,
+    )
+    runner = web.AppRunner(front.create_app())
+    pool.start()
+    try:
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", FRONT_PORT).start()
+        async with ClientSession() as session:
+            await wait_ready(session, front.worker_ports)
+            # warms up every worker
+            await send_updates(session, workers * 10, concurrency, users)
+            seconds = await send_updates(session, total, concurrency, users)
+    finally:
+        await runner.cleanup()
+        pool.stop()
+    return total / seconds
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--users", type=int, default=1000)
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} cores")
+    baseline = None
+    for workers in args.workers:
+        rate = asyncio.run(
+            measure(workers, args.updates, args.concurrency, args.users)
+        )
+        baseline = baseline or rate
+        print(f"{workers} workers: {rate:8.0f} updates/s, x{rate / baseline:.2f}")
+
+
+if __name__ == "__main__":
+    main()
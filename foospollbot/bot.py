@@ -1,7 +1,6 @@
+from typing import Any
 from contextlib import contextmanager
-from uuid import uuid4
-import string
-import secrets
+import asyncio
 from aiogram.types.message import Message
 from aiogram.types.update import Update
 from aiogram.types.callback_query import CallbackQuery
@@ -16,7 +15,16 @@ from aiogram.utils.callback_data import CallbackData
 from aiogram.utils.exceptions import MessageNotModified
 from transitions import MachineError
 
-from app import bot, dp, storage, start_app
+from app import (
+    bot,
+    dp,
+    photo_archive,
+    secret_codes,
+    start_app,
+    storage,
+    tracer,
+)
+from storage import DB_POOL_CHECKED_OUT, DB_POOL_WAIT
 from settings import settings
 from models.entities import (
     TelegramUser,
@@ -24,7 +32,6 @@ from models.entities import (
     UserState,
     VoteResult,
 )
-from filters import NewUserFilter, UserStateFilter
 from state_machine import UserStateMachine
 from parsers import PhoneParser, RtsfUrlParser
 from exceptions import (
@@ -36,12 +43,13 @@ from exceptions import (
 )
 from logger import get_logger
 from poll_sender import AbstractPollSender, VoteOptionCallback
+from dashboard import LiveDashboard
+from instrumentation import HANDLER_ERRORS
 
 
 logger = get_logger()
 
 
-PHOTO_STORAGE_PATH = settings["photo_storage_path"]
 ORG_TELEGRAM_USER = settings["org_telegram_user"]
 ADMIN_CHAT_ID = settings["admin_chat_id"]
 
@@ -49,15 +57,46 @@ ADMIN_CHAT_ID = settings["admin_chat_id"]
 ApproveCallback = CallbackData("APPROVE", "telegram_user_id")
 RejectCallback = CallbackData("REJECT", "telegram_user_id")
 
+# advisory lock key of the poll campaign, shared by all processes and replicas
+POLL_CAMPAIGN_LOCK = 7_210_001
+
 
 class PollSender(AbstractPollSender):
     bot = bot
     storage = storage
+    admin_chat_id = ADMIN_CHAT_ID
+
+    CONCURRENT_POLLS = settings["poll_sender"]["concurrency"]
+    CHUNK_SIZE = settings["poll_sender"]["chunk_size"]
+    RESULTS_BATCH_SIZE = settings["poll_sender"]["results_batch_size"]
+    RESULTS_INTERVAL = settings["poll_sender"]["results_interval"]
+    MESSAGES_PER_SECOND = settings["poll_sender"]["messages_per_second"]
+    MAX_RETRIES = settings["poll_sender"]["max_retries"]
+    RETRY_BACKOFF = settings["poll_sender"]["retry_backoff"]
+    PROGRESS_INTERVAL = settings["poll_sender"]["progress_interval"]
+
+
+def render_info(info: dict[str, Any]) -> str:
+    text = "*States:*\n"
+    for state, count in info["states"].items():
+        text += f"{state.value}: {count}\n"
+
+    text += "\n*Current results:*\n"
+    for option, count in info["results"].items():
+        text += f"{option}: {count}\n"
 
+    return text
 
-def generate_secret_code(len: int = 8) -> str:
-    alphabet = string.ascii_letters + string.digits
-    return "".join(secrets.choice(alphabet) for _ in range(len)).upper()
+
+def render_live_info() -> str:
+    return render_info(storage.tally.snapshot()).replace("_", "\\_")
+
+
+live_dashboard = LiveDashboard(
+    bot=bot,
+    render=render_live_info,
+    interval=settings["live_dashboard_interval"],
+)
 
 
 @contextmanager
@@ -71,43 +110,157 @@ def enrich_logs(handler_name: str, message: Message) -> None:
         yield
 
 
+async def send_undelivered_polls(message: Message) -> None:
+    async with storage.session() as session:
+        total = await storage.count_undelivered_poll_dispatches(session)
+        vote_options = await storage.get_vote_options(session)
+
+    sender = PollSender(options=tuple(vote_options), total=total)
+    await message.answer(f"Началась отправка опросов: {total}")
+    await sender.send(storage.iter_undelivered_poll_dispatches(PollSender.CHUNK_SIZE))
+    await message.answer(f"Отправка опросов закончена\n{sender.progress.format()}")
+
+
+async def run_poll_campaign(message: Message, create_dispatches: bool) -> None:
+    try:
+        async with storage.advisory_lock(POLL_CAMPAIGN_LOCK) as locked:
+            if not locked:
+                await message.answer("Отправка опросов уже идет")
+                return
+
+            if create_dispatches:
+                with logger:
+                    async with storage.session() as session:
+                        created = await storage.create_poll_dispatches(session)
+                        await session.commit()
+
+                    logger.context_push(created=created)
+                    logger.info("POLL_DISPATCHES_CREATED")
+
+            await send_undelivered_polls(message)
+    except Exception:
+        logger.exception("POLL_SENDING_FAILED")
+        await message.answer("Отправка опросов прервана из-за ошибки")
+
+
+def start_poll_campaign(message: Message, create_dispatches: bool) -> None:
+    """Sends polls in the background, the admin's other commands aren't held up.
+
+    A campaign already running in any worker or replica is left alone.
+    """
+    asyncio.ensure_future(run_poll_campaign(message, create_dispatches))
+
+
 @dp.message_handler(
     IDFilter(chat_id=ADMIN_CHAT_ID),
     Text(equals="/startvote"),
+    state="*",
 )
 async def admin_handler_startvote(message: Message) -> None:
-    async with storage.session() as session:
-        user_ids = await storage.get_accepted_users(session)
-        vote_options = await storage.get_vote_options(session)
+    start_poll_campaign(message, create_dispatches=True)
+
 
-    sender = PollSender(user_ids, options=tuple(vote_options))
-    await message.answer("Началась отправка опросов")
-    await sender.send()
-    await message.answer("Отправка опросов закончена")
+@dp.message_handler(
+    IDFilter(chat_id=ADMIN_CHAT_ID),
+    Text(equals="/resumevote"),
+    state="*",
+)
+async def admin_handler_resumevote(message: Message) -> None:
+    start_poll_campaign(message, create_dispatches=False)
 
 
 @dp.message_handler(
     IDFilter(chat_id=ADMIN_CHAT_ID),
     Text(equals="/info"),
+    state="*",
 )
 async def admin_handler_info(message: Message) -> None:
-    async with storage.session() as session:
-        info = await storage.get_info(session)
-        text = "*States:*\n"
-        for state, count in info["states"].items():
-            text += f"{state.value}: {count}\n"
+    if storage.tally is not None and storage.tally.loaded:
+        info = storage.tally.snapshot()
+    else:
+        async with storage.session() as session:
+            info = await storage.get_info(session)
 
-        text += "\n*Current results:*\n"
-        for option, count in info["results"].items():
-            text += f"{option}: {count}\n"
+    text = render_info(info)
 
-        await message.answer(
-            text=text.replace("_", "\\_"),
-            parse_mode=ParseMode.MARKDOWN_V2,
+    if (cache := storage.state_cache) is not None:
+        text += (
+            f"\n*State cache:* {len(cache)} users, "
+            f"{cache.hits} hits, {cache.misses} misses\n"
+        )
+
+    if waits := DB_POOL_WAIT.count():
+        text += (
+            f"\n*DB pool:* {int(DB_POOL_CHECKED_OUT.value())} checked out, "
+            f"avg wait {int(DB_POOL_WAIT.sum() / waits * 1000)} ms\n"
+        )
+
+    await message.answer(
+        text=text.replace("_", "\\_"),
+        parse_mode=ParseMode.MARKDOWN_V2,
+    )
+
+
+@dp.message_handler(
+    IDFilter(chat_id=ADMIN_CHAT_ID),
+    Text(equals="/live"),
+    state="*",
+)
+async def admin_handler_live(message: Message) -> None:
+    if storage.tally is None or not storage.tally.loaded:
+        await message.answer("Счетчики еще не загружены, попробуйте позже")
+        return
+
+    live_dashboard.stop(message.chat.id)
+    await live_dashboard.start(message.chat.id)
+
+
+@dp.message_handler(
+    IDFilter(chat_id=ADMIN_CHAT_ID),
+    Text(equals="/stoplive"),
+    state="*",
+)
+async def admin_handler_stoplive(message: Message) -> None:
+    if live_dashboard.stop(message.chat.id):
+        await message.answer("Обновление остановлено")
+
+
+@dp.message_handler(
+    IDFilter(chat_id=ADMIN_CHAT_ID),
+    Text(equals="/reloadplayers"),
+    state="*",
+)
+async def admin_handler_reloadplayers(message: Message) -> None:
+    loaded = await storage.refresh_evks_players()
+    await storage.publish_evks_players_changed()
+    await message.answer(f"Загружено игроков ЕВКС: {loaded}")
+
+
+@dp.message_handler(
+    IDFilter(chat_id=ADMIN_CHAT_ID),
+    Text(equals="/slowest"),
+    state="*",
+)
+async def admin_handler_slowest(message: Message) -> None:
+    traces = tracer.slowest(10)
+    if not traces:
+        await message.answer("Трейсов нет, включите tracing в настройках")
+        return
+
+    text = ""
+    for trace in traces:
+        text += (
+            f"{trace.duration * 1000:.0f} ms {trace.handler} "
+            f"user {trace.telegram_user_id} update {trace.update_id}\n"
         )
+        for name, (count, total) in list(trace.summary().items())[:5]:
+            text += f"  {name} x{count}: {total * 1000:.0f} ms\n"
+        text += "\n"
+
+    await message.answer(text)
 
 
-@dp.callback_query_handler(VoteOptionCallback.filter())
+@dp.callback_query_handler(VoteOptionCallback.filter(), state="*")
 async def vote_result_handler(
     callback: CallbackQuery, callback_data: dict[str, str]
 ) -> None:
@@ -123,28 +276,23 @@ async def vote_result_handler(
             option_id = int(callback_data["option_id"])
 
             async with storage.session() as session:
-                user_info = await storage.get_user_info(
+                user_info = await storage.transition(
                     session=session,
                     telegram_user_id=callback.from_user.id,
-                    for_update=True,
+                    trigger="vote_result",
                 )
-                user_sm = UserStateMachine(user_info.state)
-                user_sm.vote_result(user_info)
-                user_info.state = user_sm.state
-                session.add(user_info)
 
-                secret_code = generate_secret_code()
+                vote_result_id, secret_code = await secret_codes.reserve(session)
                 vote_result = VoteResult(
-                    id=None,
+                    id=vote_result_id,
                     telegram_user_id=user_info.telegram_user_id,
                     selected_option_id=option_id,
                     secret_code=secret_code,
                 )
-                session.add(vote_result)
-
                 selected_option = await storage.get_vote_option(session, option_id)
+                storage.add_vote_result(session, vote_result, selected_option)
 
-                await session.commit()
+                await storage.commit(session)
 
             logger.context_push(secret_code=secret_code)
             logger.info("SAVED_VOTE_RESULT")
@@ -152,9 +300,8 @@ async def vote_result_handler(
             logger.exception("VOTE_RESULT_STATE_ERROR")
             await bot.send_message(
                 chat_id=callback.from_user.id,
-                text="Ваш запрос обрабатывается, бот может отвечать "
-                "с задержкой из-за большого количества запросов. "
-                "Если вы все-таки не получили подтверждения "
+                text="Ваш голос уже учтен или голосование для вас недоступно. "
+                "Если вы не получили подтверждения "
                 "о том, что ваш голос принят, напишите "
                 f"организаторам @{ORG_TELEGRAM_USER}.",
             )
@@ -182,7 +329,9 @@ async def vote_result_handler(
                 logger.warn("MESSAGE_NOT_MODIFIED_ERROR", exc_info=True)
 
 
-@dp.callback_query_handler(IDFilter(chat_id=ADMIN_CHAT_ID), ApproveCallback.filter())
+@dp.callback_query_handler(
+    IDFilter(chat_id=ADMIN_CHAT_ID), ApproveCallback.filter(), state="*"
+)
 async def approve_handler(
     callback: CallbackQuery, callback_data: dict[str, str]
 ) -> None:
@@ -197,16 +346,12 @@ async def approve_handler(
         try:
             telegram_user_id = int(callback_data["telegram_user_id"])
             async with storage.session() as session:
-                user_info = await storage.get_user_info(
+                await storage.transition(
                     session=session,
                     telegram_user_id=telegram_user_id,
-                    for_update=True,
+                    trigger="approve",
                 )
-                user_sm = UserStateMachine(user_info.state)
-                user_sm.approve(user_info)
-                user_info.state = user_sm.state
-                session.add(user_info)
-                await session.commit()
+                await storage.commit(session)
 
             logger.info("APPROVED_USER")
 
@@ -225,7 +370,9 @@ async def approve_handler(
                 logger.warn("MESSAGE_NOT_MODIFIED_ERROR", exc_info=True)
 
 
-@dp.callback_query_handler(IDFilter(chat_id=ADMIN_CHAT_ID), RejectCallback.filter())
+@dp.callback_query_handler(
+    IDFilter(chat_id=ADMIN_CHAT_ID), RejectCallback.filter(), state="*"
+)
 async def reject_handler(
     callback: CallbackQuery, callback_data: dict[str, str]
 ) -> None:
@@ -239,16 +386,12 @@ async def reject_handler(
 
         telegram_user_id = int(callback_data["telegram_user_id"])
         async with storage.session() as session:
-            user_info = await storage.get_user_info(
+            await storage.transition(
                 session=session,
                 telegram_user_id=telegram_user_id,
-                for_update=True,
+                trigger="reject",
             )
-            user_sm = UserStateMachine(user_info.state)
-            user_sm.reject(user_info)
-            user_info.state = user_sm.state
-            session.add(user_info)
-            await session.commit()
+            await storage.commit(session)
 
         logger.info("REJECTED_USER")
 
@@ -256,7 +399,8 @@ async def reject_handler(
         await callback.message.reply(text=f"Rejected by @{callback.from_user.username}")
 
 
-@dp.message_handler(NewUserFilter())
+# users without user info have no state
+@dp.message_handler()
 async def new_user_handler(message: Message) -> None:
     with enrich_logs("new_user", message):
         logger.info("NEW_USER")
@@ -279,8 +423,8 @@ async def new_user_handler(message: Message) -> None:
                     telegram_user_id=message.from_user.id,
                     state=UserStateMachine.get_initial_state(),
                 )
-                session.add(user_info)
-                await session.commit()
+                storage.add_user_info(session, user_info)
+                await storage.commit(session)
                 logger.info("USER_CREATED")
             else:
                 logger.warning("USER_ALREADY_EXISTS_SKIP_CREATING")
@@ -288,7 +432,7 @@ async def new_user_handler(message: Message) -> None:
         await message.answer(text="Сообщите свое имя")
 
 
-@dp.message_handler(UserStateFilter(UserState.COLLECTING_FIRST_NAME))
+@dp.message_handler(state=UserState.COLLECTING_FIRST_NAME.value)
 async def collect_first_name_handler(message: Message) -> None:
     with enrich_logs("collect_first_name", message):
         logger.info("COLLECTING_FIRST_NAME")
@@ -296,25 +440,20 @@ async def collect_first_name_handler(message: Message) -> None:
         first_name = message.text.strip()
 
         async with storage.session() as session:
-            user_info = await storage.get_user_info(
+            await storage.transition(
                 session=session,
                 telegram_user_id=message.from_user.id,
-                for_update=True,
+                trigger="next",
+                from_state=UserState.COLLECTING_FIRST_NAME,
+                first_name=first_name,
             )
-            user_sm = UserStateMachine(user_info.state)
-
-            user_info.first_name = first_name
-            user_sm.next()
-            user_info.state = user_sm.state
-
-            session.add(user_info)
-            await session.commit()
+            await storage.commit(session)
 
         logger.info("SAVED_FIRST_NAME")
         await message.answer(text="Сообщите свою фамилию")
 
 
-@dp.message_handler(UserStateFilter(UserState.COLLECTING_LAST_NAME))
+@dp.message_handler(state=UserState.COLLECTING_LAST_NAME.value)
 async def collect_last_name_handler(message: Message) -> None:
     with enrich_logs("collect_last_name", message):
         logger.info("COLLECTING_LAST_NAME")
@@ -322,25 +461,20 @@ async def collect_last_name_handler(message: Message) -> None:
         last_name = message.text.strip()
 
         async with storage.session() as session:
-            user_info = await storage.get_user_info(
+            await storage.transition(
                 session=session,
                 telegram_user_id=message.from_user.id,
-                for_update=True,
+                trigger="next",
+                from_state=UserState.COLLECTING_LAST_NAME,
+                last_name=last_name,
             )
-            user_sm = UserStateMachine(user_info.state)
-
-            user_info.last_name = last_name
-            user_sm.next()
-            user_info.state = user_sm.state
-
-            session.add(user_info)
-            await session.commit()
+            await storage.commit(session)
 
         logger.info("SAVED_LAST_NAME")
         await message.answer(text="Сообщите номер телефона")
 
 
-@dp.message_handler(UserStateFilter(UserState.COLLECTING_PHONE))
+@dp.message_handler(state=UserState.COLLECTING_PHONE.value)
 async def collect_phone_handler(message: Message) -> None:
     with enrich_logs("collect_phone", message):
         logger.info("COLLECTING_PHONE")
@@ -348,19 +482,14 @@ async def collect_phone_handler(message: Message) -> None:
         phone = PhoneParser(message.text).parse()
 
         async with storage.session() as session:
-            user_info = await storage.get_user_info(
+            await storage.transition(
                 session=session,
                 telegram_user_id=message.from_user.id,
-                for_update=True,
+                trigger="next",
+                from_state=UserState.COLLECTING_PHONE,
+                phone=phone,
             )
-            user_sm = UserStateMachine(user_info.state)
-
-            user_info.phone = phone
-            user_sm.next()
-            user_info.state = user_sm.state
-
-            session.add(user_info)
-            await session.commit()
+            await storage.commit(session)
 
         logger.info("SAVED_PHONE")
         await message.answer(
@@ -368,30 +497,25 @@ async def collect_phone_handler(message: Message) -> None:
         )
 
 
-@dp.message_handler(UserStateFilter(UserState.COLLECTING_RTSF_URL))
+@dp.message_handler(state=UserState.COLLECTING_RTSF_URL.value)
 async def collect_rtsf_url_handler(message: Message) -> None:
     with enrich_logs("collect_rtsf_url", message):
         logger.info("COLLECTING_RTSF_URL")
 
         parsed_url = RtsfUrlParser(message.text).parse()
         async with storage.session() as session:
-            user_info = await storage.get_user_info(
-                session=session,
-                telegram_user_id=message.from_user.id,
-                for_update=True,
-            )
             evks_player = await storage.get_evks_player(
                 session, parsed_url.evks_player_id
             )
-            user_sm = UserStateMachine(user_info.state)
-
-            user_info.rtsf_url = parsed_url.url
-            user_info.evks_player_id = evks_player.id
-            user_sm.next()
-            user_info.state = user_sm.state
-
-            session.add(user_info)
-            await session.commit()
+            await storage.transition(
+                session=session,
+                telegram_user_id=message.from_user.id,
+                trigger="next",
+                from_state=UserState.COLLECTING_RTSF_URL,
+                rtsf_url=parsed_url.url,
+                evks_player_id=evks_player.id,
+            )
+            await storage.commit(session)
 
         logger.info("SAVED_RTSF_URL")
         await message.answer(
@@ -403,7 +527,7 @@ async def collect_rtsf_url_handler(message: Message) -> None:
 
 
 @dp.message_handler(
-    UserStateFilter(UserState.COLLECTING_PHOTO),
+    state=UserState.COLLECTING_PHOTO.value,
     content_types=(ContentType.TEXT,),
 )
 async def collect_photo_no_content_handler(message: Message) -> None:
@@ -413,32 +537,27 @@ async def collect_photo_no_content_handler(message: Message) -> None:
 
 
 @dp.message_handler(
-    UserStateFilter(UserState.COLLECTING_PHOTO),
+    state=UserState.COLLECTING_PHOTO.value,
     content_types=(ContentType.PHOTO,),
 )
 async def collect_photo_handler(message: Message) -> None:
     with enrich_logs("collect_photo", message):
         logger.info("COLLECTING_PHOTO")
 
-        photo_id = uuid4()
-        await message.photo[-1].download(
-            destination_file=f"{PHOTO_STORAGE_PATH}/{photo_id}.jpg"
-        )
+        photo_file_id = message.photo[-1].file_id
 
         async with storage.session() as session:
-            user_info = await storage.get_user_info(
+            user_info = await storage.transition(
                 session=session,
                 telegram_user_id=message.from_user.id,
-                for_update=True,
+                trigger="next",
+                from_state=UserState.COLLECTING_PHOTO,
+                photo_file_id=photo_file_id,
             )
-            user_sm = UserStateMachine(user_info.state)
-            user_info.photo_id = photo_id
-            user_sm.next()
-            user_info.state = user_sm.state
-            session.add(user_info)
-            await session.commit()
-
-        logger.context_push(photo_id=str(photo_id))
+            await storage.commit(session)
+
+        photo_archive.submit(message.from_user.id, photo_file_id)
+        logger.context_push(photo_file_id=photo_file_id)
         logger.info("SAVED_PHOTO")
 
         await message.answer(
@@ -449,14 +568,14 @@ async def collect_photo_handler(message: Message) -> None:
             )
         )
 
-        await notify_admins_review(message.from_user.id)
+        await notify_admins_review(user_info)
         logger.info("REVIEW_NOTIFICATION_SENT")
 
 
-async def notify_admins_review(telegram_user_id: int) -> None:
+async def notify_admins_review(user_info: UserInfo) -> None:
+    telegram_user_id = user_info.telegram_user_id
     async with storage.session() as session:
         telegram_user = await storage.get_telegram_user(session, telegram_user_id)
-        user_info = await storage.get_user_info(session, telegram_user_id)
         evks_player = await storage.get_evks_player(session, user_info.evks_player_id)
         keyboard = InlineKeyboardMarkup(
             inline_keyboard=(
@@ -478,21 +597,20 @@ async def notify_admins_review(telegram_user_id: int) -> None:
                 ],
             )
         )
-        with open(f"{PHOTO_STORAGE_PATH}/{user_info.photo_id}.jpg", "rb") as photo:
-            await bot.send_photo(
-                chat_id=ADMIN_CHAT_ID,
-                photo=photo,
-                caption=(
-                    f"Telegram info: @{telegram_user.username} "
-                    f"({telegram_user.first_name} {telegram_user.last_name})\n"
-                    f"Real name: {user_info.last_name} {user_info.first_name}\n"
-                    f"Phone: {user_info.phone}\n"
-                    f"EVKS: {evks_player.last_name} {evks_player.first_name} "
-                    f"{user_info.rtsf_url}\n"
-                    f"Last competition: {evks_player.last_competition_date}"
-                ),
-                reply_markup=keyboard,
-            )
+        await bot.send_photo(
+            chat_id=ADMIN_CHAT_ID,
+            photo=user_info.photo_file_id,
+            caption=(
+                f"Telegram info: @{telegram_user.username} "
+                f"({telegram_user.first_name} {telegram_user.last_name})\n"
+                f"Real name: {user_info.last_name} {user_info.first_name}\n"
+                f"Phone: {user_info.phone}\n"
+                f"EVKS: {evks_player.last_name} {evks_player.first_name} "
+                f"{user_info.rtsf_url}\n"
+                f"Last competition: {evks_player.last_competition_date}"
+            ),
+            reply_markup=keyboard,
+        )
 
 
 async def notify_approved(telegram_user_id: int) -> None:
@@ -505,7 +623,7 @@ async def notify_approved(telegram_user_id: int) -> None:
     )
 
 
-@dp.message_handler(UserStateFilter(UserState.IN_REVIEW))
+@dp.message_handler(state=UserState.IN_REVIEW.value)
 async def in_review_handler(message: Message) -> None:
     with enrich_logs("in_review", message):
         logger.info("IN_REVIEW_STATUS_POLLED")
@@ -520,6 +638,7 @@ async def exception_handler(update: Update, exception: Exception) -> None:
             error=str(exception),
         )
         logger.info("EXCEPTION_FALLBACK_HANDLER")
+        HANDLER_ERRORS.inc(type=type(exception).__name__)
         msg = {
             PhoneParseError: (
                 "Не удалось сохранить номер телефона. "
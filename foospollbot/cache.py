@@ -0,0 +1,53 @@
+from typing import Optional
+from collections import OrderedDict
+import time
+
+from models.entities import UserState
+
+
+class UserStateCache:
+    """Bounded LRU cache of user states with optional TTL.
+
+    Handlers write new states through on commit and filters can be answered
+    from memory. With several processes sharing the database, changes made
+    by the others arrive through ``cache_sync.ChangeListener``.
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[int, tuple[UserState, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, telegram_user_id: int) -> Optional[UserState]:
+        entry = self._entries.get(telegram_user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        state, expires_at = entry
+        if self.ttl is not None and expires_at < time.monotonic():
+            del self._entries[telegram_user_id]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(telegram_user_id)
+        self.hits += 1
+        return state
+
+    def set(self, telegram_user_id: int, state: UserState) -> None:
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else 0.0
+        self._entries[telegram_user_id] = (state, expires_at)
+        self._entries.move_to_end(telegram_user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, telegram_user_id: int) -> None:
+        self._entries.pop(telegram_user_id, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
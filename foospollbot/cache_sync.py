@@ -0,0 +1,80 @@
+from typing import Any, Optional
+import asyncio
+import asyncpg
+
+from storage import ORIGIN, Storage, decode_changes
+from logger import get_logger
+
+
+CHANGES_CHANNEL = "foospollbot_changes"
+
+
+class ChangeListener:
+    """Applies changes committed by other processes to in-memory state.
+
+    Every process publishing with ``Storage.setup_changes_channel`` listens
+    on the same channel, so user state caches and tallies stay coherent
+    across worker processes and replicas. Notifications sent while the
+    listening connection was down are lost, so after reconnecting the state
+    cache is cleared and the tally recounted.
+    """
+
+    logger = get_logger()
+
+    def __init__(
+        self, storage: Storage, dsn: str, reconnect_interval: float = 5.0
+    ) -> None:
+        self.storage = storage
+        self.dsn = dsn
+        self.reconnect_interval = reconnect_interval
+        self._connection: Optional[asyncpg.Connection] = None
+
+    async def start(self) -> None:
+        await self._connect()
+
+    async def _connect(self) -> None:
+        connection = await asyncpg.connect(self.dsn)
+        await connection.add_listener(self.storage.changes_channel, self._on_changes)
+        connection.add_termination_listener(self._on_termination)
+        self._connection = connection
+
+    def _on_changes(
+        self, connection: Any, pid: int, channel: str, payload: str
+    ) -> None:
+        message = decode_changes(payload)
+        if message["origin"] == ORIGIN:
+            return
+
+        self.storage.apply_changes(message["states"], message["votes"])
+        if message["tally"] is not None and self.storage.tally is not None:
+            self.storage.tally.load(message["tally"])
+        if message["evks_players"]:
+            asyncio.ensure_future(self._refresh_evks_players())
+
+    async def _refresh_evks_players(self) -> None:
+        try:
+            await self.storage.refresh_evks_players()
+        except Exception:
+            self.logger.exception("EVKS_PLAYERS_REFRESH_FAILED")
+
+    def _on_termination(self, connection: Any) -> None:
+        self.logger.warning("CHANGE_LISTENER_DISCONNECTED")
+        asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        self._connection = None
+        while self._connection is None:
+            await asyncio.sleep(self.reconnect_interval)
+            try:
+                await self._connect()
+            except Exception:
+                self.logger.exception("CHANGE_LISTENER_RECONNECT_FAILED")
+        self.logger.info("CHANGE_LISTENER_RECONNECTED")
+
+        if self.storage.state_cache is not None:
+            self.storage.state_cache.clear()
+        try:
+            await self.storage.refresh_tally()
+        except Exception:
+            # the periodic recount repairs the tally later
+            self.logger.exception("TALLY_RECOUNT_FAILED")
@@ -1,59 +1,168 @@
+from typing import Iterable, Iterator, Optional
+import csv
+import io
 import pathlib
+import time
 from datetime import datetime
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql.expression import bindparam
 
 from settings import settings
-from models.tables import metadata_obj, evks_players
+from models.tables import metadata_obj
+from logger import get_logger, setup_logger
 
 
-def create_schema(engine):
-    metadata_obj.create_all(engine)
-
-
-def insert_evks_players(engine):
-    BASE_DIR = pathlib.Path(__file__).parent
-    file_path = BASE_DIR / "data" / "evks_players.csv"
+BASE_DIR = pathlib.Path(__file__).parent
 
-    with open(file_path, "r") as file:
-        lines = file.read().split("\n")
+logger = get_logger()
 
-    columns = (
-        "id",
-        "first_name",
-        "last_name",
-        "itsf_first_name",
-        "itsf_last_name",
-        "itsf_license",
-        "foreigner",
-        "last_competition_date",
-    )
-
-    data = [dict(zip(columns, line.split(","))) for line in lines[1:-1]]
-    for row in data:
-        for key, value in row.items():
-            if value is None or value == "" or value.upper() == "NULL":
-                row[key] = None
+EVKS_PLAYERS_COLUMNS = (
+    "id",
+    "first_name",
+    "last_name",
+    "itsf_first_name",
+    "itsf_last_name",
+    "itsf_license",
+    "foreigner",
+    "last_competition_date",
+)
 
-        row["foreigner"] = row["foreigner"] == "1"
 
-        if dt := row["last_competition_date"]:
-            row["last_competition_date"] = datetime.strptime(dt, "%Y-%m-%d").date()
+def create_schema(engine):
+    metadata_obj.create_all(engine)
 
-        if row["itsf_license"] == "0":
-            row["itsf_license"] = None
 
-    statement = evks_players.insert().values(
-        {column: bindparam(column) for column in columns}
+def _normalize_evks_player(line: list[str]) -> list[Optional[str]]:
+    if len(line) != len(EVKS_PLAYERS_COLUMNS):
+        raise ValueError(
+            f"expected {len(EVKS_PLAYERS_COLUMNS)} fields, got {len(line)}"
+        )
+
+    row: dict[str, Optional[str]] = dict(zip(EVKS_PLAYERS_COLUMNS, line))
+    for key, value in row.items():
+        if value == "" or value.upper() == "NULL":
+            row[key] = None
+
+    row["id"] = str(int(row["id"]))
+    row["foreigner"] = "true" if row["foreigner"] == "1" else "false"
+
+    if dt := row["last_competition_date"]:
+        row["last_competition_date"] = (
+            datetime.strptime(dt, "%Y-%m-%d").date().isoformat()
+        )
+
+    if row["itsf_license"] == "0":
+        row["itsf_license"] = None
+
+    return [row[column] for column in EVKS_PLAYERS_COLUMNS]
+
+
+def parse_evks_players(lines: Iterable[str]) -> Iterator[list[Optional[str]]]:
+    """Normalizes CSV rows to the evks_players column order.
+
+    The line number the row starts at is appended, so the last of
+    duplicate rows can be told apart. Malformed rows are logged and skipped.
+    """
+    reader = csv.reader(lines)
+    next(reader, None)  # header
+
+    while True:
+        line_number = reader.line_num + 1
+        try:
+            line = next(reader)
+        except StopIteration:
+            return
+        if not line:
+            continue
+
+        try:
+            row = _normalize_evks_player(line)
+        except (TypeError, ValueError) as e:
+            with logger:
+                logger.context_push(line_number=line_number, error=str(e))
+                logger.error("EVKS_PLAYER_ROW_SKIPPED")
+            continue
+        yield row + [str(line_number)]
+
+
+class CopyStream:
+    """File-like object COPY reads CSV from, encoding rows as it goes."""
+
+    def __init__(self, rows: Iterator[list[Optional[str]]]) -> None:
+        self._rows = rows
+        self.count = 0
+
+    def read(self, size: int = -1) -> str:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in self._rows:
+            writer.writerow(row)
+            self.count += 1
+            if 0 <= size <= buffer.tell():
+                break
+        return buffer.getvalue()
+
+
+def insert_evks_players(engine, file_path: Optional[pathlib.Path] = None):
+    """Streams the CSV into a staging table with COPY and merges it.
+
+    Existing players are updated, so the import can be re-run after a
+    CSV refresh. Memory use doesn't depend on the file size.
+    """
+    file_path = file_path or BASE_DIR / "data" / "evks_players.csv"
+    columns = ", ".join(EVKS_PLAYERS_COLUMNS)
+    updates = ", ".join(
+        f"{column} = EXCLUDED.{column}" for column in EVKS_PLAYERS_COLUMNS[1:]
     )
 
-    with sessionmaker(engine)() as session:
-        session.execute(statement, data)
-        session.commit()
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(
+            "CREATE TEMP TABLE evks_players_staging "
+            "(LIKE evks_players INCLUDING DEFAULTS, line_number integer) "
+            "ON COMMIT DROP"
+        )
+
+        started = time.perf_counter()
+        with open(file_path, "r", newline="") as file:
+            stream = CopyStream(parse_evks_players(file))
+            cursor.copy_expert(
+                f"COPY evks_players_staging ({columns}, line_number) "
+                "FROM STDIN WITH (FORMAT csv)",
+                stream,
+            )
+        copied = time.perf_counter()
+        print(f"Copied {stream.count} rows in {copied - started:.2f}s")
+
+        cursor.execute(
+            f"""
+            WITH merged AS (
+                INSERT INTO evks_players ({columns})
+                SELECT DISTINCT ON (id) {columns}
+                FROM evks_players_staging
+                -- the last row of a player wins
+                ORDER BY id, line_number DESC
+                ON CONFLICT (id) DO UPDATE SET {updates}
+                RETURNING xmax = 0 AS inserted
+            )
+            SELECT
+                count(*) FILTER (WHERE inserted),
+                count(*) FILTER (WHERE NOT inserted)
+            FROM merged
+            """
+        )
+        inserted, updated = cursor.fetchone()
+        connection.commit()
+        print(
+            f"Inserted {inserted}, updated {updated} evks players "
+            f"in {time.perf_counter() - copied:.2f}s"
+        )
+    finally:
+        connection.close()
 
 
 if __name__ == "__main__":
+    setup_logger()
     engine = create_engine(
         "postgresql://{user}:{password}@{host}:{port}/{database}".format(
             **settings["db"]
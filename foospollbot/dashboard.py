@@ -0,0 +1,89 @@
+from typing import Callable, Optional
+import asyncio
+from aiogram.bot import Bot
+from aiogram.types import ParseMode
+from aiogram.utils.exceptions import (
+    MessageCantBeEdited,
+    MessageNotModified,
+    MessageToEditNotFound,
+    RetryAfter,
+)
+
+from logger import get_logger
+
+
+class LiveDashboard:
+    """Messages edited in place with the latest rendered text.
+
+    All live messages share one update loop: the text is rendered once per
+    tick, at most once every ``interval`` seconds regardless of how many
+    chats are watching, and a message is edited only when the text differs
+    from what was last shown in it.
+    """
+
+    logger = get_logger()
+
+    def __init__(self, bot: Bot, render: Callable[[], str], interval: float) -> None:
+        self.bot = bot
+        self.render = render
+        self.interval = interval
+        self._messages: dict[int, int] = {}
+        self._texts: dict[tuple[int, int], str] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, chat_id: int) -> None:
+        text = self.render()
+        message = await self.bot.send_message(
+            chat_id=chat_id, text=text, parse_mode=ParseMode.MARKDOWN_V2
+        )
+        self._messages[chat_id] = message.message_id
+        self._texts[chat_id, message.message_id] = text
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self, chat_id: int) -> bool:
+        message_id = self._messages.pop(chat_id, None)
+        if message_id is None:
+            return False
+        self._texts.pop((chat_id, message_id), None)
+        return True
+
+    async def _edit(self, chat_id: int, message_id: int, text: str) -> None:
+        if self._messages.get(chat_id) != message_id:
+            # stopped or restarted while other messages were edited
+            return
+        if self._texts.get((chat_id, message_id)) == text:
+            return
+        try:
+            await self.bot.edit_message_text(
+                text=text,
+                chat_id=chat_id,
+                message_id=message_id,
+                parse_mode=ParseMode.MARKDOWN_V2,
+            )
+        except MessageNotModified:
+            pass
+        except (MessageToEditNotFound, MessageCantBeEdited):
+            self.logger.warning("LIVE_MESSAGE_GONE", exc_info=True)
+            if self._messages.get(chat_id) == message_id:
+                self.stop(chat_id)
+            return
+        if self._messages.get(chat_id) == message_id:
+            self._texts[chat_id, message_id] = text
+
+    async def update(self) -> None:
+        """Edits the live messages whose shown text is out of date."""
+        text = self.render()
+        for chat_id, message_id in list(self._messages.items()):
+            await self._edit(chat_id, message_id, text)
+
+    async def _run(self) -> None:
+        while self._messages:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.update()
+            except RetryAfter as e:
+                await asyncio.sleep(e.timeout)
+            except Exception:
+                self.logger.exception("LIVE_DASHBOARD_UPDATE_FAILED")
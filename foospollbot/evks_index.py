@@ -0,0 +1,49 @@
+from typing import Iterable, Optional, Union
+from dataclasses import dataclass
+from datetime import date
+
+from models.entities import EvksPlayer
+from exceptions import EvksPlayerDoesNotExist
+
+
+@dataclass(frozen=True, slots=True)
+class EvksPlayerRecord:
+    id: int
+    first_name: str
+    last_name: str
+    foreigner: bool
+    last_competition_date: date
+    itsf_first_name: Optional[str] = None
+    itsf_last_name: Optional[str] = None
+    itsf_license: Optional[int] = None
+
+
+AnyEvksPlayer = Union[EvksPlayer, EvksPlayerRecord]
+
+
+class EvksPlayerIndex:
+    """Read-only in-memory copy of the evks_players table keyed by id.
+
+    The table only changes when the CSV is re-imported, so the index is
+    loaded on startup and reloaded on admin request.
+    """
+
+    def __init__(self) -> None:
+        self._players: dict[int, EvksPlayerRecord] = {}
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self._players)
+
+    def __contains__(self, evks_player_id: int) -> bool:
+        return evks_player_id in self._players
+
+    def load(self, players: Iterable[EvksPlayerRecord]) -> None:
+        self._players = {player.id: player for player in players}
+        self.loaded = True
+
+    def get(self, evks_player_id: int) -> EvksPlayerRecord:
+        try:
+            return self._players[evks_player_id]
+        except KeyError as e:
+            raise EvksPlayerDoesNotExist(evks_player_id=evks_player_id) from e
@@ -0,0 +1,231 @@
+from typing import Any, Optional
+import asyncio
+from collections import defaultdict
+import copy
+from aiogram.dispatcher.storage import BaseStorage
+from transitions import MachineError
+
+from models.entities import UserState
+from state_machine import UserStateMachine
+from storage import Storage
+from metrics import Histogram
+from logger import get_logger
+
+
+FSM_READ_BATCH_SIZE = Histogram(
+    "fsm_read_batch_size",
+    "Users whose state was loaded by one query",
+    buckets=(1, 2, 5, 10, 25, 50, 100),
+)
+FSM_WRITE_BATCH_SIZE = Histogram(
+    "fsm_write_batch_size",
+    "User states written by one flush",
+    buckets=(1, 2, 5, 10, 25, 50, 100),
+)
+
+
+class PostgresStateStorage(BaseStorage):
+    """aiogram FSM storage over ``user_infos.state``.
+
+    States are keyed by user, whatever the chat, and are the values of
+    ``UserState``; users without user info have no state. Reads are answered
+    from the storage state cache, otherwise the users asked for within
+    ``read_delay`` seconds are loaded with one query.
+
+    A state set here must be reachable from the current one by a state
+    machine transition, otherwise ``MachineError`` is raised. It is kept in
+    a write-behind buffer, written once it holds ``write_buffer_size`` users
+    or after ``flush_interval`` seconds, and on close, with one
+    ``Storage.transition_many`` per transition, so transition conditions are
+    checked and the tally is kept up to date. Writes the database rejects,
+    e.g. because the state was changed meanwhile, are dropped and logged.
+    Resetting the state keeps it: users with user info always have one.
+
+    Data is kept in memory only, the bot keeps everything it collects in
+    user info columns.
+    """
+
+    logger = get_logger()
+
+    def __init__(
+        self,
+        storage: Storage,
+        read_delay: float = 0.0,
+        write_buffer_size: int = 100,
+        flush_interval: float = 1.0,
+    ) -> None:
+        self.storage = storage
+        self.read_delay = read_delay
+        self.write_buffer_size = write_buffer_size
+        self.flush_interval = flush_interval
+        self._reads: dict[int, asyncio.Future[Optional[UserState]]] = {}
+        self._read_task: Optional[asyncio.Task] = None
+        # user -> (trigger, source state, destination state)
+        self._writes: dict[int, tuple[str, UserState, UserState]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self._data: dict[int, dict] = {}
+
+    @staticmethod
+    def _user_id(user: Any) -> Optional[int]:
+        return None if user is None else int(user)
+
+    async def _load(self) -> None:
+        if self.read_delay:
+            await asyncio.sleep(self.read_delay)
+        reads, self._reads = self._reads, {}
+        self._read_task = None
+        FSM_READ_BATCH_SIZE.observe(len(reads))
+        try:
+            async with self.storage.session() as session:
+                states = await self.storage.get_user_states(session, list(reads))
+        except Exception as e:
+            for future in reads.values():
+                future.set_exception(e)
+            return
+
+        for telegram_user_id, future in reads.items():
+            state = states.get(telegram_user_id)
+            if state is not None:
+                self.storage.cache_user_state(telegram_user_id, state)
+            future.set_result(state)
+
+    async def get_user_state(self, telegram_user_id: int) -> Optional[UserState]:
+        if write := self._writes.get(telegram_user_id):
+            return write[2]
+        if state := self.storage.get_cached_user_state(telegram_user_id):
+            return state
+
+        future = self._reads.get(telegram_user_id)
+        if future is None:
+            future = self._reads[telegram_user_id] = asyncio.Future()
+            if self._read_task is None:
+                self._read_task = asyncio.ensure_future(self._load())
+        # a cancelled reader must not cancel the shared load
+        return await asyncio.shield(future)
+
+    async def get_state(
+        self,
+        *,
+        chat: Any = None,
+        user: Any = None,
+        default: Optional[str] = None,
+    ) -> Optional[str]:
+        chat, user = self.check_address(chat=chat, user=user)
+        telegram_user_id = self._user_id(user)
+        if telegram_user_id is None:
+            return self.resolve_state(default)
+
+        state = await self.get_user_state(telegram_user_id)
+        if state is None:
+            return self.resolve_state(default)
+        return state.value
+
+    async def set_state(
+        self, *, chat: Any = None, user: Any = None, state: Optional[Any] = None
+    ) -> None:
+        chat, user = self.check_address(chat=chat, user=user)
+        state = self.resolve_state(state)
+        if state is None:
+            # user info and so its state are kept when a conversation ends
+            return
+
+        telegram_user_id = self._user_id(user)
+        if telegram_user_id in self._writes:
+            # one buffered write per user, each is a single transition
+            await self.flush()
+        dest = UserState(state)
+        source = await self.get_user_state(telegram_user_id)
+        if source == dest:
+            return
+        if source is None:
+            raise MachineError(f"User {telegram_user_id} has no user info")
+        trigger = UserStateMachine.find_trigger(source, dest)
+        if trigger is None:
+            raise MachineError(
+                f"Can't move from state {source.name} to state {dest.name}!"
+            )
+
+        self._writes[telegram_user_id] = (trigger, source, dest)
+        if len(self._writes) >= self.write_buffer_size:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        try:
+            await self.flush()
+        except Exception:
+            # the buffer is kept and written with the next flush
+            self.logger.exception("FSM_STATE_FLUSH_FAILED")
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._writes:
+                return
+            writes = dict(self._writes)
+            FSM_WRITE_BATCH_SIZE.observe(len(writes))
+            groups: dict[tuple[str, UserState], list[int]] = defaultdict(list)
+            for telegram_user_id, (trigger, source, _) in writes.items():
+                groups[trigger, source].append(telegram_user_id)
+
+            updated: set[int] = set()
+            async with self.storage.session() as session:
+                for (trigger, source), telegram_user_ids in groups.items():
+                    updated.update(
+                        await self.storage.transition_many(
+                            session, telegram_user_ids, trigger, from_state=source
+                        )
+                    )
+                await self.storage.commit(session)
+
+            for telegram_user_id, write in writes.items():
+                # newer states set while flushing stay buffered
+                if self._writes.get(telegram_user_id) is write:
+                    del self._writes[telegram_user_id]
+            if rejected := set(writes) - updated:
+                for telegram_user_id in rejected:
+                    self.storage.invalidate_user_state(telegram_user_id)
+                with self.logger:
+                    self.logger.context_push(telegram_user_ids=sorted(rejected))
+                    self.logger.warning("FSM_STATE_TRANSITIONS_REJECTED")
+
+    async def get_data(
+        self, *, chat: Any = None, user: Any = None, default: Optional[dict] = None
+    ) -> dict:
+        chat, user = self.check_address(chat=chat, user=user)
+        telegram_user_id = self._user_id(user)
+        return copy.deepcopy(self._data.get(telegram_user_id, default or {}))
+
+    async def set_data(
+        self, *, chat: Any = None, user: Any = None, data: Optional[dict] = None
+    ) -> None:
+        chat, user = self.check_address(chat=chat, user=user)
+        telegram_user_id = self._user_id(user)
+        if data:
+            self._data[telegram_user_id] = copy.deepcopy(data)
+        else:
+            self._data.pop(telegram_user_id, None)
+
+    async def update_data(
+        self,
+        *,
+        chat: Any = None,
+        user: Any = None,
+        data: Optional[dict] = None,
+        **kwargs: Any,
+    ) -> None:
+        current = await self.get_data(chat=chat, user=user)
+        current.update(data or {}, **kwargs)
+        await self.set_data(chat=chat, user=user, data=current)
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    async def wait_closed(self) -> None:
+        pass
@@ -0,0 +1,89 @@
+from typing import Any, Optional, Union
+import time
+from aiogram.bot import Bot
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.types import CallbackQuery, Message
+from aiogram.utils.exceptions import RetryAfter
+from aiohttp import web
+
+from metrics import CONTENT_TYPE, Counter, Histogram, render
+from tracing import span
+
+
+UPDATES_HANDLED = Counter("updates_handled_total", "Updates processed, by handler")
+HANDLER_LATENCY = Histogram(
+    "handler_latency_seconds", "Time spent in a handler, by handler"
+)
+HANDLER_ERRORS = Counter(
+    "handler_errors_total", "Exceptions reaching the errors handler, by type"
+)
+TELEGRAM_API_LATENCY = Histogram(
+    "telegram_api_latency_seconds", "Bot API request latency, by method"
+)
+TELEGRAM_API_RETRY_AFTER = Counter(
+    "telegram_api_retry_after_total", "Bot API flood control errors, by method"
+)
+
+# ctx_data keys, the handler is only known once its filters have passed
+_HANDLER = "metrics_handler"
+_STARTED = "metrics_started"
+
+
+class MetricsMiddleware(BaseMiddleware):
+    async def _on_process(self, data: dict[str, Any]) -> None:
+        data[_HANDLER] = current_handler.get().__name__
+        data[_STARTED] = time.perf_counter()
+
+    async def _on_post_process(self, data: dict[str, Any]) -> None:
+        if (handler := data.get(_HANDLER)) is None:
+            return
+        UPDATES_HANDLED.inc(handler=handler)
+        HANDLER_LATENCY.observe(time.perf_counter() - data[_STARTED], handler=handler)
+
+    async def on_process_message(self, message: Message, data: dict) -> None:
+        await self._on_process(data)
+
+    async def on_post_process_message(
+        self, message: Message, results: list, data: dict
+    ) -> None:
+        await self._on_post_process(data)
+
+    async def on_process_callback_query(
+        self, callback_query: CallbackQuery, data: dict
+    ) -> None:
+        await self._on_process(data)
+
+    async def on_post_process_callback_query(
+        self, callback_query: CallbackQuery, results: list, data: dict
+    ) -> None:
+        await self._on_post_process(data)
+
+
+class InstrumentedBot(Bot):
+    """Bot recording the latency and flood control errors of API requests.
+
+    Requests are also traced, which covers send_message, send_photo and
+    every other API method.
+    """
+
+    async def request(
+        self,
+        method: str,
+        data: Optional[dict] = None,
+        files: Optional[dict] = None,
+        **kwargs: Any,
+    ) -> Union[list, dict, bool]:
+        started = time.perf_counter()
+        try:
+            with span(f"Bot.{method}"):
+                return await super().request(method, data, files, **kwargs)
+        except RetryAfter:
+            TELEGRAM_API_RETRY_AFTER.inc(method=method)
+            raise
+        finally:
+            TELEGRAM_API_LATENCY.observe(time.perf_counter() - started, method=method)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=render().encode(), headers={"Content-Type": CONTENT_TYPE})
@@ -1,24 +1,44 @@
-from typing import Any
+from typing import Any, Optional
+from contextvars import ContextVar
+from datetime import datetime, timezone
+import atexit
+import json
 import logging
+import queue
+import threading
+from logging.handlers import BufferingHandler, QueueHandler, QueueListener
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
+from pymongo import MongoClient
 from settings import settings
+from metrics import Counter
 
 
 LOGGER_NAME = "app"
 
+LOG_RECORDS_DROPPED = Counter(
+    "log_records_dropped_total", "Log records dropped because the queue was full"
+)
+
+
+# Each asyncio task sees its own copy of these, and the context dicts are
+# never mutated, so concurrently running handlers can't see each other's
+# context.
+_log_context: ContextVar[dict[str, Any]] = ContextVar("log_context", default={})
+_saved_log_contexts: ContextVar[tuple[dict[str, Any], ...]] = ContextVar(
+    "saved_log_contexts", default=()
+)
+
 
 class ContextLoggerAdapter(logging.LoggerAdapter):
     def __init__(self, logger: logging.Logger) -> None:
         super().__init__(logger, {})
         self._logger = logger
-        self._context_stack: list[dict[str, Any]] = [{}]
 
     def _get_context(self) -> dict[str, Any]:
-        return self._context_stack[-1]
+        return _log_context.get()
 
     def context_push(self, **kwargs: Any):
-        context = self._get_context()
-        context |= kwargs
+        _log_context.set({**_log_context.get(), **kwargs})
 
     def process(self, msg, kwargs):  # type: ignore
         extra = kwargs.setdefault("extra", {})
@@ -26,30 +46,121 @@ class ContextLoggerAdapter(logging.LoggerAdapter):
         return msg, kwargs
 
     def __enter__(self) -> None:
-        new_context = {**self._get_context()}
-        self._context_stack.append(new_context)
+        _saved_log_contexts.set(_saved_log_contexts.get() + (_log_context.get(),))
 
     def __exit__(self, exc_type, exc_value, traceback):  # type: ignore
-        self._context_stack.pop()
-
-
-def setup_logger():
+        *saved, context = _saved_log_contexts.get()
+        _saved_log_contexts.set(tuple(saved))
+        _log_context.set(context)
+
+
+def record_to_dict(record: logging.LogRecord) -> dict[str, Any]:
+    return {
+        "timestamp": datetime.fromtimestamp(record.created, timezone.utc),
+        "level": record.levelname,
+        "module": record.module,
+        "message": record.getMessage(),
+        "context": getattr(record, "context", {}),
+    }
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(record_to_dict(record), ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Hands records over to a bounded queue without ever blocking.
+
+    When the queue is full the record is dropped and counted, so a slow
+    sink can't stall the event loop.
+    """
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+class MongoBatchHandler(BufferingHandler):
+    """Writes records to Mongo with one insert_many per batch.
+
+    Meant to run behind a QueueListener: the batch is flushed from the
+    listener thread when it is full, and by a timer started with the first
+    buffered record once it is ``flush_interval`` seconds old, so a quiet
+    log doesn't keep records in memory.
+    """
+
+    def __init__(
+        self, collection: Any, batch_size: int, flush_interval: float
+    ) -> None:
+        super().__init__(capacity=batch_size)
+        self.collection = collection
+        self.flush_interval = flush_interval
+        self._timer: Optional[threading.Timer] = None
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if self._timer is None:
+            self._timer = threading.Timer(self.flush_interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+        super().emit(record)
+
+    def flush(self) -> None:
+        with self.lock:
+            buffer, self.buffer = self.buffer, []
+            timer, self._timer = self._timer, None
+        if timer is not None and timer is not threading.current_thread():
+            timer.cancel()
+        if not buffer:
+            return
+        try:
+            self.collection.insert_many(
+                [record_to_dict(record) for record in buffer], ordered=False
+            )
+        except Exception:
+            self.handleError(buffer[-1])
+
+
+def setup_logger() -> QueueListener:
+    """Routes the app logger through a bounded queue to the sinks.
+
+    Records are formatted and written by a QueueListener thread, the
+    logging call itself only enqueues the record.
+    """
     stream_handler = logging.StreamHandler()
-    formatter = logging.Formatter(
-        fmt="%(asctime)s - %(levelname)s - %(module)s - %(message)s - %(context)s"
-    )
-    stream_handler.setFormatter(formatter)
-
-    # mongo_handler = MongoHandler(
-    #    host=settings["mongo_logs"]["host"],
-    #    port=settings["mongo_logs"]["port"],
-    # )
+    stream_handler.setFormatter(JsonFormatter())
+    handlers: list[logging.Handler] = [stream_handler]
+
+    mongo_settings = settings["mongo_logs"]
+    if mongo_settings["enabled"]:
+        client = MongoClient(
+            host=mongo_settings["host"],
+            port=mongo_settings["port"],
+            username=mongo_settings["user"],
+            password=mongo_settings["password"],
+        )
+        handlers.append(
+            MongoBatchHandler(
+                collection=client[mongo_settings["database"]][
+                    mongo_settings["collection"]
+                ],
+                batch_size=mongo_settings["batch_size"],
+                flush_interval=mongo_settings["flush_interval"],
+            )
+        )
+
+    log_queue: queue.Queue = queue.Queue(maxsize=settings["log_queue_size"])
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
 
     level = logging.getLevelName(settings["log_level"])
     logger = logging.getLogger(LOGGER_NAME)
     logger.setLevel(level)
-    logger.addHandler(stream_handler)
-    # logger.addHandler(mongo_handler)
+    logger.addHandler(DroppingQueueHandler(log_queue))
+    return listener
 
 
 def get_logger() -> ContextLoggerAdapter:
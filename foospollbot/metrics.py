@@ -0,0 +1,144 @@
+from typing import Iterable
+from collections import defaultdict
+import bisect
+
+
+LabelValues = tuple[tuple[str, str], ...]
+Sample = tuple[str, LabelValues, float]
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: list["Metric"] = []
+
+    def register(self, metric: "Metric") -> None:
+        self.metrics.append(metric)
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, registry: Registry = REGISTRY
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        registry.register(self)
+
+    @staticmethod
+    def _key(labels: dict[str, object]) -> LabelValues:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def collect(self) -> Iterable[Sample]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(
+        self, name: str, documentation: str, registry: Registry = REGISTRY
+    ) -> None:
+        super().__init__(name, documentation, registry)
+        self._values: dict[LabelValues, float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels: object) -> None:
+        self._values[self._key(labels)] += amount
+
+    def value(self, **labels: object) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def collect(self) -> Iterable[Sample]:
+        for key, value in self._values.items():
+            yield self.name, key, value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount: float = 1, **labels: object) -> None:
+        self._values[self._key(labels)] -= amount
+
+    def set(self, value: float, **labels: object) -> None:
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        registry: Registry = REGISTRY,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, registry)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: dict[LabelValues, list[int]] = {}
+        self._sums: dict[LabelValues, float] = defaultdict(float)
+
+    def observe(self, value: float, **labels: object) -> None:
+        key = self._key(labels)
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+    def count(self, **labels: object) -> int:
+        return sum(self._counts.get(self._key(labels), ()))
+
+    def sum(self, **labels: object) -> float:
+        return self._sums.get(self._key(labels), 0.0)
+
+    def collect(self) -> Iterable[Sample]:
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield f"{self.name}_bucket", key + (("le", le),), cumulative
+            yield f"{self.name}_sum", key, self._sums[key]
+            yield f"{self.name}_count", key, cumulative
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if value == float("-inf"):
+        return "-Inf"
+    return repr(float(value))
+
+
+def _format_labels(labels: LabelValues) -> str:
+    if not labels:
+        return ""
+    pairs = (
+        '{}="{}"'.format(
+            key,
+            value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for key, value in labels
+    )
+    return "{" + ",".join(pairs) + "}"
+
+
+def render(registry: Registry = REGISTRY) -> str:
+    """Prometheus text exposition of all metrics in the registry."""
+    lines = []
+    for metric in registry.metrics:
+        documentation = metric.documentation.replace("\\", "\\\\").replace("\n", "\\n")
+        lines.append(f"# HELP {metric.name} {documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, labels, value in metric.collect():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
@@ -43,6 +43,9 @@ class UserInfo:
     rtsf_url: Optional[str] = None
     evks_player_id: Optional[int] = None
     photo_id: Optional[UUID] = None
+    photo_file_id: Optional[str] = None
+    photo_digest: Optional[str] = None
+    photo_archive_failures: int = 0
 
     created: Optional[datetime] = field(init=False)
     updated: Optional[datetime] = field(init=False)
@@ -70,3 +73,22 @@ class VoteResult:
     secret_code: str
 
     created: Optional[datetime] = field(init=False)
+
+
+@unique
+class PollDispatchStatus(Enum):
+    PENDING = "pending"
+    SENT = "sent"
+    FAILED = "failed"
+
+
+@dataclass
+class PollDispatch:
+    id: int
+    telegram_user_id: int
+    status: PollDispatchStatus
+    attempts: int = 0
+    last_error: Optional[str] = None
+
+    created: Optional[datetime] = field(init=False)
+    updated: Optional[datetime] = field(init=False)
@@ -5,6 +5,7 @@ from models.tables import (
     user_infos,
     vote_options,
     vote_results,
+    poll_dispatches,
 )
 from models.entities import (
     TelegramUser,
@@ -12,6 +13,7 @@ from models.entities import (
     UserInfo,
     VoteOption,
     VoteResult,
+    PollDispatch,
 )
 
 
@@ -26,3 +28,5 @@ mapper_registry.map_imperatively(UserInfo, user_infos)
 mapper_registry.map_imperatively(VoteOption, vote_options)
 
 mapper_registry.map_imperatively(VoteResult, vote_results)
+
+mapper_registry.map_imperatively(PollDispatch, poll_dispatches)
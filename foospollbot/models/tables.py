@@ -1,7 +1,7 @@
 import sqlalchemy as sa
 from sqlalchemy.sql import func
 from sqlalchemy.dialects.postgresql import UUID
-from models.entities import UserState
+from models.entities import PollDispatchStatus, UserState
 
 
 metadata_obj = sa.MetaData()
@@ -44,6 +44,11 @@ user_infos = sa.Table(
     sa.Column("rtsf_url", sa.String, nullable=True),
     sa.Column("evks_player_id", sa.Integer, sa.ForeignKey("evks_players.id")),
     sa.Column("photo_id", UUID(as_uuid=True), nullable=True),
+    sa.Column("photo_file_id", sa.String, nullable=True),
+    sa.Column("photo_digest", sa.String, nullable=True),
+    sa.Column(
+        "photo_archive_failures", sa.Integer, nullable=False, server_default="0"
+    ),
     sa.Column("state", sa.Enum(UserState)),
     sa.Column("created", sa.DateTime, server_default=func.now()),
     sa.Column("updated", sa.DateTime, onupdate=func.now()),
@@ -56,10 +61,13 @@ vote_options = sa.Table(
     sa.Column("text", sa.Text, unique=True),
 )
 
+# secret codes are derived from ids reserved ahead, see secret_codes
+vote_results_id_seq = sa.Sequence("vote_results_id_seq", metadata=metadata_obj)
+
 vote_results = sa.Table(
     "vote_results",
     metadata_obj,
-    sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+    sa.Column("id", sa.Integer, vote_results_id_seq, primary_key=True),
     sa.Column(
         "telegram_user_id", sa.BigInteger, sa.ForeignKey("telegram_users.id"), unique=True
     ),
@@ -67,3 +75,20 @@ vote_results = sa.Table(
     sa.Column("secret_code", sa.String, unique=True),
     sa.Column("created", sa.DateTime, server_default=func.now()),
 )
+
+poll_dispatches = sa.Table(
+    "poll_dispatches",
+    metadata_obj,
+    sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+    sa.Column(
+        "telegram_user_id",
+        sa.BigInteger,
+        sa.ForeignKey("telegram_users.id"),
+        unique=True,
+    ),
+    sa.Column("status", sa.Enum(PollDispatchStatus)),
+    sa.Column("attempts", sa.Integer, server_default="0"),
+    sa.Column("last_error", sa.Text, nullable=True),
+    sa.Column("created", sa.DateTime, server_default=func.now()),
+    sa.Column("updated", sa.DateTime, onupdate=func.now()),
+)
@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import io
+import os
+import pathlib
+from aiogram.bot import Bot
+
+from storage import Storage
+from logger import get_logger
+
+
+def store_photo(directory: pathlib.Path, data: bytes) -> str:
+    """Writes the photo under its sha256 digest unless it is already there.
+
+    The file is written to a temporary name and renamed, so a partially
+    written photo is never visible under its digest.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    path = directory / f"{digest}.jpg"
+    if not path.exists():
+        tmp_path = directory / f".{digest}.{os.getpid()}.tmp"
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    return digest
+
+
+class PhotoArchive:
+    """Downloads submitted photos to disk in the background.
+
+    Photos are queued by their Telegram file_id and archived by a fixed
+    number of workers. Hashing and writing run in the default executor.
+    A failed photo is retried ``max_attempts`` times with exponential
+    backoff. The queue holds ``queue_size`` photos, the ones that didn't
+    fit or kept failing are found by a scan of the photos that weren't
+    archived, run on start and every ``rescan_interval`` seconds. Failures
+    are counted per photo and the scan takes the least failed ones first,
+    so photos that always fail don't hold back the rest. Photos
+    submitted before start, e.g. in worker processes that don't run the
+    archive, are left to that scan as well.
+    """
+
+    logger = get_logger()
+
+    def __init__(
+        self,
+        bot: Bot,
+        storage: Storage,
+        directory: str,
+        concurrency: int,
+        queue_size: int,
+        max_attempts: int,
+        retry_backoff: float,
+        rescan_interval: float,
+    ) -> None:
+        self.bot = bot
+        self.storage = storage
+        self.directory = pathlib.Path(directory)
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.rescan_interval = rescan_interval
+        self._queue: asyncio.Queue[tuple[int, str]] = asyncio.Queue(queue_size)
+        # users whose photo is queued or being archived
+        self._queued: set[int] = set()
+        self._tasks: list[asyncio.Task] = []
+
+    async def start(self) -> None:
+        self._tasks = [
+            asyncio.ensure_future(self._worker()) for _ in range(self.concurrency)
+        ]
+        self._tasks.append(asyncio.ensure_future(self._rescan()))
+
+    def submit(self, telegram_user_id: int, file_id: str) -> None:
+        if not self._tasks:
+            return
+        if telegram_user_id in self._queued or self._queue.full():
+            return
+        self._queue.put_nowait((telegram_user_id, file_id))
+        self._queued.add(telegram_user_id)
+
+    async def _rescan(self) -> None:
+        while True:
+            try:
+                async with self.storage.session() as session:
+                    pending = await self.storage.get_unarchived_photos(
+                        session, limit=self._queue.maxsize
+                    )
+            except Exception:
+                self.logger.exception("PHOTO_ARCHIVE_RESCAN_FAILED")
+            else:
+                for telegram_user_id, file_id in pending:
+                    self.submit(telegram_user_id, file_id)
+            await asyncio.sleep(self.rescan_interval)
+
+    async def _archive(self, telegram_user_id: int, file_id: str) -> str:
+        buffer: io.BytesIO = await self.bot.download_file_by_id(
+            file_id, destination=io.BytesIO()
+        )
+        digest = await asyncio.get_running_loop().run_in_executor(
+            None, store_photo, self.directory, buffer.getvalue()
+        )
+
+        async with self.storage.session() as session:
+            await self.storage.set_photo_digest(session, telegram_user_id, digest)
+            await self.storage.commit(session)
+        return digest
+
+    async def _record_failure(self, telegram_user_id: int) -> None:
+        async with self.storage.session() as session:
+            await self.storage.add_photo_archive_failure(session, telegram_user_id)
+            await self.storage.commit(session)
+
+    async def _archive_with_retries(self, telegram_user_id: int, file_id: str) -> str:
+        for attempt in range(self.max_attempts):
+            try:
+                return await self._archive(telegram_user_id, file_id)
+            except Exception:
+                if attempt + 1 == self.max_attempts:
+                    raise
+                self.logger.warning("PHOTO_ARCHIVE_RETRY", exc_info=True)
+                await asyncio.sleep(self.retry_backoff * 2**attempt)
+
+    async def _worker(self) -> None:
+        while True:
+            telegram_user_id, file_id = await self._queue.get()
+            with self.logger:
+                self.logger.context_push(telegram_user_id=telegram_user_id)
+                try:
+                    digest = await self._archive_with_retries(
+                        telegram_user_id, file_id
+                    )
+                except Exception:
+                    # left to the next rescan
+                    self.logger.exception("PHOTO_ARCHIVE_FAILED")
+                    try:
+                        await self._record_failure(telegram_user_id)
+                    except Exception:
+                        self.logger.exception("PHOTO_ARCHIVE_FAILURE_NOT_RECORDED")
+                else:
+                    self.logger.context_push(photo_digest=digest)
+                    self.logger.info("PHOTO_ARCHIVED")
+                finally:
+                    self._queued.discard(telegram_user_id)
+                    self._queue.task_done()
@@ -1,94 +1,306 @@
-from typing import ClassVar, Sequence
-from dataclasses import dataclass
+from typing import Any, AsyncIterator, ClassVar, Optional, Sequence
+from dataclasses import dataclass, field
 import asyncio
+import time
 from aiogram.bot import Bot
+from aiogram.bot.api import Methods
 from aiogram.utils.callback_data import CallbackData
+from aiogram.utils.exceptions import NetworkError, RetryAfter
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.utils.payload import prepare_arg
 
-from models.entities import VoteOption
-from state_machine import UserStateMachine
+from models.entities import PollDispatchStatus, UserState, VoteOption
 from storage import Storage
+from rate_limit import TokenBucket
 from logger import get_logger
+from metrics import Counter, Gauge
 
 
-@dataclass(frozen=True)
-class Poll:
-    telegram_user_id: int
-    options: tuple[VoteOption]
+POLLS_DISPATCHED = Counter("polls_dispatched_total", "Polls processed, by status")
+POLLS_REMAINING = Gauge("polls_remaining", "Polls left in the current campaign")
+
+
+@dataclass
+class SendingProgress:
+    total: int
+    sent: int = 0
+    failed: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    @property
+    def remaining(self) -> int:
+        return self.total - self.sent - self.failed
+
+    def eta(self) -> Optional[float]:
+        done = self.sent + self.failed
+        if not done:
+            return None
+        return (time.monotonic() - self.started) / done * self.remaining
+
+    def format(self) -> str:
+        text = (
+            f"Отправлено: {self.sent}, ошибок: {self.failed}, "
+            f"осталось: {self.remaining}"
+        )
+        if (eta := self.eta()) is not None and self.remaining:
+            minutes, seconds = divmod(int(eta), 60)
+            text += f", ETA: {minutes}:{seconds:02d}"
+        return text
 
 
 VoteOptionCallback = CallbackData("VOTE_OPTION", "option_id")
 
 
+def build_poll_payload(options: tuple[VoteOption]) -> dict[str, Any]:
+    """sendMessage arguments shared by every poll of a campaign.
+
+    The keyboard is serialized here once, so sending a poll only has to add
+    the chat id.
+    """
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [
+                InlineKeyboardButton(
+                    text=option.text,
+                    callback_data=VoteOptionCallback.new(option_id=option.id),
+                )
+            ]
+            for option in options
+        ]
+    )
+    return {
+        "text": (
+            "Пришло время проголосовать. К этому сообщению "
+            "прикреплены кнопки с именами кандидатов. "
+            "Внимательно и аккуратно нажмите на кандидата, "
+            "за которого вы хотите отдать свой голос. "
+            "Возможности переголосовать не будет."
+        ),
+        "reply_markup": prepare_arg(keyboard),
+    }
+
+
 class AbstractPollSender:
     bot: ClassVar[Bot]
     storage: ClassVar[Storage]
     logger = get_logger()
 
-    CONCURRENT_POLLS = 3
+    admin_chat_id: ClassVar[Optional[int]] = None
 
-    def __init__(self, user_ids: Sequence[int], options: tuple[VoteOption]) -> None:
-        self.polls = tuple(
-            Poll(telegram_user_id=uid, options=options) for uid in user_ids
-        )
-        self._sem = asyncio.Semaphore(self.CONCURRENT_POLLS)
-
-    async def _send_poll(self, poll: Poll) -> None:
-        async with self._sem:
-            with self.logger:
-                self.logger.context_push(telegram_user_id=poll.telegram_user_id)
-                self.logger.info("SENDING_POLL")
-
-                try:
-                    inline_keyboard: list[list[InlineKeyboardButton]] = []
-                    for option in poll.options:
-                        inline_keyboard.append(
-                            [
-                                InlineKeyboardButton(
-                                    text=option.text,
-                                    callback_data=VoteOptionCallback.new(
-                                        option_id=option.id
-                                    ),
-                                )
-                            ]
-                        )
-                    keyboard = InlineKeyboardMarkup(inline_keyboard=inline_keyboard)
-
-                    async with self.storage.session() as session:
-                        user_info = await self.storage.get_user_info(
-                            session=session,
-                            telegram_user_id=poll.telegram_user_id,
-                            for_update=True,
-                        )
-                        user_sm = UserStateMachine(user_info.state)
-                        user_sm.start_vote(user_info)
-                        user_info.state = user_sm.state
-                        session.add(user_info)
-                        await session.commit()
-
-                    self.logger.info("UPDATED_USER_STATE")
-
-                    await self.bot.send_message(
-                        chat_id=poll.telegram_user_id,
-                        text=(
-                            "Пришло время проголосовать. К этому сообщению "
-                            "прикреплены кнопки с именами кандидатов. "
-                            "Внимательно и аккуратно нажмите на кандидата, "
-                            "за которого вы хотите отдать свой голос. "
-                            "Возможности переголосовать не будет."
-                        ),
-                        reply_markup=keyboard,
-                    )
-
-                    self.logger.info("FINISH_SENDING_POLL")
-                except:  # noqa: E722
-                    self.logger.exception("SENDING_POLL_FAILED")
+    CONCURRENT_POLLS = 10
+    CHUNK_SIZE = 500
+    RESULTS_BATCH_SIZE = 50
+    RESULTS_INTERVAL = 1.0
+    MESSAGES_PER_SECOND = 25.0
+    MAX_RETRIES = 3
+    RETRY_BACKOFF = 1.0
+    PROGRESS_INTERVAL = 30.0
+
+    def __init__(self, options: tuple[VoteOption], total: int) -> None:
+        self._payload = build_poll_payload(options)
+        self.progress = SendingProgress(total=total)
+        POLLS_REMAINING.set(total)
+        self._bucket = TokenBucket(rate=self.MESSAGES_PER_SECOND)
+        self._results: dict[PollDispatchStatus, dict[int, Optional[str]]] = {}
+
+    async def _send_message(self, telegram_user_id: int) -> None:
+        attempt = 0
+        while True:
+            await self._bucket.acquire()
+            try:
+                # raw request: the payload is prepared and the response is unused
+                await self.bot.request(
+                    Methods.SEND_MESSAGE,
+                    {"chat_id": telegram_user_id, **self._payload},
+                )
+                return
+            except RetryAfter as e:
+                self.logger.context_push(retry_after=e.timeout)
+                self.logger.warning("SENDING_POLL_RETRY_AFTER")
+                self._bucket.pause(e.timeout)
+            except (NetworkError, asyncio.TimeoutError):
+                attempt += 1
+                if attempt > self.MAX_RETRIES:
                     raise
+                self.logger.warning("SENDING_POLL_NETWORK_ERROR", exc_info=True)
+                await asyncio.sleep(self.RETRY_BACKOFF * 2 ** (attempt - 1))
+
+    async def _send_poll(self, telegram_user_id: int) -> None:
+        with self.logger:
+            self.logger.context_push(telegram_user_id=telegram_user_id)
+            self.logger.info("SENDING_POLL")
+
+            try:
+                await self._send_message(telegram_user_id)
+            except Exception as e:
+                self.logger.exception("SENDING_POLL_FAILED")
+                await self._record(telegram_user_id, PollDispatchStatus.FAILED, repr(e))
+                return
+
+            await self._record(telegram_user_id, PollDispatchStatus.SENT)
+            self.logger.info("FINISH_SENDING_POLL")
+
+    async def _start_vote(self, user_ids: Sequence[int]) -> list[int]:
+        """Moves a chunk of recipients to VOTING in a single transaction.
 
-                await asyncio.sleep(2)  # sleep 2 seconds after completing poll sending
+        Returns the users switched now and the users left in VOTING by an
+        interrupted run, other users are marked failed.
+        """
+        async with self.storage.session() as session:
+            switched = await self.storage.transition_many(
+                session, user_ids, trigger="start_vote"
+            )
+            states = await self.storage.get_user_states(session, user_ids)
+            await self.storage.commit(session)
 
-    async def send(self) -> None:
-        tasks = [asyncio.ensure_future(self._send_poll(poll)) for poll in self.polls]
+        with self.logger:
+            self.logger.context_push(chunk=len(user_ids), switched=len(switched))
+            self.logger.info("UPDATED_USER_STATES")
+
+        recipients: list[int] = []
+        for telegram_user_id in user_ids:
+            state = states.get(telegram_user_id)
+            if state == UserState.VOTING:
+                self.storage.cache_user_state(telegram_user_id, state)
+                recipients.append(telegram_user_id)
+                continue
+
+            await self._record(
+                telegram_user_id,
+                PollDispatchStatus.FAILED,
+                f"Unexpected user state {state}",
+            )
+        return recipients
+
+    def _count(self, status: PollDispatchStatus) -> None:
+        if status == PollDispatchStatus.SENT:
+            self.progress.sent += 1
+        else:
+            self.progress.failed += 1
+        POLLS_DISPATCHED.inc(status=status.value)
+        POLLS_REMAINING.set(self.progress.remaining)
+
+    async def _record(
+        self,
+        telegram_user_id: int,
+        status: PollDispatchStatus,
+        error: Optional[str] = None,
+    ) -> None:
+        """Counts the outcome, statuses are written in small batches.
+
+        Batches are bounded by ``RESULTS_BATCH_SIZE`` and ``RESULTS_INTERVAL``:
+        polls sent but not written when the process dies are sent again on
+        resume.
+        """
+        self._count(status)
+        self._results.setdefault(status, {})[telegram_user_id] = error
+        if sum(map(len, self._results.values())) >= self.RESULTS_BATCH_SIZE:
+            await self._write_results()
+
+    async def _write_results(self) -> None:
+        """Writes collected statuses in one transaction, one UPDATE per status.
+
+        Statuses that failed to be written are kept for the next write.
+        """
+        results, self._results = self._results, {}
+        if not results:
+            return
+        try:
+            async with self.storage.session() as session:
+                for status, errors in results.items():
+                    await self.storage.update_poll_dispatches(session, status, errors)
+                await session.commit()
+        except BaseException:
+            for status, errors in results.items():
+                self._results.setdefault(status, {}).update(errors)
+            raise
+
+    async def _write_results_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.RESULTS_INTERVAL)
+            try:
+                await self._write_results()
+            except Exception:
+                self.logger.exception("POLL_DISPATCHES_UPDATE_FAILED")
+
+    async def _report_progress(self) -> None:
+        while True:
+            await asyncio.sleep(self.PROGRESS_INTERVAL)
+            self.logger.info("POLLS_SENDING_PROGRESS")
+            if self.admin_chat_id is None:
+                continue
+            try:
+                await self.bot.send_message(
+                    chat_id=self.admin_chat_id, text=self.progress.format()
+                )
+            except Exception:
+                self.logger.exception("SENDING_PROGRESS_FAILED")
+
+    async def _worker(self, queue: asyncio.Queue[Optional[int]]) -> None:
+        while (telegram_user_id := await queue.get()) is not None:
+            try:
+                await self._send_poll(telegram_user_id)
+            except Exception:
+                # the dispatch stays undelivered and is picked up on resume
+                with self.logger:
+                    self.logger.context_push(telegram_user_id=telegram_user_id)
+                    self.logger.exception("SENDING_POLL_CRASHED")
+
+    @staticmethod
+    async def _put(
+        queue: asyncio.Queue[Optional[int]],
+        item: Optional[int],
+        workers: Sequence[asyncio.Task],
+    ) -> None:
+        """Waits for room in the queue, raises if the workers die meanwhile."""
+        if not queue.full():
+            queue.put_nowait(item)
+            return
+
+        put = asyncio.ensure_future(queue.put(item))
+        try:
+            while running := [worker for worker in workers if not worker.done()]:
+                await asyncio.wait(
+                    (put, *running), return_when=asyncio.FIRST_COMPLETED
+                )
+                if put.done():
+                    return
+                for worker in running:
+                    if worker.done():
+                        # raises what the worker died of
+                        worker.result()
+            raise RuntimeError("Poll sending workers stopped")
+        finally:
+            put.cancel()
+
+    async def send(self, user_id_chunks: AsyncIterator[Sequence[int]]) -> None:
+        """Sends polls to recipients streamed in chunks.
+
+        A fixed pool of workers sends the polls, the bounded queue between
+        them and the recipients stream keeps memory flat.
+        """
         self.logger.info("STARTING_POLLS_SENDING_PROCESS")
-        await asyncio.gather(*tasks, return_exceptions=True)
+        queue: asyncio.Queue[Optional[int]] = asyncio.Queue(
+            maxsize=self.CONCURRENT_POLLS
+        )
+        workers = [
+            asyncio.ensure_future(self._worker(queue))
+            for _ in range(self.CONCURRENT_POLLS)
+        ]
+        reporter = asyncio.ensure_future(self._report_progress())
+        writer = asyncio.ensure_future(self._write_results_periodically())
+        try:
+            async for user_ids in user_id_chunks:
+                for telegram_user_id in await self._start_vote(user_ids):
+                    await self._put(queue, telegram_user_id, workers)
+
+            for _ in workers:
+                await self._put(queue, None, workers)
+            await asyncio.gather(*workers)
+        finally:
+            reporter.cancel()
+            writer.cancel()
+            for worker in workers:
+                worker.cancel()
+            await self._write_results()
         self.logger.info("FINISHED_POLLS_SENDING_PROCESS")
@@ -0,0 +1,142 @@
+from typing import Any, Optional
+import asyncio
+from aiogram.dispatcher import Dispatcher
+from aiogram.types import Update
+
+from logger import get_logger
+
+
+# update fields carrying the user the update comes from
+_USER_EVENTS = (
+    "message",
+    "edited_message",
+    "callback_query",
+    "inline_query",
+    "chosen_inline_result",
+    "my_chat_member",
+    "chat_member",
+    "chat_join_request",
+)
+
+
+def ordering_key(update: Update) -> int:
+    """Updates with the same key are processed one at a time, in order."""
+    for name in _USER_EVENTS:
+        event = getattr(update, name)
+        if event is not None and event.from_user is not None:
+            return event.from_user.id
+    return update.update_id
+
+
+def raw_ordering_key(update: dict[str, Any]) -> int:
+    """``ordering_key`` of an update that wasn't parsed into ``Update``."""
+    for name in _USER_EVENTS:
+        event = update.get(name)
+        if event is not None and "from" in event:
+            return event["from"]["id"]
+    return update["update_id"]
+
+
+class UpdatePoller:
+    """Long polling with the updates of each user processed in order.
+
+    Every update gets a task that first waits for the previous update with
+    the same ordering key, so the updates of one user are handled in order
+    while different users are handled concurrently, and a slow update only
+    holds up its own user. Once ``max_pending`` updates are fetched but not
+    processed, polling waits for them to catch up.
+
+    On stop the pending long poll is abandoned and the fetched updates are
+    processed before ``run`` returns. Telegram only forgets updates once a
+    later getUpdates call confirms them, so updates fetched but not yet
+    processed are delivered again after a crash.
+    """
+
+    logger = get_logger()
+
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        max_pending: int,
+        timeout: int,
+        retry_interval: float = 1.0,
+    ) -> None:
+        self.dispatcher = dispatcher
+        self.bot = dispatcher.bot
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self._stopping = asyncio.Event()
+        self._pending = asyncio.Semaphore(max_pending)
+        # the task of the last update fetched per ordering key
+        self._chains: dict[int, asyncio.Task] = {}
+
+    def stop(self) -> None:
+        self._stopping.set()
+
+    async def _get_updates(self, offset: Optional[int]) -> Optional[list[Update]]:
+        """Next batch of updates, None once stopped."""
+        stopping = asyncio.ensure_future(self._stopping.wait())
+        fetch = asyncio.ensure_future(
+            self.bot.get_updates(offset=offset, timeout=self.timeout)
+        )
+        await asyncio.wait((stopping, fetch), return_when=asyncio.FIRST_COMPLETED)
+        stopping.cancel()
+        if not fetch.done():
+            fetch.cancel()
+            return None
+        return fetch.result()
+
+    async def _process(self, update: Update) -> None:
+        try:
+            # unlike process_update, runs the update-level middlewares
+            await self.dispatcher.process_updates([update])
+        except Exception:
+            with self.logger:
+                self.logger.context_push(update_id=update.update_id)
+                self.logger.exception("UPDATE_PROCESSING_FAILED")
+
+    async def _process_after(
+        self, key: int, previous: Optional[asyncio.Task], update: Update
+    ) -> None:
+        try:
+            if previous is not None:
+                await asyncio.wait((previous,))
+            await self._process(update)
+        finally:
+            self._pending.release()
+            if self._chains.get(key) is asyncio.current_task():
+                del self._chains[key]
+
+    async def _schedule(self, update: Update) -> None:
+        await self._pending.acquire()
+        key = ordering_key(update)
+        self._chains[key] = asyncio.ensure_future(
+            self._process_after(key, self._chains.get(key), update)
+        )
+
+    async def run(self) -> None:
+        self.logger.info("STARTING_POLLING")
+        offset: Optional[int] = None
+        try:
+            while not self._stopping.is_set():
+                try:
+                    updates = await self._get_updates(offset)
+                except Exception:
+                    self.logger.exception("GET_UPDATES_FAILED")
+                    await asyncio.sleep(self.retry_interval)
+                    continue
+
+                for update in updates or ():
+                    await self._schedule(update)
+                    offset = update.update_id + 1
+        finally:
+            self.logger.info("DRAINING_UPDATES")
+            # the last task of a key finishes after the earlier ones
+            while self._chains:
+                await asyncio.wait(list(self._chains.values()))
+
+        if offset is not None:
+            # confirms the processed updates
+            await self.bot.get_updates(offset=offset, limit=1, timeout=0)
+        self.logger.info("STOPPED_POLLING")
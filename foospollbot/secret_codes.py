@@ -0,0 +1,66 @@
+from collections import deque
+import hashlib
+import hmac
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from storage import Storage
+
+
+# Crockford's base32, without the easily confused I, L, O and U
+ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+CODE_LENGTH = 8
+# 5 bits per character
+_HALF_BITS = CODE_LENGTH * 5 // 2
+_HALF_MASK = (1 << _HALF_BITS) - 1
+_ROUNDS = 8
+
+
+class SecretCodes:
+    """Secret codes of vote results, unique by construction.
+
+    A code is a keyed permutation of the vote result id: a Feistel network
+    over 40 bits with HMAC-SHA256 rounds, written in base32. Distinct ids
+    give distinct codes, so inserting a vote result never conflicts on the
+    secret code, and without the key codes can't be told from random ones.
+    The key must stay the same for the whole election, codes from different
+    keys may repeat.
+
+    Ids are reserved from the vote_results sequence ``batch_size`` at a time,
+    so most votes take their id and code without a query.
+    """
+
+    def __init__(self, key: str, storage: Storage, batch_size: int) -> None:
+        self.key = key.encode()
+        self.storage = storage
+        self.batch_size = batch_size
+        self._ids: deque[int] = deque()
+
+    def _round(self, index: int, half: int) -> int:
+        digest = hmac.new(
+            self.key, bytes((index,)) + half.to_bytes(3, "big"), hashlib.sha256
+        ).digest()
+        return int.from_bytes(digest[:3], "big") & _HALF_MASK
+
+    def code(self, number: int) -> str:
+        if not 0 <= number < 1 << (2 * _HALF_BITS):
+            raise ValueError(f"{number} is out of the secret code range")
+
+        left, right = number >> _HALF_BITS, number & _HALF_MASK
+        for index in range(_ROUNDS):
+            left, right = right, left ^ self._round(index, right)
+        value = left << _HALF_BITS | right
+
+        chars = []
+        for _ in range(CODE_LENGTH):
+            value, char = divmod(value, len(ALPHABET))
+            chars.append(ALPHABET[char])
+        return "".join(reversed(chars))
+
+    async def reserve(self, session: AsyncSession) -> tuple[int, str]:
+        """Vote result id and its secret code."""
+        if not self._ids:
+            self._ids.extend(
+                await self.storage.reserve_vote_result_ids(session, self.batch_size)
+            )
+        vote_result_id = self._ids.popleft()
+        return vote_result_id, self.code(vote_result_id)
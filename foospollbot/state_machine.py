@@ -1,5 +1,7 @@
-from transitions import Machine
+from typing import Any, Callable, NamedTuple, Optional
+from transitions import MachineError
 from models.entities import UserInfo, UserState
+from tracing import traced
 
 
 _transitions = [
@@ -40,14 +42,69 @@ _transitions = [
 ]
 
 
+class Transition(NamedTuple):
+    dest: UserState
+    conditions: tuple[str, ...]
+
+
+def _compile(
+    transitions: list[dict[str, Any]]
+) -> dict[str, dict[UserState, Transition]]:
+    table: dict[str, dict[UserState, Transition]] = {}
+    for transition in transitions:
+        conditions = transition.get("conditions", ())
+        if isinstance(conditions, str):
+            conditions = (conditions,)
+        table.setdefault(transition["trigger"], {})[transition["source"]] = Transition(
+            dest=transition["dest"], conditions=tuple(conditions)
+        )
+    return table
+
+
+_table = _compile(_transitions)
+
+
 class UserStateMachine:
+    """Applies triggers from ``_transitions`` through a table built at import.
+
+    Behaves like a ``transitions.Machine`` model: an unknown trigger for the
+    current state raises ``MachineError``, a failed condition leaves the state
+    unchanged and returns False.
+    """
+
+    __slots__ = ("state",)
+
     def __init__(self, state: UserState) -> None:
-        self._machine = Machine(
-            model=self,
-            states=UserState,
-            transitions=_transitions,
-            initial=state,
-        )
+        self.state = state
+
+    @traced
+    def trigger(self, trigger_name: str, *args: Any, **kwargs: Any) -> bool:
+        transition = _table[trigger_name].get(self.state)
+        if transition is None:
+            raise MachineError(
+                f"Can't trigger event {trigger_name} from state {self.state.name}!"
+            )
+
+        for condition in transition.conditions:
+            if not getattr(self, condition)(*args, **kwargs):
+                return False
+
+        self.state = transition.dest
+        return True
+
+    @staticmethod
+    def get_transitions(trigger_name: str) -> dict[UserState, Transition]:
+        """Source state -> transition mapping of a trigger."""
+        return _table[trigger_name]
+
+    @staticmethod
+    def find_trigger(source: UserState, dest: UserState) -> Optional[str]:
+        """Trigger moving a user from ``source`` to ``dest``, if there is one."""
+        for trigger_name, transitions in _table.items():
+            transition = transitions.get(source)
+            if transition is not None and transition.dest == dest:
+                return trigger_name
+        return None
 
     @staticmethod
     def get_initial_state() -> UserState:
@@ -61,6 +118,19 @@ class UserStateMachine:
                 user_info.phone is not None,
                 user_info.rtsf_url is not None,
                 user_info.evks_player_id is not None,
-                user_info.photo_id is not None,
+                user_info.photo_file_id is not None
+                or user_info.photo_id is not None,
             )
         )
+
+
+def _make_trigger(trigger_name: str) -> Callable[..., bool]:
+    def trigger(self: UserStateMachine, *args: Any, **kwargs: Any) -> bool:
+        return self.trigger(trigger_name, *args, **kwargs)
+
+    trigger.__name__ = trigger_name
+    return trigger
+
+
+for _trigger_name in _table:
+    setattr(UserStateMachine, _trigger_name, _make_trigger(_trigger_name))
@@ -1,13 +1,33 @@
-from typing import Optional, Any
+from typing import Optional, Any, AsyncIterator, Sequence
 from collections import defaultdict
 from contextlib import asynccontextmanager
+from uuid import uuid4
+import json
+import time
 from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy import select, func
+from sqlalchemy import (
+    BigInteger,
+    String,
+    and_,
+    any_,
+    case,
+    event,
+    literal,
+    or_,
+    select,
+    func,
+    update,
+)
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from transitions import MachineError
 
 from models.entities import (
     EvksPlayer,
+    PollDispatch,
+    PollDispatchStatus,
     TelegramUser,
     UserInfo,
     UserState,
@@ -15,23 +35,210 @@ from models.entities import (
     VoteResult,
 )
 from exceptions import EvksPlayerDoesNotExist, TelegramUserDoesNotExist
+from models.tables import (
+    evks_players,
+    poll_dispatches,
+    user_infos,
+    vote_results_id_seq,
+)
+from state_machine import UserStateMachine
+from cache import UserStateCache
+from tally import Tally
+from evks_index import AnyEvksPlayer, EvksPlayerIndex, EvksPlayerRecord
+from metrics import Counter, Gauge, Histogram
+from tracing import traced
+
+
+DB_POOL_CHECKOUTS = Counter(
+    "db_pool_checkouts_total", "Connections checked out from the pool"
+)
+DB_POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out", "Connections currently checked out from the pool"
+)
+DB_POOL_WAIT = Histogram(
+    "db_pool_wait_seconds",
+    "Time a checkout waited for a pooled connection, including connecting",
+)
+DB_CONNECTION_HELD = Histogram(
+    "db_connection_held_seconds", "Time a connection was checked out of the pool"
+)
+
+
+# SQL counterparts of the state machine transition conditions
+_transition_conditions = {
+    "has_full_info": (
+        user_infos.c.first_name.is_not(None),
+        user_infos.c.last_name.is_not(None),
+        user_infos.c.phone.is_not(None),
+        user_infos.c.rtsf_url.is_not(None),
+        user_infos.c.evks_player_id.is_not(None),
+        # photo_id is only set for photos submitted before file_id was kept
+        or_(
+            user_infos.c.photo_file_id.is_not(None),
+            user_infos.c.photo_id.is_not(None),
+        ),
+    ),
+}
+
+
+_undelivered_poll_dispatch = poll_dispatches.c.status.in_(
+    (PollDispatchStatus.PENDING, PollDispatchStatus.FAILED)
+)
+
+
+def _source_state(trigger: str, dest: UserState) -> UserState:
+    """Transitions of a trigger have distinct destinations."""
+    for source, transition in UserStateMachine.get_transitions(trigger).items():
+        if transition.dest == dest:
+            return source
+    raise MachineError(f"Event {trigger} has no transition to state {dest.name}!")
+
+
+# session.info keys for changes applied to in-process state on commit
+_STATE_CHANGES = "state_changes"
+_VOTES = "votes"
+
+
+# identifies this process in change notifications
+ORIGIN = uuid4().hex
+
+StateChange = tuple[int, Optional[UserState], UserState]
+
+# NOTIFY payloads must stay under 8000 bytes
+_NOTIFY_BATCH = 100
+
+
+def encode_changes(
+    state_changes: Sequence[StateChange],
+    votes: Sequence[str] = (),
+    evks_players: bool = False,
+    tally: Optional[dict[str, Any]] = None,
+) -> str:
+    """``tally`` is a recounted ``Tally.snapshot`` for the others to load."""
+    if tally is not None:
+        tally = {
+            "states": {state.value: count for state, count in tally["states"].items()},
+            "results": tally["results"],
+        }
+    return json.dumps(
+        {
+            "origin": ORIGIN,
+            "states": [
+                (telegram_user_id, source and source.value, dest.value)
+                for telegram_user_id, source, dest in state_changes
+            ],
+            "votes": list(votes),
+            "evks_players": evks_players,
+            "tally": tally,
+        },
+        ensure_ascii=False,
+    )
+
+
+def decode_changes(payload: str) -> dict[str, Any]:
+    message = json.loads(payload)
+    message["states"] = [
+        (telegram_user_id, source and UserState(source), UserState(dest))
+        for telegram_user_id, source, dest in message["states"]
+    ]
+    if (tally := message["tally"]) is not None:
+        tally["states"] = {
+            UserState(state): count for state, count in tally["states"].items()
+        }
+    return message
+
+
+def _bigint_array(values: Sequence[int]) -> Any:
+    """Binds ids as a single array parameter, to be used with ``= ANY(...)``."""
+    return literal(list(values), ARRAY(BigInteger))
+
+
+def _on_checkout(dbapi_connection: Any, connection_record: Any, *_: Any) -> None:
+    DB_POOL_CHECKOUTS.inc()
+    DB_POOL_CHECKED_OUT.inc()
+    connection_record.info["checked_out_at"] = time.perf_counter()
+
+
+def _on_checkin(dbapi_connection: Any, connection_record: Any) -> None:
+    DB_POOL_CHECKED_OUT.dec()
+    checked_out_at = connection_record.info.pop("checked_out_at", None)
+    if checked_out_at is not None:
+        DB_CONNECTION_HELD.observe(time.perf_counter() - checked_out_at)
+
+
+class MeteredPool(AsyncAdaptedQueuePool):
+    """Connection pool observing how long each checkout waited.
+
+    Sessions connect lazily on their first query, so the wait is measured
+    where the connection is actually taken from the pool.
+    """
+
+    def connect(self) -> Any:
+        started = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            DB_POOL_WAIT.observe(time.perf_counter() - started)
 
 
 class Storage:
     db_engine: Optional[AsyncEngine] = None
+    state_cache: Optional[UserStateCache] = None
+    tally: Optional[Tally] = None
+    evks_players: Optional[EvksPlayerIndex] = None
+    changes_channel: Optional[str] = None
+    _session_factory: Optional[sessionmaker] = None
 
     @classmethod
     def setup_db_engine(cls, db_engine: AsyncEngine) -> None:
         cls.db_engine = db_engine
+        cls._session_factory = sessionmaker(
+            db_engine, expire_on_commit=False, class_=AsyncSession
+        )
+        event.listen(db_engine.sync_engine, "checkout", _on_checkout)
+        event.listen(db_engine.sync_engine, "checkin", _on_checkin)
 
-    def _sessionmaker(self):
-        return sessionmaker(self.db_engine, expire_on_commit=False, class_=AsyncSession)
+    @classmethod
+    def setup_state_cache(cls, state_cache: UserStateCache) -> None:
+        cls.state_cache = state_cache
+
+    @classmethod
+    def setup_tally(cls, tally: Tally) -> None:
+        cls.tally = tally
+
+    @classmethod
+    def setup_evks_players(cls, evks_players: EvksPlayerIndex) -> None:
+        cls.evks_players = evks_players
+
+    @classmethod
+    def setup_changes_channel(cls, channel: str) -> None:
+        """Publishes committed changes for other processes, see cache_sync."""
+        cls.changes_channel = channel
 
     @asynccontextmanager
     async def session(self) -> AsyncSession:
-        async with self._sessionmaker()() as session:
+        async with self._session_factory() as session:
             yield session
 
+    @asynccontextmanager
+    async def advisory_lock(self, key: int) -> AsyncIterator[bool]:
+        """Tries a Postgres advisory lock, yields whether it was taken.
+
+        The lock is held by a connection of its own until the block exits,
+        so it excludes every process on the database and is dropped by the
+        server when the process dies.
+        """
+        async with self.db_engine.connect() as connection:
+            locked = await connection.scalar(select(func.pg_try_advisory_lock(key)))
+            await connection.commit()
+            try:
+                yield locked
+            finally:
+                if locked:
+                    await connection.execute(select(func.pg_advisory_unlock(key)))
+                    await connection.commit()
+
+    @traced
     async def get_telegram_user(
         self, session: AsyncSession, telegram_user_id: int
     ) -> TelegramUser:
@@ -43,6 +250,7 @@ class Storage:
         except NoResultFound as e:
             raise TelegramUserDoesNotExist(telegram_user_id=telegram_user_id) from e
 
+    @traced
     async def get_user_info(
         self, session: AsyncSession, telegram_user_id: int, for_update: bool = False
     ) -> UserInfo:
@@ -56,9 +264,240 @@ class Storage:
         except NoResultFound as e:
             raise TelegramUserDoesNotExist(telegram_user_id=telegram_user_id) from e
 
+    def get_cached_user_state(self, telegram_user_id: int) -> Optional[UserState]:
+        if self.state_cache is None:
+            return None
+        return self.state_cache.get(telegram_user_id)
+
+    def cache_user_state(self, telegram_user_id: int, state: UserState) -> None:
+        if self.state_cache is not None:
+            self.state_cache.set(telegram_user_id, state)
+
+    def invalidate_user_state(self, telegram_user_id: int) -> None:
+        if self.state_cache is not None:
+            self.state_cache.invalidate(telegram_user_id)
+
+    @traced
+    async def commit(self, session: AsyncSession) -> None:
+        """Commits, then applies tracked state changes and votes in memory.
+
+        With a changes channel set up the changes are also sent with NOTIFY
+        in the same transaction, so other processes get them on commit.
+        """
+        state_changes = session.info.pop(_STATE_CHANGES, [])
+        votes = session.info.pop(_VOTES, [])
+        if self.changes_channel is not None:
+            for start in range(0, max(len(state_changes), len(votes)), _NOTIFY_BATCH):
+                end = start + _NOTIFY_BATCH
+                await self._notify(
+                    session,
+                    encode_changes(state_changes[start:end], votes[start:end]),
+                )
+
+        await session.commit()
+        self.apply_changes(state_changes, votes)
+
+    async def _notify(self, session: AsyncSession, payload: str) -> None:
+        await session.execute(select(func.pg_notify(self.changes_channel, payload)))
+
+    def apply_changes(
+        self, state_changes: Sequence[StateChange], votes: Sequence[str]
+    ) -> None:
+        for telegram_user_id, source, dest in state_changes:
+            self.cache_user_state(telegram_user_id, dest)
+            if self.tally is not None:
+                self.tally.move(source, dest)
+        for option_text in votes:
+            if self.tally is not None:
+                self.tally.add_vote(option_text)
+
+    async def _publish(self, payload: str) -> None:
+        if self.changes_channel is None:
+            return
+        async with self.session() as session:
+            await self._notify(session, payload)
+            await session.commit()
+
+    async def publish_evks_players_changed(self) -> None:
+        await self._publish(encode_changes((), evks_players=True))
+
+    async def publish_tally(self) -> None:
+        """Sends the tally, so other processes needn't recount themselves."""
+        await self._publish(encode_changes((), tally=self.tally.snapshot()))
+
+    @staticmethod
+    def _track_state_change(
+        session: AsyncSession,
+        telegram_user_id: int,
+        source: Optional[UserState],
+        dest: UserState,
+    ) -> None:
+        session.info.setdefault(_STATE_CHANGES, []).append(
+            (telegram_user_id, source, dest)
+        )
+
+    def add_user_info(self, session: AsyncSession, user_info: UserInfo) -> None:
+        session.add(user_info)
+        self._track_state_change(
+            session, user_info.telegram_user_id, None, user_info.state
+        )
+
+    def add_vote_result(
+        self, session: AsyncSession, vote_result: VoteResult, option: VoteOption
+    ) -> None:
+        session.add(vote_result)
+        session.info.setdefault(_VOTES, []).append(option.text)
+
+    @traced
+    async def reserve_vote_result_ids(
+        self, session: AsyncSession, count: int
+    ) -> list[int]:
+        """Takes ids from the vote_results sequence, unused ones become gaps."""
+        result = await session.scalars(
+            select(vote_results_id_seq.next_value()).select_from(
+                func.generate_series(1, count)
+            )
+        )
+        return list(result)
+
+    async def refresh_tally(self) -> None:
+        """Full recount, run on startup and periodically to repair drift."""
+        async with self.session() as session:
+            info = await self.get_info(session)
+        self.tally.load(info)
+
+    @staticmethod
+    def _transition_clauses(
+        trigger: str, from_state: Optional[UserState] = None
+    ) -> tuple[Any, Any]:
+        """WHERE clause for allowed source states and the destination state."""
+        transitions = UserStateMachine.get_transitions(trigger)
+        if from_state is not None:
+            if from_state not in transitions:
+                raise MachineError(
+                    f"Can't trigger event {trigger} from state {from_state.name}!"
+                )
+            transitions = {from_state: transitions[from_state]}
+
+        state = user_infos.c.state
+        allowed = or_(
+            *(
+                and_(
+                    state == source,
+                    *(
+                        clause
+                        for condition in transition.conditions
+                        for clause in _transition_conditions[condition]
+                    ),
+                )
+                for source, transition in transitions.items()
+            )
+        )
+        dest = case(
+            *(
+                (state == source, literal(transition.dest, state.type))
+                for source, transition in transitions.items()
+            )
+        )
+        return allowed, dest
+
+    @traced
+    async def transition(
+        self,
+        session: AsyncSession,
+        telegram_user_id: int,
+        trigger: str,
+        from_state: Optional[UserState] = None,
+        **field_updates: Any,
+    ) -> UserInfo:
+        """Applies a state machine trigger with a single conditional UPDATE.
+
+        Allowed source states and conditions come from the state machine
+        transitions table, ``from_state`` narrows them down to one source.
+        Raises ``MachineError`` when the user is not in an allowed state.
+        """
+        allowed, dest = self._transition_clauses(trigger, from_state)
+        result = await session.scalars(
+            update(UserInfo)
+            .where(UserInfo.telegram_user_id == telegram_user_id, allowed)
+            .values(state=dest, **field_updates)
+            .returning(UserInfo),
+        )
+        if user_info := result.one_or_none():
+            self._track_state_change(
+                session,
+                telegram_user_id,
+                from_state or _source_state(trigger, user_info.state),
+                user_info.state,
+            )
+            return user_info
+
+        await self._raise_transition_error(session, telegram_user_id, trigger)
+
+    @traced
+    async def transition_many(
+        self,
+        session: AsyncSession,
+        telegram_user_ids: Sequence[int],
+        trigger: str,
+        from_state: Optional[UserState] = None,
+    ) -> list[int]:
+        """Applies a trigger to every user in an allowed state with one UPDATE.
+
+        Returns ids of the users that were transitioned, the rest are skipped.
+        """
+        allowed, dest = self._transition_clauses(trigger, from_state)
+        result = await session.execute(
+            update(user_infos)
+            .where(
+                user_infos.c.telegram_user_id == any_(_bigint_array(telegram_user_ids)),
+                allowed,
+            )
+            .values(state=dest)
+            .returning(user_infos.c.telegram_user_id, user_infos.c.state)
+        )
+        user_ids = []
+        for telegram_user_id, state in result.all():
+            self._track_state_change(
+                session,
+                telegram_user_id,
+                from_state or _source_state(trigger, state),
+                state,
+            )
+            user_ids.append(telegram_user_id)
+        return user_ids
+
+    @traced
+    async def get_user_states(
+        self, session: AsyncSession, telegram_user_ids: Sequence[int]
+    ) -> dict[int, UserState]:
+        result = await session.execute(
+            select(UserInfo.telegram_user_id, UserInfo.state).where(
+                UserInfo.telegram_user_id == any_(_bigint_array(telegram_user_ids))
+            )
+        )
+        return dict(result.all())
+
+    async def _raise_transition_error(
+        self, session: AsyncSession, telegram_user_id: int, trigger: str
+    ) -> None:
+        user_info = await self.get_user_info(session, telegram_user_id)
+        if not UserStateMachine(user_info.state).trigger(trigger, user_info):
+            raise MachineError(
+                f"Can't trigger event {trigger} from state {user_info.state.name}: "
+                "conditions are not met!"
+            )
+        raise MachineError(
+            f"Can't trigger event {trigger} from state {user_info.state.name}!"
+        )
+
+    @traced
     async def get_evks_player(
         self, session: AsyncSession, evks_player_id: int
-    ) -> EvksPlayer:
+    ) -> AnyEvksPlayer:
+        if self.evks_players is not None and self.evks_players.loaded:
+            return self.evks_players.get(evks_player_id)
+
         result = await session.execute(
             select(EvksPlayer).where(EvksPlayer.id == evks_player_id)
         )
@@ -67,18 +506,126 @@ class Storage:
         except NoResultFound as e:
             raise EvksPlayerDoesNotExist(evks_player_id=evks_player_id) from e
 
-    async def get_accepted_users(self, session: AsyncSession) -> list[int]:
+    @traced
+    async def create_poll_dispatches(self, session: AsyncSession) -> int:
+        """Queues a poll for every accepted user that has none yet."""
         result = await session.execute(
-            select(UserInfo.telegram_user_id).where(
-                UserInfo.state == UserState.ACCEPTED
+            insert(poll_dispatches)
+            .from_select(
+                ["telegram_user_id", "status"],
+                select(
+                    UserInfo.telegram_user_id,
+                    literal(PollDispatchStatus.PENDING, poll_dispatches.c.status.type),
+                ).where(UserInfo.state == UserState.ACCEPTED),
             )
+            .on_conflict_do_nothing(index_elements=["telegram_user_id"])
         )
-        return result.scalars().all()
+        return result.rowcount
+
+    @traced
+    async def count_undelivered_poll_dispatches(self, session: AsyncSession) -> int:
+        result = await session.execute(
+            select(func.count(PollDispatch.id)).where(_undelivered_poll_dispatch)
+        )
+        return result.scalar_one()
+
+    async def iter_undelivered_poll_dispatches(
+        self, chunk_size: int
+    ) -> AsyncIterator[list[int]]:
+        """Yields recipient ids in chunks using keyset pagination.
+
+        Every chunk is read in its own short session, so no connection or
+        cursor is held while the polls of a chunk are being sent.
+        """
+        last_id: Optional[int] = None
+        while True:
+            stmt = (
+                select(PollDispatch.telegram_user_id)
+                .where(_undelivered_poll_dispatch)
+                .order_by(PollDispatch.telegram_user_id)
+                .limit(chunk_size)
+            )
+            if last_id is not None:
+                stmt = stmt.where(PollDispatch.telegram_user_id > last_id)
+
+            async with self.session() as session:
+                result = await session.execute(stmt)
+                user_ids = result.scalars().all()
+
+            if not user_ids:
+                return
+            yield user_ids
+            last_id = user_ids[-1]
+
+    @traced
+    async def update_poll_dispatches(
+        self,
+        session: AsyncSession,
+        status: PollDispatchStatus,
+        errors: dict[int, Optional[str]],
+    ) -> None:
+        """Sets one status with one UPDATE, ``errors`` maps recipients to errors."""
+        values = func.unnest(
+            _bigint_array(list(errors)), literal(list(errors.values()), ARRAY(String))
+        ).table_valued("telegram_user_id", "error").render_derived()
+        await session.execute(
+            update(poll_dispatches)
+            .where(poll_dispatches.c.telegram_user_id == values.c.telegram_user_id)
+            .values(
+                status=status,
+                attempts=poll_dispatches.c.attempts + 1,
+                last_error=values.c.error,
+            )
+        )
+
+    async def get_unarchived_photos(
+        self, session: AsyncSession, limit: int
+    ) -> list[tuple[int, str]]:
+        result = await session.execute(
+            select(UserInfo.telegram_user_id, UserInfo.photo_file_id)
+            .where(
+                UserInfo.photo_file_id.is_not(None), UserInfo.photo_digest.is_(None)
+            )
+            # photos that keep failing must not crowd out the new ones
+            .order_by(UserInfo.photo_archive_failures, UserInfo.id)
+            .limit(limit)
+        )
+        return [tuple(row) for row in result.all()]
+
+    @traced
+    async def set_photo_digest(
+        self, session: AsyncSession, telegram_user_id: int, digest: str
+    ) -> None:
+        await session.execute(
+            update(UserInfo)
+            .where(UserInfo.telegram_user_id == telegram_user_id)
+            .values(photo_digest=digest)
+        )
+
+    @traced
+    async def add_photo_archive_failure(
+        self, session: AsyncSession, telegram_user_id: int
+    ) -> None:
+        await session.execute(
+            update(UserInfo)
+            .where(UserInfo.telegram_user_id == telegram_user_id)
+            .values(photo_archive_failures=UserInfo.photo_archive_failures + 1)
+        )
+
+    async def refresh_evks_players(self) -> int:
+        async with self.session() as session:
+            result = await session.execute(select(evks_players))
+            self.evks_players.load(
+                EvksPlayerRecord(**row) for row in result.mappings()
+            )
+        return len(self.evks_players)
 
+    @traced
     async def get_vote_options(self, session: AsyncSession) -> list[VoteOption]:
         result = await session.execute(select(VoteOption))
         return result.scalars().all()
 
+    @traced
     async def get_vote_option(
         self, session: AsyncSession, option_id: int
     ) -> VoteOption:
@@ -87,6 +634,7 @@ class Storage:
         )
         return result.one()[0]
 
+    @traced
     async def get_info(self, session: AsyncSession) -> dict[str, Any]:
         ret: dict[str, Any] = defaultdict(dict)
 
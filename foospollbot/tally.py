@@ -0,0 +1,37 @@
+from typing import Any, Optional
+from collections import Counter
+
+from models.entities import UserState
+
+
+class Tally:
+    """User state and vote counters kept in memory.
+
+    Updated by committed transitions and votes and reloaded from a full
+    recount periodically, which repairs any drift.
+    """
+
+    def __init__(self) -> None:
+        self.states: Counter[UserState] = Counter()
+        self.results: Counter[str] = Counter()
+        self.loaded = False
+
+    def load(self, info: dict[str, Any]) -> None:
+        self.states = Counter(info["states"])
+        self.results = Counter(info["results"])
+        self.loaded = True
+
+    def move(self, source: Optional[UserState], dest: UserState) -> None:
+        if source is not None:
+            self.states[source] -= 1
+        self.states[dest] += 1
+
+    def add_vote(self, option_text: str) -> None:
+        self.results[option_text] += 1
+
+    def snapshot(self) -> dict[str, Any]:
+        """Same shape as ``Storage.get_info``."""
+        return {
+            "states": {state: count for state, count in self.states.items() if count},
+            "results": dict(self.results),
+        }
@@ -0,0 +1,36 @@
+from cache import UserStateCache
+from models.entities import UserState
+
+
+class TestUserStateCache:
+    def test_hit_and_miss(self):
+        cache = UserStateCache(max_size=10)
+        assert cache.get(1) is None
+        cache.set(1, UserState.IN_REVIEW)
+        assert cache.get(1) == UserState.IN_REVIEW
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_lru_eviction(self):
+        cache = UserStateCache(max_size=2)
+        cache.set(1, UserState.ACCEPTED)
+        cache.set(2, UserState.ACCEPTED)
+        cache.get(1)
+        cache.set(3, UserState.ACCEPTED)
+        assert cache.get(2) is None
+        assert cache.get(1) == UserState.ACCEPTED
+        assert len(cache) == 2
+
+    def test_ttl_expiration(self, monkeypatch):
+        now = 100.0
+        monkeypatch.setattr("cache.time.monotonic", lambda: now)
+        cache = UserStateCache(max_size=10, ttl=5)
+        cache.set(1, UserState.VOTING)
+        now = 106.0
+        assert cache.get(1) is None
+        assert len(cache) == 0
+
+    def test_invalidate(self):
+        cache = UserStateCache(max_size=10)
+        cache.set(1, UserState.VOTING)
+        cache.invalidate(1)
+        assert cache.get(1) is None
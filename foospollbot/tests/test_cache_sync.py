@@ -0,0 +1,62 @@
+from cache import UserStateCache
+from cache_sync import ChangeListener
+from models.entities import UserState
+from storage import ORIGIN, Storage, decode_changes, encode_changes
+from tally import Tally
+
+
+def make_storage():
+    class LocalStorage(Storage):
+        pass
+
+    LocalStorage.setup_state_cache(UserStateCache(max_size=10))
+    LocalStorage.setup_tally(Tally())
+    return LocalStorage()
+
+
+class TestChangeEncoding:
+    def test_round_trip(self):
+        changes = [
+            (1, None, UserState.COLLECTING_FIRST_NAME),
+            (2, UserState.VOTING, UserState.VOTED),
+        ]
+        message = decode_changes(encode_changes(changes, ["Кандидат"]))
+        assert message["origin"] == ORIGIN
+        assert message["states"] == changes
+        assert message["votes"] == ["Кандидат"]
+        assert message["evks_players"] is False
+
+
+class TestChangeListener:
+    def test_applies_changes_of_other_processes(self):
+        storage = make_storage()
+        listener = ChangeListener(storage=storage, dsn="")
+        payload = encode_changes([(1, UserState.VOTING, UserState.VOTED)], ["A"])
+        payload = payload.replace(ORIGIN, "other")
+
+        listener._on_changes(None, 0, "channel", payload)
+
+        assert storage.state_cache.get(1) == UserState.VOTED
+        assert storage.tally.snapshot()["results"] == {"A": 1}
+        assert storage.tally.states[UserState.VOTING] == -1
+
+    def test_skips_own_changes(self):
+        storage = make_storage()
+        listener = ChangeListener(storage=storage, dsn="")
+        payload = encode_changes([(1, UserState.VOTING, UserState.VOTED)], ["A"])
+
+        listener._on_changes(None, 0, "channel", payload)
+
+        assert storage.state_cache.get(1) is None
+        assert storage.tally.snapshot()["results"] == {}
+
+    def test_loads_recounted_tally(self):
+        source = Tally()
+        source.load({"states": {UserState.VOTED: 2}, "results": {"A": 2}})
+        storage = make_storage()
+        listener = ChangeListener(storage=storage, dsn="")
+        payload = encode_changes((), tally=source.snapshot())
+
+        listener._on_changes(None, 0, "channel", payload.replace(ORIGIN, "other"))
+
+        assert storage.tally.snapshot() == source.snapshot()
@@ -0,0 +1,54 @@
+import csv
+import io
+
+from create_schema import CopyStream, parse_evks_players
+
+
+HEADER = (
+    "id,first_name,last_name,itsf_first_name,itsf_last_name,"
+    "itsf_license,foreigner,last_competition_date\n"
+)
+
+
+class TestParseEvksPlayers:
+    def test_quoted_fields(self):
+        lines = io.StringIO(
+            HEADER
+            + '1,"Иван, мл.","О\'Нил",Ivan,"O""Neil",123,1,2022-05-01\n'
+            + "2,Петр,Петров,NULL,,0,0,\n"
+        )
+        assert list(parse_evks_players(lines)) == [
+            [
+                *("1", "Иван, мл.", "О'Нил", "Ivan", 'O"Neil', "123"),
+                *("true", "2022-05-01", "2"),
+            ],
+            ["2", "Петр", "Петров", None, None, None, "false", None, "3"],
+        ]
+
+    def test_malformed_rows_skipped(self):
+        lines = io.StringIO(
+            HEADER
+            + "1,Иван,Иванов,,,,0\n"
+            + "x,Иван,Иванов,,,,0,\n"
+            + "3,Иван,Иванов,,,,0,01.05.2022\n"
+            + '4,"Иван\nИванов",Иванов,,,,0,\n'
+            + "\n"
+            + "5,Петр,Петров,,,,0,\n"
+        )
+        rows = list(parse_evks_players(lines))
+        assert [(row[0], row[-1]) for row in rows] == [("4", "5"), ("5", "8")]
+
+
+class TestCopyStream:
+    def test_round_trip(self):
+        rows = [["1", "Иван, мл.", None], ["2", 'O"Neil', "x"]]
+        stream = CopyStream(iter(rows))
+        data = ""
+        while chunk := stream.read(8):
+            data += chunk
+
+        assert stream.count == 2
+        assert list(csv.reader(io.StringIO(data))) == [
+            ["1", "Иван, мл.", ""],
+            ["2", 'O"Neil', "x"],
+        ]
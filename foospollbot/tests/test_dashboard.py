@@ -0,0 +1,110 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiogram.utils.exceptions import MessageToEditNotFound, RetryAfter
+
+from dashboard import LiveDashboard
+
+
+class FakeBot:
+    def __init__(self):
+        self.next_message_id = 100
+        self.edits = []
+        self.errors = {}
+
+    async def send_message(self, chat_id, text, parse_mode):
+        self.next_message_id += 1
+        return SimpleNamespace(message_id=self.next_message_id)
+
+    async def edit_message_text(self, text, chat_id, message_id, parse_mode):
+        if error := self.errors.pop(chat_id, None):
+            raise error
+        self.edits.append((chat_id, message_id, text))
+
+
+def make_dashboard():
+    bot = FakeBot()
+    texts = ["A"]
+    dashboard = LiveDashboard(bot, render=lambda: texts[-1], interval=3600)
+    return bot, texts, dashboard
+
+
+async def stop_all(dashboard):
+    for chat_id in list(dashboard._messages):
+        dashboard.stop(chat_id)
+    dashboard._task.cancel()
+
+
+class TestLiveDashboard:
+    def test_new_message_does_not_hide_stale_ones(self):
+        async def main():
+            bot, texts, dashboard = make_dashboard()
+            await dashboard.start(1)
+            texts.append("B")
+            await dashboard.start(2)
+
+            await dashboard.update()
+            assert bot.edits == [(1, 101, "B")]
+            await stop_all(dashboard)
+
+        asyncio.run(main())
+
+    def test_unchanged_text_not_edited(self):
+        async def main():
+            bot, texts, dashboard = make_dashboard()
+            await dashboard.start(1)
+            await dashboard.update()
+            texts.append("B")
+            await dashboard.update()
+            await dashboard.update()
+            assert bot.edits == [(1, 101, "B")]
+            await stop_all(dashboard)
+
+        asyncio.run(main())
+
+    def test_retry_edits_only_messages_left_behind(self):
+        async def main():
+            bot, texts, dashboard = make_dashboard()
+            await dashboard.start(1)
+            await dashboard.start(2)
+            texts.append("B")
+            bot.errors[2] = RetryAfter(0)
+
+            try:
+                await dashboard.update()
+            except RetryAfter:
+                pass
+            await dashboard.update()
+            assert bot.edits == [(1, 101, "B"), (2, 102, "B")]
+            await stop_all(dashboard)
+
+        asyncio.run(main())
+
+    def test_gone_message_stopped(self):
+        async def main():
+            bot, texts, dashboard = make_dashboard()
+            await dashboard.start(1)
+            texts.append("B")
+            bot.errors[1] = MessageToEditNotFound("message to edit not found")
+
+            await dashboard.update()
+            assert dashboard._messages == {}
+            assert dashboard._texts == {}
+            await stop_all(dashboard)
+
+        asyncio.run(main())
+
+    def test_restart_tracks_new_message(self):
+        async def main():
+            bot, texts, dashboard = make_dashboard()
+            await dashboard.start(1)
+            dashboard.stop(1)
+            await dashboard.start(1)
+            assert dashboard._texts == {(1, 102): "A"}
+
+            texts.append("B")
+            await dashboard.update()
+            assert bot.edits == [(1, 102, "B")]
+            await stop_all(dashboard)
+
+        asyncio.run(main())
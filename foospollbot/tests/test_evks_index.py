@@ -0,0 +1,29 @@
+from datetime import date
+import pytest
+
+from evks_index import EvksPlayerIndex, EvksPlayerRecord
+from exceptions import EvksPlayerDoesNotExist
+
+
+class TestEvksPlayerIndex:
+    def test_lookup(self):
+        index = EvksPlayerIndex()
+        index.load(
+            [
+                EvksPlayerRecord(
+                    id=175,
+                    first_name="Имя",
+                    last_name="Фамилия",
+                    foreigner=False,
+                    last_competition_date=date(2022, 1, 1),
+                )
+            ]
+        )
+        assert 175 in index
+        assert index.get(175).last_name == "Фамилия"
+
+    def test_does_not_exist(self):
+        index = EvksPlayerIndex()
+        index.load([])
+        with pytest.raises(EvksPlayerDoesNotExist):
+            index.get(1)
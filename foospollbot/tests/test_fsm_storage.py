@@ -0,0 +1,218 @@
+import asyncio
+from contextlib import asynccontextmanager
+import pytest
+from aiogram import Bot, Dispatcher
+from aiogram.dispatcher import FSMContext
+from aiogram.types import Update
+from transitions import MachineError
+
+from cache import UserStateCache
+from fsm_storage import PostgresStateStorage
+from models.entities import UserState
+from state_machine import UserStateMachine
+
+
+class FakeStorage:
+    def __init__(self, states, state_cache=None):
+        self.states = dict(states)
+        self.state_cache = state_cache
+        self.reads = []
+        self.writes = []
+        self.invalidated = []
+
+    @asynccontextmanager
+    async def session(self):
+        yield None
+
+    async def get_user_states(self, session, telegram_user_ids):
+        self.reads.append(sorted(telegram_user_ids))
+        return {
+            user_id: self.states[user_id]
+            for user_id in telegram_user_ids
+            if user_id in self.states
+        }
+
+    async def transition_many(self, session, telegram_user_ids, trigger, from_state):
+        self.writes.append((trigger, from_state, sorted(telegram_user_ids)))
+        dest = UserStateMachine.get_transitions(trigger)[from_state].dest
+        updated = [
+            user_id
+            for user_id in telegram_user_ids
+            if self.states.get(user_id) == from_state
+        ]
+        self.states.update({user_id: dest for user_id in updated})
+        return updated
+
+    def invalidate_user_state(self, telegram_user_id):
+        self.invalidated.append(telegram_user_id)
+
+    async def commit(self, session):
+        pass
+
+    def get_cached_user_state(self, telegram_user_id):
+        if self.state_cache is None:
+            return None
+        return self.state_cache.get(telegram_user_id)
+
+    def cache_user_state(self, telegram_user_id, state):
+        if self.state_cache is not None:
+            self.state_cache.set(telegram_user_id, state)
+
+
+def make_message_update(update_id, user_id):
+    return Update(
+        update_id=update_id,
+        message={
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+            "text": str(update_id),
+        },
+    )
+
+
+class TestPostgresStateStorage:
+    def test_concurrent_reads_batched(self):
+        storage = FakeStorage(
+            {1: UserState.VOTING, 2: UserState.IN_REVIEW},
+            state_cache=UserStateCache(max_size=10),
+        )
+        fsm = PostgresStateStorage(storage)
+
+        async def main():
+            states = await asyncio.gather(
+                *(fsm.get_state(user=user_id) for user_id in (1, 2, 3, 1))
+            )
+            # known states are cached, unknown users are asked again
+            await fsm.get_state(user=1)
+            await fsm.get_state(user=3)
+            return states
+
+        states = asyncio.run(main())
+        assert states == ["voting", "in_review", None, "voting"]
+        assert storage.reads == [[1, 2, 3], [3]]
+
+    def test_writes_buffered(self):
+        storage = FakeStorage(
+            {1: UserState.ACCEPTED, 2: UserState.VOTING, 3: UserState.ACCEPTED}
+        )
+        fsm = PostgresStateStorage(storage, write_buffer_size=2, flush_interval=60)
+
+        async def main():
+            await fsm.set_state(user=1, state="voting")
+            assert await fsm.get_state(user=1) == "voting"
+            assert storage.writes == []
+
+            await fsm.set_state(user=3, state="voting")
+            assert storage.writes == [("start_vote", UserState.ACCEPTED, [1, 3])]
+
+            await fsm.set_state(user=2, state="voted")
+            await fsm.close()
+
+        asyncio.run(main())
+        assert storage.writes[-1] == ("vote_result", UserState.VOTING, [2])
+        assert storage.states == {
+            1: UserState.VOTING,
+            2: UserState.VOTED,
+            3: UserState.VOTING,
+        }
+
+    def test_flush_interval(self):
+        storage = FakeStorage({1: UserState.ACCEPTED})
+        fsm = PostgresStateStorage(storage, flush_interval=0.01)
+
+        async def main():
+            await fsm.set_state(user=1, state="voting")
+            await asyncio.sleep(0.05)
+
+        asyncio.run(main())
+        assert storage.states == {1: UserState.VOTING}
+
+    def test_illegal_transition_rejected(self):
+        storage = FakeStorage({1: UserState.ACCEPTED})
+        fsm = PostgresStateStorage(storage)
+
+        async def main():
+            with pytest.raises(MachineError):
+                await fsm.set_state(user=1, state="voted")
+            with pytest.raises(MachineError):
+                await fsm.set_state(user=2, state="voting")
+            await fsm.close()
+
+        asyncio.run(main())
+        assert storage.writes == []
+        assert storage.states == {1: UserState.ACCEPTED}
+
+    def test_changed_state_not_overwritten(self):
+        storage = FakeStorage({1: UserState.ACCEPTED})
+        fsm = PostgresStateStorage(storage, flush_interval=60)
+
+        async def main():
+            await fsm.set_state(user=1, state="voting")
+            # another replica moved the user meanwhile
+            storage.states[1] = UserState.REJECTED
+            await fsm.close()
+            return await fsm.get_state(user=1)
+
+        assert asyncio.run(main()) == "rejected"
+        assert storage.invalidated == [1]
+
+    def test_set_state_and_finish(self):
+        storage = FakeStorage({1: UserState.ACCEPTED})
+        fsm = PostgresStateStorage(storage, flush_interval=60)
+
+        async def main():
+            dp = Dispatcher(
+                Bot(token="123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"), storage=fsm
+            )
+
+            @dp.message_handler(state=UserState.ACCEPTED.value)
+            async def start_vote(message, state: FSMContext):
+                await state.update_data(step=1)
+                await state.set_state(UserState.VOTING.value)
+                await state.finish()
+
+            await dp.process_updates([make_message_update(1, 1)])
+            data = await fsm.get_data(user=1)
+            await fsm.close()
+            return data
+
+        assert asyncio.run(main()) == {}
+        assert storage.states == {1: UserState.VOTING}
+
+    def test_data(self):
+        fsm = PostgresStateStorage(FakeStorage({}))
+
+        async def main():
+            await fsm.update_data(user=1, data={"a": 1}, b=2)
+            return await fsm.get_data(chat=1, user=1)
+
+        assert asyncio.run(main()) == {"a": 1, "b": 2}
+
+    def test_state_filters(self):
+        storage = FakeStorage({2: UserState.COLLECTING_PHONE})
+        handled = []
+
+        async def main():
+            dp = Dispatcher(
+                Bot(token="123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"),
+                storage=PostgresStateStorage(storage),
+            )
+
+            @dp.message_handler()
+            async def new_user(message):
+                handled.append(("new_user", message.from_user.id))
+
+            @dp.message_handler(state=UserState.COLLECTING_PHONE.value)
+            async def collect_phone(message):
+                handled.append(("collect_phone", message.from_user.id))
+
+            await dp.process_updates(
+                [make_message_update(1, 1), make_message_update(2, 2)]
+            )
+
+        asyncio.run(main())
+        assert sorted(handled) == [("collect_phone", 2), ("new_user", 1)]
+        # both updates resolved their state with one query
+        assert storage.reads == [[1, 2]]
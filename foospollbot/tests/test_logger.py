@@ -0,0 +1,146 @@
+import asyncio
+import json
+import logging
+import queue
+import threading
+
+from logger import (
+    ContextLoggerAdapter,
+    DroppingQueueHandler,
+    JsonFormatter,
+    LOG_RECORDS_DROPPED,
+    MongoBatchHandler,
+)
+
+
+class ListHandler(logging.Handler):
+    def __init__(self) -> None:
+        super().__init__()
+        self.records: list[logging.LogRecord] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.records.append(record)
+
+
+def make_logger(name, handler):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(handler)
+    return ContextLoggerAdapter(logger)
+
+
+def make_record(**context):
+    record = logging.LogRecord(
+        "app", logging.INFO, __file__, 1, "EVENT %s", ("happened",), None
+    )
+    record.context = context
+    return record
+
+
+class TestDroppingQueueHandler:
+    def test_drops_when_full(self):
+        handler = DroppingQueueHandler(queue.Queue(maxsize=1))
+        dropped = LOG_RECORDS_DROPPED.value()
+
+        handler.handle(make_record())
+        handler.handle(make_record())
+
+        assert handler.queue.qsize() == 1
+        assert LOG_RECORDS_DROPPED.value() == dropped + 1
+
+    def test_context_snapshot(self):
+        handler = DroppingQueueHandler(queue.Queue())
+        logger = make_logger("test_context_snapshot", handler)
+
+        with logger:
+            logger.context_push(handler="start")
+            logger.info("EVENT")
+            logger.context_push(handler="vote")
+
+        assert handler.queue.get_nowait().context == {"handler": "start"}
+
+
+class TestJsonFormatter:
+    def test_format(self):
+        data = json.loads(JsonFormatter().format(make_record(telegram_user_id=1)))
+        assert data["level"] == "INFO"
+        assert data["message"] == "EVENT happened"
+        assert data["context"] == {"telegram_user_id": 1}
+
+
+class FakeCollection:
+    def __init__(self) -> None:
+        self.batches: list[list[dict]] = []
+        self.inserted = threading.Event()
+
+    def insert_many(self, documents: list[dict], ordered: bool) -> None:
+        self.batches.append(documents)
+        self.inserted.set()
+
+
+class TestMongoBatchHandler:
+    def test_flush_when_full(self):
+        collection = FakeCollection()
+        handler = MongoBatchHandler(collection, batch_size=2, flush_interval=60)
+        handler.handle(make_record())
+        assert collection.batches == []
+        handler.handle(make_record())
+        assert [len(batch) for batch in collection.batches] == [2]
+        assert handler._timer is None
+
+    def test_flush_after_interval_without_new_records(self):
+        collection = FakeCollection()
+        handler = MongoBatchHandler(collection, batch_size=100, flush_interval=0.05)
+        handler.handle(make_record(telegram_user_id=1))
+        handler.handle(make_record(telegram_user_id=2))
+        assert collection.inserted.wait(timeout=5)
+        assert [len(batch) for batch in collection.batches] == [2]
+        assert handler.buffer == []
+        handler.close()
+
+
+class TestContextLoggerAdapter:
+    def test_nested_context(self):
+        handler = ListHandler()
+        logger = make_logger("test_nested_context", handler)
+
+        with logger:
+            logger.context_push(handler="vote")
+            with logger:
+                logger.context_push(option=1)
+                logger.info("INNER")
+            logger.info("OUTER")
+        logger.info("NO_CONTEXT")
+
+        assert [record.context for record in handler.records] == [
+            {"handler": "vote", "option": 1},
+            {"handler": "vote"},
+            {},
+        ]
+
+    def test_concurrent_handlers_isolated(self):
+        handler = ListHandler()
+        logger = make_logger("test_concurrent_handlers_isolated", handler)
+
+        async def handle(telegram_user_id: int) -> None:
+            with logger:
+                logger.context_push(telegram_user_id=telegram_user_id)
+                await asyncio.sleep(0)
+                with logger:
+                    logger.context_push(step="inner")
+                    await asyncio.sleep(0)
+                    logger.info("INNER %s", telegram_user_id)
+                await asyncio.sleep(0)
+                logger.info("OUTER %s", telegram_user_id)
+
+        async def main() -> None:
+            await asyncio.gather(*(handle(i) for i in range(1000)))
+
+        asyncio.run(main())
+
+        assert len(handler.records) == 2000
+        for record in handler.records:
+            assert record.context["telegram_user_id"] == record.args[0]
+            assert ("step" in record.context) == record.msg.startswith("INNER")
+        assert logger._get_context() == {}
@@ -0,0 +1,47 @@
+import pytest
+
+from metrics import Counter, Histogram, Registry, render
+
+
+class TestMetrics:
+    def test_counter_labels(self):
+        counter = Counter("updates_total", "", registry=Registry())
+        counter.inc(handler="a")
+        counter.inc(2, handler="a")
+        counter.inc(handler="b")
+        assert counter.value(handler="a") == 3
+        assert counter.value(handler="c") == 0
+
+    def test_histogram_buckets(self):
+        histogram = Histogram("latency", "", registry=Registry(), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.observe(value)
+
+        samples = {
+            (name, dict(labels).get("le")): value
+            for name, labels, value in histogram.collect()
+        }
+        assert samples[("latency_bucket", "0.1")] == 2
+        assert samples[("latency_bucket", "1.0")] == 3
+        assert samples[("latency_bucket", "+Inf")] == 4
+        assert samples[("latency_count", None)] == 4
+        assert histogram.sum() == pytest.approx(5.65)
+
+    def test_render(self):
+        registry = Registry()
+        counter = Counter("updates_total", "Updates", registry=registry)
+        counter.inc(handler='say "hi"')
+        histogram = Histogram("latency", "Latency", registry=registry, buckets=(1,))
+        histogram.observe(0.5)
+
+        assert render(registry) == (
+            "# HELP updates_total Updates\n"
+            "# TYPE updates_total counter\n"
+            'updates_total{handler="say \\"hi\\""} 1.0\n'
+            "# HELP latency Latency\n"
+            "# TYPE latency histogram\n"
+            'latency_bucket{le="1.0"} 1.0\n'
+            'latency_bucket{le="+Inf"} 1.0\n'
+            "latency_sum 0.5\n"
+            "latency_count 1.0\n"
+        )
@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+from contextlib import asynccontextmanager
+
+from photo_archive import PhotoArchive, store_photo
+
+
+class TestStorePhoto:
+    def test_content_addressed(self, tmp_path):
+        digest = store_photo(tmp_path, b"photo")
+        assert digest == hashlib.sha256(b"photo").hexdigest()
+        assert (tmp_path / f"{digest}.jpg").read_bytes() == b"photo"
+
+    def test_duplicate_written_once(self, tmp_path):
+        digest = store_photo(tmp_path, b"photo")
+        path = tmp_path / f"{digest}.jpg"
+        mtime = path.stat().st_mtime_ns
+
+        assert store_photo(tmp_path, b"photo") == digest
+        assert path.stat().st_mtime_ns == mtime
+        assert [p.name for p in tmp_path.iterdir()] == [f"{digest}.jpg"]
+
+
+class FakeBot:
+    def __init__(self, failures):
+        self.failures = failures
+        self.downloads = []
+
+    async def download_file_by_id(self, file_id, destination):
+        self.downloads.append(file_id)
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("download failed")
+        destination.write(file_id.encode())
+        return destination
+
+
+class FakeStorage:
+    def __init__(self, unarchived):
+        self.unarchived = dict(unarchived)
+        self.failures = {}
+        self.scans = 0
+
+    @asynccontextmanager
+    async def session(self):
+        yield None
+
+    async def get_unarchived_photos(self, session, limit):
+        self.scans += 1
+        pending = sorted(
+            self.unarchived.items(),
+            key=lambda item: (self.failures.get(item[0], 0), item[0]),
+        )
+        return pending[:limit]
+
+    async def set_photo_digest(self, session, telegram_user_id, digest):
+        del self.unarchived[telegram_user_id]
+
+    async def add_photo_archive_failure(self, session, telegram_user_id):
+        self.failures[telegram_user_id] = self.failures.get(telegram_user_id, 0) + 1
+
+    async def commit(self, session):
+        pass
+
+
+def make_archive(tmp_path, bot, storage, queue_size=10):
+    return PhotoArchive(
+        bot=bot,
+        storage=storage,
+        directory=tmp_path,
+        concurrency=1,
+        queue_size=queue_size,
+        max_attempts=3,
+        retry_backoff=0,
+        rescan_interval=0.01,
+    )
+
+
+class TestPhotoArchive:
+    def test_retried(self, tmp_path):
+        bot = FakeBot(failures=2)
+        storage = FakeStorage({})
+        archive = make_archive(tmp_path, bot, storage)
+
+        async def main():
+            await archive.start()
+            storage.unarchived[1] = "file"
+            archive.submit(1, "file")
+            await archive._queue.join()
+
+        asyncio.run(main())
+        assert bot.downloads == ["file"] * 3
+        assert storage.unarchived == {}
+
+    def test_overflow_rescanned(self, tmp_path):
+        bot = FakeBot(failures=0)
+        storage = FakeStorage({user_id: f"file{user_id}" for user_id in range(5)})
+        archive = make_archive(tmp_path, bot, storage, queue_size=2)
+
+        async def main():
+            await archive.start()
+            while storage.unarchived:
+                await asyncio.sleep(0.01)
+
+        asyncio.run(main())
+        assert sorted(bot.downloads) == [f"file{user_id}" for user_id in range(5)]
+        assert storage.scans > 1
+
+    def test_failing_photos_dont_block_new_ones(self, tmp_path):
+        class BrokenFilesBot(FakeBot):
+            async def download_file_by_id(self, file_id, destination):
+                if file_id.startswith("broken"):
+                    self.downloads.append(file_id)
+                    raise ConnectionError("file is gone")
+                return await super().download_file_by_id(file_id, destination)
+
+        bot = BrokenFilesBot(failures=0)
+        storage = FakeStorage({0: "broken0", 1: "broken1"})
+        storage.unarchived.update(
+            {user_id: f"file{user_id}" for user_id in range(2, 5)}
+        )
+        archive = make_archive(tmp_path, bot, storage, queue_size=2)
+
+        async def main():
+            await archive.start()
+            while len(storage.unarchived) > 2:
+                await asyncio.sleep(0.01)
+
+        asyncio.run(asyncio.wait_for(main(), timeout=5))
+        assert sorted(storage.unarchived) == [0, 1]
+        assert storage.failures[0] >= 1
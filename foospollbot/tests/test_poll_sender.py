@@ -0,0 +1,148 @@
+import asyncio
+from contextlib import asynccontextmanager
+import pytest
+
+from models.entities import PollDispatchStatus
+from poll_sender import AbstractPollSender
+
+
+async def chunks(user_ids, size):
+    for start in range(0, len(user_ids), size):
+        yield user_ids[start:start + size]
+
+
+class FakePollSender(AbstractPollSender):
+    bot = None
+    storage = None
+    CONCURRENT_POLLS = 2
+
+    def __init__(self, total):
+        super().__init__(options=(), total=total)
+        self.attempted = []
+
+    async def _start_vote(self, user_ids):
+        return list(user_ids)
+
+    async def _send_poll(self, telegram_user_id):
+        self.attempted.append(telegram_user_id)
+        if telegram_user_id % 2:
+            raise ConnectionError("database is gone")
+
+
+class FakeStorage:
+    def __init__(self):
+        self.transactions = []
+        self.alive = True
+
+    @asynccontextmanager
+    async def session(self):
+        if not self.alive:
+            raise ConnectionError("the process is gone")
+        self.transactions.append([])
+        yield self
+
+    async def update_poll_dispatches(self, session, status, errors):
+        self.transactions[-1].append((status, dict(errors)))
+
+    async def commit(self):
+        pass
+
+
+class TestPollSender:
+    def test_recipient_failures_dont_stop_workers(self):
+        sender = FakePollSender(total=20)
+        asyncio.run(
+            asyncio.wait_for(sender.send(chunks(list(range(20)), 5)), timeout=5)
+        )
+        assert sorted(sender.attempted) == list(range(20))
+
+    def test_dead_workers_raise(self):
+        class DyingPollSender(FakePollSender):
+            async def _worker(self, queue):
+                raise ValueError("worker died")
+
+        sender = DyingPollSender(total=20)
+        with pytest.raises(ValueError):
+            asyncio.run(
+                asyncio.wait_for(sender.send(chunks(list(range(20)), 5)), timeout=5)
+            )
+
+    def test_statuses_written_per_chunk(self):
+        storage = FakeStorage()
+
+        class BatchingPollSender(AbstractPollSender):
+            bot = None
+            CONCURRENT_POLLS = 2
+            RESULTS_BATCH_SIZE = 5
+
+            async def _start_vote(self, user_ids):
+                return list(user_ids)
+
+            async def _send_message(self, telegram_user_id):
+                if telegram_user_id == 3:
+                    raise ConnectionError("blocked")
+
+        BatchingPollSender.storage = storage
+        sender = BatchingPollSender(options=(), total=12)
+        asyncio.run(sender.send(chunks(list(range(12)), 5)))
+
+        assert len(storage.transactions) == 3
+        written = {}
+        for transaction in storage.transactions:
+            for status, errors in transaction:
+                for telegram_user_id, error in errors.items():
+                    written[telegram_user_id] = (status, error)
+        assert written.pop(3) == (
+            PollDispatchStatus.FAILED,
+            "ConnectionError('blocked')",
+        )
+        assert written == {
+            telegram_user_id: (PollDispatchStatus.SENT, None)
+            for telegram_user_id in range(12)
+            if telegram_user_id != 3
+        }
+        assert (sender.progress.sent, sender.progress.failed) == (11, 1)
+
+    def test_resume_after_kill_skips_sent_polls(self):
+        storage = FakeStorage()
+        sent = []
+
+        class KilledPollSender(AbstractPollSender):
+            bot = None
+            CONCURRENT_POLLS = 2
+            RESULTS_INTERVAL = 0.01
+
+            async def _start_vote(self, user_ids):
+                return list(user_ids)
+
+            async def _send_message(self, telegram_user_id):
+                if telegram_user_id >= 8:
+                    # the process is killed while these are in flight
+                    await asyncio.Event().wait()
+                sent.append(telegram_user_id)
+
+        KilledPollSender.storage = storage
+
+        async def main():
+            sender = KilledPollSender(options=(), total=12)
+            task = asyncio.ensure_future(sender.send(chunks(list(range(12)), 5)))
+            while len(sent) < 8:
+                await asyncio.sleep(0.001)
+            await asyncio.sleep(0.05)
+            # nothing is written after a kill
+            storage.alive = False
+            task.cancel()
+            with pytest.raises((asyncio.CancelledError, ConnectionError)):
+                await task
+
+        asyncio.run(main())
+        delivered = {
+            telegram_user_id
+            for transaction in storage.transactions
+            for status, errors in transaction
+            if status == PollDispatchStatus.SENT
+            for telegram_user_id in errors
+        }
+        # resume sends the undelivered dispatches only
+        assert delivered == set(sent)
+        assert [i for i in range(12) if i not in delivered] == [8, 9, 10, 11]
@@ -0,0 +1,111 @@
+import asyncio
+from aiogram.types import Update
+
+from polling import UpdatePoller, ordering_key
+
+
+def make_update(update_id, user_id):
+    return Update(
+        update_id=update_id,
+        message={
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+            "text": str(update_id),
+        },
+    )
+
+
+class FakeBot:
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.offsets = []
+
+    async def get_updates(self, offset=None, limit=None, timeout=None):
+        self.offsets.append(offset)
+        if self.batches:
+            return self.batches.pop(0)
+        if timeout:
+            await asyncio.sleep(timeout)
+        return []
+
+
+class FakeDispatcher:
+    def __init__(self, bot):
+        self.bot = bot
+        self.processed = []
+        self.running = 0
+        self.max_running = 0
+
+    async def process_updates(self, updates):
+        (update,) = updates
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.01 if update.update_id % 2 else 0)
+        self.processed.append(update)
+        self.running -= 1
+
+
+class TestUpdatePoller:
+    def test_ordering_key(self):
+        assert ordering_key(make_update(1, 42)) == 42
+        assert ordering_key(Update(update_id=7)) == 7
+
+    def test_per_user_order_and_drain(self):
+        updates = [make_update(i, i % 4) for i in range(1, 41)]
+        bot = FakeBot([updates[:20], updates[20:]])
+        dispatcher = FakeDispatcher(bot)
+        poller = UpdatePoller(dispatcher, max_pending=8, timeout=60)
+
+        async def main():
+            task = asyncio.ensure_future(poller.run())
+            while len(bot.offsets) < 3:
+                await asyncio.sleep(0)
+            poller.stop()
+            await task
+
+        asyncio.run(main())
+
+        assert len(dispatcher.processed) == 40
+        assert dispatcher.max_running > 1
+        for user_id in range(4):
+            ids = [
+                update.update_id
+                for update in dispatcher.processed
+                if update.message.from_user.id == user_id
+            ]
+            assert ids == sorted(ids)
+        # the final call confirms everything processed
+        assert bot.offsets[-1] == 41
+
+    def test_slow_user_does_not_block_others(self):
+        release = asyncio.Event()
+
+        class SlowDispatcher(FakeDispatcher):
+            async def process_updates(self, updates):
+                (update,) = updates
+                if update.message.from_user.id == 1:
+                    await release.wait()
+                self.processed.append(update)
+
+        updates = [make_update(1, 1), make_update(2, 1)]
+        updates += [make_update(i, 2 + i % 3) for i in range(3, 13)]
+        bot = FakeBot([updates])
+        dispatcher = SlowDispatcher(bot)
+        poller = UpdatePoller(dispatcher, max_pending=20, timeout=60)
+
+        async def main():
+            task = asyncio.ensure_future(poller.run())
+            while len(dispatcher.processed) < 10:
+                await asyncio.sleep(0)
+            processed = [update.update_id for update in dispatcher.processed]
+            release.set()
+            poller.stop()
+            await task
+            return processed
+
+        processed = asyncio.run(main())
+        assert processed == list(range(3, 13))
+        assert [update.update_id for update in dispatcher.processed[-2:]] == [1, 2]
+        assert not poller._chains
@@ -0,0 +1,40 @@
+import asyncio
+import time
+
+from rate_limit import TokenBucket
+
+
+class TestTokenBucket:
+    def test_rate(self):
+        async def acquire_all():
+            bucket = TokenBucket(rate=100, capacity=1)
+            for _ in range(11):
+                await bucket.acquire()
+
+        started = time.monotonic()
+        asyncio.run(acquire_all())
+        assert time.monotonic() - started >= 0.09
+
+    def test_pause(self):
+        async def acquire_after_pause():
+            bucket = TokenBucket(rate=1000)
+            bucket.pause(0.1)
+            await bucket.acquire()
+
+        started = time.monotonic()
+        asyncio.run(acquire_after_pause())
+        assert time.monotonic() - started >= 0.1
+
+    def test_no_burst_after_pause(self):
+        async def acquire_after_pause():
+            bucket = TokenBucket(rate=100)
+            bucket.pause(0.05)
+            sent = []
+            for _ in range(6):
+                await bucket.acquire()
+                sent.append(time.monotonic())
+            return sent
+
+        sent = asyncio.run(acquire_after_pause())
+        # sends are spaced by the rate, not released as a full bucket
+        assert sent[-1] - sent[0] >= 0.045
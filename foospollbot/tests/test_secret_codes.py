@@ -0,0 +1,42 @@
+import asyncio
+
+from secret_codes import ALPHABET, CODE_LENGTH, SecretCodes
+
+
+class FakeStorage:
+    def __init__(self):
+        self.next_id = 1
+        self.reservations = 0
+
+    async def reserve_vote_result_ids(self, session, count):
+        self.reservations += 1
+        ids = list(range(self.next_id, self.next_id + count))
+        self.next_id += count
+        return ids
+
+
+class TestSecretCodes:
+    def test_codes_unique(self):
+        secret_codes = SecretCodes(key="key", storage=None, batch_size=1)
+        codes = {secret_codes.code(number) for number in range(20_000)}
+        assert len(codes) == 20_000
+        assert all(len(code) == CODE_LENGTH for code in codes)
+        assert set("".join(codes)) == set(ALPHABET)
+
+    def test_codes_depend_on_key(self):
+        first = SecretCodes(key="first", storage=None, batch_size=1)
+        second = SecretCodes(key="second", storage=None, batch_size=1)
+        assert first.code(1) == first.code(1)
+        assert first.code(1) != second.code(1)
+
+    def test_reserve_in_batches(self):
+        storage = FakeStorage()
+        secret_codes = SecretCodes(key="key", storage=storage, batch_size=10)
+
+        async def main():
+            return [await secret_codes.reserve(None) for _ in range(25)]
+
+        reserved = asyncio.run(main())
+        assert [vote_result_id for vote_result_id, _ in reserved] == list(range(1, 26))
+        assert reserved[0][1] == secret_codes.code(1)
+        assert storage.reservations == 3
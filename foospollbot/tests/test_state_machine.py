@@ -0,0 +1,63 @@
+from uuid import uuid4
+import pytest
+from transitions import MachineError
+
+from models.entities import UserInfo, UserState
+from state_machine import UserStateMachine
+
+
+def make_user_info(**kwargs):
+    return UserInfo(id=1, telegram_user_id=1, state=UserState.IN_REVIEW, **kwargs)
+
+
+class TestUserStateMachine:
+    def test_registration_flow(self):
+        user_sm = UserStateMachine(UserStateMachine.get_initial_state())
+        for _ in range(5):
+            user_sm.next()
+        assert user_sm.state == UserState.IN_REVIEW
+
+    @pytest.mark.parametrize(
+        "state,trigger",
+        (
+            (UserState.IN_REVIEW, "next"),
+            (UserState.COLLECTING_PHONE, "approve"),
+            (UserState.ACCEPTED, "vote_result"),
+            (UserState.VOTED, "start_vote"),
+        ),
+    )
+    def test_invalid_trigger(self, state, trigger):
+        user_sm = UserStateMachine(state)
+        with pytest.raises(MachineError):
+            getattr(user_sm, trigger)(make_user_info())
+        assert user_sm.state == state
+
+    def test_approve_requires_full_info(self):
+        user_sm = UserStateMachine(UserState.IN_REVIEW)
+        assert user_sm.approve(make_user_info(first_name="Name")) is False
+        assert user_sm.state == UserState.IN_REVIEW
+
+    def test_approve(self):
+        user_info = make_user_info(
+            first_name="Name",
+            last_name="Surname",
+            phone="+7 (999) 999-99-99",
+            rtsf_url="https://rtsf.ru/ratings/player/1",
+            evks_player_id=1,
+            photo_id=uuid4(),
+        )
+        user_sm = UserStateMachine(UserState.IN_REVIEW)
+        assert user_sm.approve(user_info) is True
+        assert user_sm.state == UserState.ACCEPTED
+
+    def test_approve_with_photo_file_id(self):
+        user_info = make_user_info(
+            first_name="Name",
+            last_name="Surname",
+            phone="+7 (999) 999-99-99",
+            rtsf_url="https://rtsf.ru/ratings/player/1",
+            evks_player_id=1,
+            photo_file_id="AgACAgIAAxkBAAIBY2",
+        )
+        user_sm = UserStateMachine(UserState.IN_REVIEW)
+        assert user_sm.approve(user_info) is True
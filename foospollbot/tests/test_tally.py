@@ -0,0 +1,30 @@
+from models.entities import UserState
+from tally import Tally
+
+
+class TestTally:
+    def test_move_and_vote(self):
+        tally = Tally()
+        tally.load(
+            {"states": {UserState.ACCEPTED: 2, UserState.VOTING: 1}, "results": {}}
+        )
+        tally.move(UserState.ACCEPTED, UserState.VOTING)
+        tally.move(UserState.VOTING, UserState.VOTED)
+        tally.move(None, UserState.COLLECTING_FIRST_NAME)
+        tally.add_vote("Candidate")
+
+        assert tally.snapshot() == {
+            "states": {
+                UserState.ACCEPTED: 1,
+                UserState.VOTING: 1,
+                UserState.VOTED: 1,
+                UserState.COLLECTING_FIRST_NAME: 1,
+            },
+            "results": {"Candidate": 1},
+        }
+
+    def test_load_replaces_counters(self):
+        tally = Tally()
+        tally.add_vote("Candidate")
+        tally.load({"states": {UserState.VOTED: 3}, "results": {"Candidate": 3}})
+        assert tally.snapshot()["results"] == {"Candidate": 3}
@@ -0,0 +1,82 @@
+import asyncio
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from tracing import Trace, Tracer, TracingMiddleware, _current_trace, span, traced
+
+
+@traced
+async def load() -> int:
+    await asyncio.sleep(0)
+    return 1
+
+
+class TestTracing:
+    def test_span_without_trace(self):
+        with span("noop"):
+            pass
+        assert _current_trace.get() is None
+
+    def test_traced_records_spans(self):
+        async def handle() -> Trace:
+            trace = Trace(update_id=1)
+            _current_trace.set(trace)
+            assert await load() == 1
+            with span("render"):
+                await load()
+            return trace
+
+        trace = asyncio.run(handle())
+
+        assert [name for name, _, _ in trace.spans] == ["load", "load", "render"]
+        assert trace.summary()["load"][0] == 2
+
+    def test_slowest(self):
+        tracer = Tracer(size=2)
+        for update_id, duration in enumerate((0.3, 0.1, 0.2)):
+            tracer.traces.append(Trace(update_id=update_id, duration=duration))
+
+        assert [trace.update_id for trace in tracer.slowest(1)] == [2]
+        assert len(tracer.traces) == 2
+
+    def test_task_spans_stop_with_update(self):
+        tracer = Tracer(size=10)
+        background = []
+
+        async def work(finished: asyncio.Event) -> None:
+            await load()
+            await finished.wait()
+            await load()
+
+        async def main() -> None:
+            dp = Dispatcher(Bot(token="123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"))
+            dp.middleware.setup(TracingMiddleware(tracer))
+            finished = asyncio.Event()
+
+            @dp.message_handler()
+            async def start(message):
+                background.append(asyncio.ensure_future(work(finished)))
+                await asyncio.sleep(0.01)
+
+            await dp.process_updates(
+                [
+                    Update(
+                        update_id=1,
+                        message={
+                            "message_id": 1,
+                            "date": 0,
+                            "chat": {"id": 1, "type": "private"},
+                            "from": {"id": 1, "is_bot": False, "first_name": "U"},
+                            "text": "start",
+                        },
+                    )
+                ]
+            )
+            finished.set()
+            await background[0]
+
+        asyncio.run(main())
+        [trace] = tracer.traces
+        assert trace.handler == "start"
+        # only the span the task recorded while the update was processed
+        assert [name for name, _, _ in trace.spans] == ["load"]
@@ -0,0 +1,167 @@
+import asyncio
+from aiogram import Bot, Dispatcher
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.types import Update
+
+from user_serialization import KeyedLocks, UserSerialization
+
+
+def make_message_update(update_id, user_id):
+    return Update(
+        update_id=update_id,
+        message={
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+            "text": str(update_id),
+        },
+    )
+
+
+def make_callback_update(update_id, user_id, message_id):
+    return Update(
+        update_id=update_id,
+        callback_query={
+            "id": str(update_id),
+            "chat_instance": "chat",
+            "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+            "message": {
+                "message_id": message_id,
+                "date": 0,
+                "chat": {"id": user_id, "type": "private"},
+                "text": "poll",
+            },
+            "data": "VOTE_OPTION:1",
+        },
+    )
+
+
+def make_dispatcher(serialization):
+    dp = Dispatcher(Bot(token="123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"))
+    serialization.install(dp)
+    return dp
+
+
+class CancellingMiddleware(BaseMiddleware):
+    async def on_pre_process_update(self, update, data):
+        raise CancelHandler()
+
+
+class TestUserSerialization:
+    def test_user_updates_serialized(self):
+        serialization = UserSerialization(coalesce_window=10)
+        events = []
+
+        async def main():
+            dp = make_dispatcher(serialization)
+
+            @dp.message_handler()
+            async def handler(message):
+                events.append(("start", message.from_user.id, message.message_id))
+                await asyncio.sleep(0.01)
+                events.append(("end", message.from_user.id, message.message_id))
+
+            await asyncio.gather(
+                *(
+                    dp.process_updates([make_message_update(i, i % 2 + 1)])
+                    for i in range(1, 7)
+                )
+            )
+
+        asyncio.run(main())
+
+        for user_id in (1, 2):
+            user_events = [e for e in events if e[1] == user_id]
+            assert [e[0] for e in user_events] == ["start", "end"] * 3
+            message_ids = [e[2] for e in user_events[::2]]
+            assert message_ids == sorted(message_ids)
+        # both users were in progress at the same time
+        assert events[0][0] == events[1][0] == "start"
+        assert len(serialization.locks) == 0
+
+    def test_duplicate_callbacks_coalesced(self):
+        serialization = UserSerialization(coalesce_window=10)
+        handled = []
+
+        async def main():
+            dp = make_dispatcher(serialization)
+
+            @dp.callback_query_handler()
+            async def handler(callback_query):
+                handled.append(callback_query.id)
+
+            await asyncio.gather(
+                dp.process_updates([make_callback_update(1, 5, message_id=100)]),
+                dp.process_updates([make_callback_update(2, 5, message_id=100)]),
+                dp.process_updates([make_callback_update(3, 5, message_id=101)]),
+            )
+
+        asyncio.run(main())
+
+        assert handled == ["1", "3"]
+        assert len(serialization.locks) == 0
+
+    def test_failed_callback_not_coalesced(self):
+        serialization = UserSerialization(coalesce_window=10)
+        handled = []
+
+        async def main():
+            dp = make_dispatcher(serialization)
+
+            @dp.callback_query_handler()
+            async def handler(callback_query):
+                handled.append(callback_query.id)
+                if len(handled) == 1:
+                    raise ValueError("first attempt fails")
+
+            @dp.errors_handler(exception=ValueError)
+            async def errors_handler(update, exception):
+                return True
+
+            await asyncio.gather(
+                dp.process_updates([make_callback_update(1, 5, message_id=100)]),
+                dp.process_updates([make_callback_update(2, 5, message_id=100)]),
+            )
+            await dp.process_updates([make_callback_update(3, 5, message_id=100)])
+
+        asyncio.run(main())
+
+        assert handled == ["1", "2"]
+        assert len(serialization.locks) == 0
+
+    def test_lock_released_when_cancelled(self):
+        serialization = UserSerialization(coalesce_window=10)
+
+        async def main():
+            dp = make_dispatcher(serialization)
+            dp.middleware.setup(CancellingMiddleware())
+            await dp.process_updates([make_message_update(1, 1)])
+
+            @dp.message_handler()
+            async def handler(message):
+                pass
+
+            await asyncio.wait_for(
+                dp.process_updates([make_message_update(2, 1)]), timeout=1
+            )
+
+        asyncio.run(main())
+        assert len(serialization.locks) == 0
+
+
+class TestKeyedLocks:
+    def test_cancelled_waiter_forgotten(self):
+        locks = KeyedLocks()
+
+        async def main():
+            await locks.acquire(1)
+            waiter = asyncio.ensure_future(locks.acquire(1))
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+            locks.release(1)
+
+        asyncio.run(main())
+        assert len(locks) == 0
@@ -0,0 +1,71 @@
+import asyncio
+import json
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from workers import FrontDispatcher
+
+
+def make_update(update_id, user_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+            "text": str(update_id),
+        },
+    }
+
+
+def make_worker(index, received):
+    async def handle(request):
+        received.append((index, (await request.json())["update_id"]))
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post("/webhook", handle)
+    return app
+
+
+class TestFrontDispatcher:
+    def test_routes_users_to_the_same_worker(self):
+        async def run():
+            received = []
+            servers = [TestServer(make_worker(i, received)) for i in range(2)]
+            for server in servers:
+                await server.start_server()
+            front = FrontDispatcher(
+                worker_ports=[server.port for server in servers],
+                webhook_path="/webhook",
+            )
+            async with TestClient(TestServer(front.create_app())) as client:
+                for update_id, user_id in enumerate([1, 2, 1, 3, 2]):
+                    response = await client.post(
+                        "/webhook", data=json.dumps(make_update(update_id, user_id))
+                    )
+                    assert response.status == 200
+                response = await client.post("/webhook", data="not json")
+                assert response.status == 400
+            for server in servers:
+                await server.close()
+            return received
+
+        received = asyncio.run(run())
+        assert received == [(1, 0), (0, 1), (1, 2), (1, 3), (0, 4)]
+
+    def test_unavailable_worker(self):
+        async def run():
+            server = TestServer(web.Application())
+            await server.start_server()
+            port = server.port
+            await server.close()
+            front = FrontDispatcher(worker_ports=[port], webhook_path="/webhook")
+            async with TestClient(TestServer(front.create_app())) as client:
+                response = await client.post(
+                    "/webhook", data=json.dumps(make_update(0, 1))
+                )
+                return response.status
+
+        assert asyncio.run(run()) == 502
@@ -0,0 +1,128 @@
+from typing import Any, Callable, Optional, TypeVar
+from collections import deque
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+import functools
+import inspect
+import time
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.types import CallbackQuery, Message, Update
+
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+@dataclass
+class Trace:
+    update_id: int
+    started: float = field(default_factory=time.perf_counter)
+    handler: Optional[str] = None
+    telegram_user_id: Optional[int] = None
+    duration: float = 0.0
+    # set once the update is processed, tasks it started may outlive it
+    closed: bool = False
+    # (name, offset from the start of the update, duration) in seconds
+    spans: list[tuple[str, float, float]] = field(default_factory=list)
+
+    def summary(self) -> dict[str, tuple[int, float]]:
+        """Span name -> (count, total duration), longest total first."""
+        totals: dict[str, tuple[int, float]] = {}
+        for name, _, duration in self.spans:
+            count, total = totals.get(name, (0, 0.0))
+            totals[name] = (count + 1, total + duration)
+        return dict(sorted(totals.items(), key=lambda item: -item[1][1]))
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+
+class span:
+    """Records the enclosed block in the trace of the current update.
+
+    Outside of a traced update, i.e. when tracing is off, it only costs a
+    context variable lookup. Tasks started by a handler inherit its trace,
+    their spans after the update is processed are not recorded.
+    """
+
+    __slots__ = ("name", "_trace", "_started")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self) -> None:
+        self._trace = _current_trace.get()
+        if self._trace is not None and self._trace.closed:
+            self._trace = None
+        if self._trace is not None:
+            self._started = time.perf_counter()
+
+    def __exit__(self, *_: Any) -> None:
+        if self._trace is not None and not self._trace.closed:
+            now = time.perf_counter()
+            self._trace.spans.append(
+                (self.name, self._started - self._trace.started, now - self._started)
+            )
+
+
+def traced(func: F) -> F:
+    """Wraps a function or coroutine function in a span named after it."""
+    name = func.__qualname__
+
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+            with span(name):
+                return await func(*args, **kwargs)
+
+        return async_wrapper  # type: ignore
+
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        with span(name):
+            return func(*args, **kwargs)
+
+    return wrapper  # type: ignore
+
+
+class Tracer:
+    """Keeps the traces of the last ``size`` updates."""
+
+    def __init__(self, size: int) -> None:
+        self.traces: deque[Trace] = deque(maxlen=size)
+
+    def slowest(self, limit: int) -> list[Trace]:
+        return sorted(self.traces, key=lambda trace: -trace.duration)[:limit]
+
+
+class TracingMiddleware(BaseMiddleware):
+    def __init__(self, tracer: Tracer) -> None:
+        super().__init__()
+        self.tracer = tracer
+
+    async def on_pre_process_update(self, update: Update, data: dict) -> None:
+        _current_trace.set(Trace(update_id=update.update_id))
+
+    async def on_post_process_update(
+        self, update: Update, results: list, data: dict
+    ) -> None:
+        if (trace := _current_trace.get()) is None:
+            return
+        trace.duration = time.perf_counter() - trace.started
+        trace.closed = True
+        self.tracer.traces.append(trace)
+        _current_trace.set(None)
+
+    def _set_handler(self, telegram_user_id: int) -> None:
+        if (trace := _current_trace.get()) is not None:
+            trace.handler = current_handler.get().__name__
+            trace.telegram_user_id = telegram_user_id
+
+    async def on_process_message(self, message: Message, data: dict) -> None:
+        self._set_handler(message.from_user.id)
+
+    async def on_process_callback_query(
+        self, callback_query: CallbackQuery, data: dict
+    ) -> None:
+        self._set_handler(callback_query.from_user.id)
@@ -0,0 +1,136 @@
+from typing import Awaitable, Callable, Optional
+from collections import Counter as CounterDict
+import asyncio
+import time
+from aiogram.dispatcher import Dispatcher
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.types import Update
+
+from metrics import Counter
+from polling import ordering_key
+
+
+CALLBACKS_COALESCED = Counter(
+    "callback_queries_coalesced_total",
+    "Repeated callback queries for the same message that were dropped",
+)
+
+
+class KeyedLocks:
+    """FIFO locks per key, dropped as soon as nobody holds or waits for them."""
+
+    def __init__(self) -> None:
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._users: CounterDict[int] = CounterDict()
+
+    async def acquire(self, key: int) -> None:
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._users[key] += 1
+        try:
+            await lock.acquire()
+        except BaseException:
+            self._forget(key)
+            raise
+
+    def release(self, key: int) -> None:
+        self._locks[key].release()
+        self._forget(key)
+
+    def _forget(self, key: int) -> None:
+        self._users[key] -= 1
+        if not self._users[key]:
+            del self._users[key]
+            del self._locks[key]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+class UserSerialization(BaseMiddleware):
+    """Processes the updates of a user one at a time, in arrival order.
+
+    ``install`` wraps the dispatcher's update handler, so the lock is taken
+    before any middleware or filter runs and released in the same
+    try/finally, whatever the middlewares raise. Waiting updates hold no DB
+    connection.
+
+    A callback query for a message whose callback was handled in the last
+    ``coalesce_window`` seconds is dropped, so double taps on a keyboard
+    reach the handler once. A tap arriving while the first one is in
+    progress waits for its outcome, and a callback that failed doesn't
+    count, so retries after an error go through.
+    """
+
+    def __init__(self, coalesce_window: float) -> None:
+        super().__init__()
+        self.coalesce_window = coalesce_window
+        self.locks = KeyedLocks()
+        self._callbacks: dict[tuple[int, int], float] = {}
+        self._in_flight: dict[tuple[int, int], asyncio.Future[bool]] = {}
+        self._failed: set[int] = set()
+
+    def install(self, dispatcher: Dispatcher) -> None:
+        dispatcher.middleware.setup(self)
+        notify = dispatcher.updates_handler.notify
+
+        async def serialized_notify(update: Update) -> list:
+            return await self.process(update, notify)
+
+        dispatcher.updates_handler.notify = serialized_notify
+
+    @staticmethod
+    def _callback_key(update: Update) -> Optional[tuple[int, int]]:
+        if update.callback_query is None or update.callback_query.message is None:
+            return None
+        message = update.callback_query.message
+        return message.chat.id, message.message_id
+
+    async def _is_duplicate(self, key: tuple[int, int]) -> bool:
+        while (in_flight := self._in_flight.get(key)) is not None:
+            if await asyncio.shield(in_flight):
+                return True
+        seen = self._callbacks.get(key)
+        return seen is not None and time.monotonic() - seen < self.coalesce_window
+
+    def _finish_callback(self, key: tuple[int, int], handled: bool) -> None:
+        if handled:
+            now = time.monotonic()
+            if len(self._callbacks) > 10_000:
+                self._callbacks = {
+                    key: seen
+                    for key, seen in self._callbacks.items()
+                    if now - seen < self.coalesce_window
+                }
+            self._callbacks[key] = now
+        self._in_flight.pop(key).set_result(handled)
+
+    async def process(
+        self, update: Update, notify: Callable[[Update], Awaitable[list]]
+    ) -> list:
+        callback_key = self._callback_key(update)
+        if callback_key is not None:
+            if await self._is_duplicate(callback_key):
+                CALLBACKS_COALESCED.inc()
+                return []
+            self._in_flight[callback_key] = asyncio.get_running_loop().create_future()
+
+        handled = False
+        try:
+            key = ordering_key(update)
+            await self.locks.acquire(key)
+            try:
+                results = await notify(update)
+            finally:
+                self.locks.release(key)
+            handled = update.update_id not in self._failed
+            return results
+        finally:
+            self._failed.discard(update.update_id)
+            if callback_key is not None:
+                self._finish_callback(callback_key, handled)
+
+    async def on_pre_process_error(
+        self, update: Update, exception: BaseException, data: dict
+    ) -> None:
+        # the errors handler answers the user, the update still failed
+        self._failed.add(update.update_id)
@@ -0,0 +1,129 @@
+from typing import Callable, Optional
+import asyncio
+import json
+import multiprocessing
+from multiprocessing.process import BaseProcess
+from aiohttp import ClientError, ClientSession, web
+
+from polling import raw_ordering_key
+from logger import get_logger
+
+
+class WorkerPool:
+    """Webhook worker processes, restarted when they die.
+
+    Processes are spawned rather than forked, so each one re-imports the
+    main module, which registers the handlers, and builds its own engine
+    and event loop.
+    """
+
+    logger = get_logger()
+
+    def __init__(
+        self, count: int, target: Callable[[int], None], check_interval: float = 5.0
+    ) -> None:
+        self.count = count
+        self.target = target
+        self.check_interval = check_interval
+        self._context = multiprocessing.get_context("spawn")
+        self._processes: list[Optional[BaseProcess]] = [None] * count
+
+    def _spawn(self, index: int) -> None:
+        process = self._context.Process(
+            target=self.target, args=(index,), name=f"worker-{index}", daemon=True
+        )
+        process.start()
+        self._processes[index] = process
+
+    def start(self) -> None:
+        for index in range(self.count):
+            self._spawn(index)
+
+    async def watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.check_interval)
+            for index, process in enumerate(self._processes):
+                if process is not None and not process.is_alive():
+                    with self.logger:
+                        self.logger.context_push(
+                            worker=index, exitcode=process.exitcode
+                        )
+                        self.logger.error("WORKER_DIED")
+                    self._spawn(index)
+
+    def stop(self, timeout: float = 30.0) -> None:
+        processes = [process for process in self._processes if process is not None]
+        for process in processes:
+            # aiohttp finishes the requests in flight on SIGTERM
+            process.terminate()
+        for process in processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.kill()
+
+
+class FrontDispatcher:
+    """Forwards webhook requests to worker processes by sender.
+
+    Updates of a user always go to the same worker, so per-user ordering
+    holds with several workers. Only the update's JSON is parsed here, the
+    workers do everything else.
+    """
+
+    logger = get_logger()
+
+    def __init__(self, worker_ports: list[int], webhook_path: str) -> None:
+        self.worker_ports = worker_ports
+        self.webhook_path = webhook_path
+        self._session: Optional[ClientSession] = None
+
+    def _url(self, index: int, path: str) -> str:
+        return f"http://127.0.0.1:{self.worker_ports[index]}{path}"
+
+    async def _forward(self, url: str, body: bytes) -> web.Response:
+        try:
+            async with self._session.post(
+                url, data=body, headers={"Content-Type": "application/json"}
+            ) as response:
+                return web.Response(
+                    body=await response.read(),
+                    status=response.status,
+                    content_type=response.content_type,
+                )
+        except ClientError:
+            self.logger.exception("WORKER_UNAVAILABLE")
+            # Telegram delivers the update again later
+            raise web.HTTPBadGateway()
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        try:
+            key = raw_ordering_key(json.loads(body))
+        except (ValueError, KeyError, TypeError):
+            raise web.HTTPBadRequest()
+        index = key % len(self.worker_ports)
+        return await self._forward(self._url(index, self.webhook_path), body)
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        index = int(request.match_info["worker"])
+        if index >= len(self.worker_ports):
+            raise web.HTTPNotFound()
+        async with self._session.get(self._url(index, "/metrics")) as response:
+            return web.Response(
+                body=await response.read(),
+                headers={"Content-Type": response.headers["Content-Type"]},
+            )
+
+    async def _on_startup(self, _: web.Application) -> None:
+        self._session = ClientSession()
+
+    async def _on_cleanup(self, _: web.Application) -> None:
+        await self._session.close()
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.webhook_path, self.handle_update)
+        app.router.add_get(r"/metrics/{worker:\d+}", self.handle_metrics)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
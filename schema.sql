@@ -36,6 +36,19 @@ CREATE TYPE public.userstate AS ENUM (
 
 ALTER TYPE public.userstate OWNER TO foospoll;
 
+--
+-- Name: polldispatchstatus; Type: TYPE; Schema: public; Owner: foospoll
+--
+
+CREATE TYPE public.polldispatchstatus AS ENUM (
+    'PENDING',
+    'SENT',
+    'FAILED'
+);
+
+
+ALTER TYPE public.polldispatchstatus OWNER TO foospoll;
+
 SET default_tablespace = '';
 
 SET default_table_access_method = heap;
@@ -80,6 +93,45 @@ ALTER TABLE public.evks_players_id_seq OWNER TO foospoll;
 ALTER SEQUENCE public.evks_players_id_seq OWNED BY public.evks_players.id;
 
 
+--
+-- Name: poll_dispatches; Type: TABLE; Schema: public; Owner: foospoll
+--
+
+CREATE TABLE public.poll_dispatches (
+    id integer NOT NULL,
+    telegram_user_id bigint,
+    status public.polldispatchstatus,
+    attempts integer DEFAULT 0,
+    last_error text,
+    created timestamp without time zone DEFAULT now(),
+    updated timestamp without time zone
+);
+
+
+ALTER TABLE public.poll_dispatches OWNER TO foospoll;
+
+--
+-- Name: poll_dispatches_id_seq; Type: SEQUENCE; Schema: public; Owner: foospoll
+--
+
+CREATE SEQUENCE public.poll_dispatches_id_seq
+    AS integer
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1;
+
+
+ALTER TABLE public.poll_dispatches_id_seq OWNER TO foospoll;
+
+--
+-- Name: poll_dispatches_id_seq; Type: SEQUENCE OWNED BY; Schema: public; Owner: foospoll
+--
+
+ALTER SEQUENCE public.poll_dispatches_id_seq OWNED BY public.poll_dispatches.id;
+
+
 --
 -- Name: telegram_users; Type: TABLE; Schema: public; Owner: foospoll
 --
@@ -129,6 +181,9 @@ CREATE TABLE public.user_infos (
     rtsf_url character varying,
     evks_player_id integer,
     photo_id uuid,
+    photo_file_id character varying,
+    photo_digest character varying,
+    photo_archive_failures integer DEFAULT 0 NOT NULL,
     state public.userstate,
     created timestamp without time zone DEFAULT now(),
     updated timestamp without time zone
@@ -237,6 +292,13 @@ ALTER SEQUENCE public.vote_results_id_seq OWNED BY public.vote_results.id;
 ALTER TABLE ONLY public.evks_players ALTER COLUMN id SET DEFAULT nextval('public.evks_players_id_seq'::regclass);
 
 
+--
+-- Name: poll_dispatches id; Type: DEFAULT; Schema: public; Owner: foospoll
+--
+
+ALTER TABLE ONLY public.poll_dispatches ALTER COLUMN id SET DEFAULT nextval('public.poll_dispatches_id_seq'::regclass);
+
+
 --
 -- Name: telegram_users id; Type: DEFAULT; Schema: public; Owner: foospoll
 --
@@ -273,6 +335,22 @@ ALTER TABLE ONLY public.evks_players
     ADD CONSTRAINT evks_players_pkey PRIMARY KEY (id);
 
 
+--
+-- Name: poll_dispatches poll_dispatches_pkey; Type: CONSTRAINT; Schema: public; Owner: foospoll
+--
+
+ALTER TABLE ONLY public.poll_dispatches
+    ADD CONSTRAINT poll_dispatches_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: poll_dispatches poll_dispatches_telegram_user_id_key; Type: CONSTRAINT; Schema: public; Owner: foospoll
+--
+
+ALTER TABLE ONLY public.poll_dispatches
+    ADD CONSTRAINT poll_dispatches_telegram_user_id_key UNIQUE (telegram_user_id);
+
+
 --
 -- Name: telegram_users telegram_users_pkey; Type: CONSTRAINT; Schema: public; Owner: foospoll
 --
@@ -337,6 +415,14 @@ ALTER TABLE ONLY public.vote_results
     ADD CONSTRAINT vote_results_telegram_user_id_key UNIQUE (telegram_user_id);
 
 
+--
+-- Name: poll_dispatches poll_dispatches_telegram_user_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: foospoll
+--
+
+ALTER TABLE ONLY public.poll_dispatches
+    ADD CONSTRAINT poll_dispatches_telegram_user_id_fkey FOREIGN KEY (telegram_user_id) REFERENCES public.telegram_users(id);
+
+
 --
 -- Name: user_infos user_infos_evks_player_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: foospoll
 --